@@ -0,0 +1,93 @@
+#! /usr/bin/env python
+
+# ======================================================================
+# matscipy - Python materials science tools
+# https://github.com/libAtoms/matscipy
+#
+# Copyright (2014) James Kermode, King's College London
+#                  Lars Pastewka, Karlsruhe Institute of Technology
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# ======================================================================
+
+"""
+Compare coordination counting in find_tip_coordination with the ASE
+neighbour list it used previously, on silicon crack clusters from
+clusters.diamond of increasing size, with a slit opened in their left
+half.
+
+    python find_tip_coordination.py [repeat] [n ...]
+"""
+
+import sys
+import time
+
+import numpy as np
+
+try:
+    from ase.calculators.neighborlist import NeighborList
+except ImportError:
+    from ase.neighborlist import NeighborList
+
+from matscipy.fracture_mechanics.clusters import diamond
+from matscipy.fracture_mechanics.crack import find_tip_coordination
+from matscipy.neighbours import neighbour_list
+
+###
+
+def ase_coordination(a, bondlength=2.6):
+    """ Coordination numbers as previously computed by
+        find_tip_coordination. """
+    nl = NeighborList([bondlength/2.0]*len(a),
+                      skin=0.0,
+                      self_interaction=False,
+                      bothways=True)
+    nl.update(a)
+    return np.array([len(nl.get_neighbors(i)[0]) for i in range(len(a))])
+
+
+def open_crack(a, opening=1.5):
+    """ Open a slit in the left half of the cluster by displacing the atoms
+        above and below its centre. """
+    x, y = a.positions[:, 0], a.positions[:, 1]
+    left = x < a.cell[0, 0]/2
+    a.positions[left & (y > a.cell[1, 1]/2), 1] += opening/2
+    a.positions[left & (y < a.cell[1, 1]/2), 1] -= opening/2
+
+
+def best_time(f, *args):
+    times = []
+    for k in range(repeat):
+        t0 = time.time()
+        retval = f(*args)
+        times += [time.time()-t0]
+    return min(times), retval
+
+###
+
+repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+sizes = [int(x) for x in sys.argv[2:]] or [5, 10, 20, 40]
+
+print('%8s %10s %12s %12s %12s %10s' % ('n', 'atoms', 'ASE/s',
+                                        'matscipy/s', 'tip/s', 'speedup'))
+for n in sizes:
+    a = diamond('Si', 5.43, [n, n, 1], crack_surface=[1, 1, 1],
+                crack_front=[1, -1, 0])
+    open_crack(a)
+    t_ase, nn_ase = best_time(ase_coordination, a)
+    t_matscipy, nn = best_time(neighbour_list, 'N', a, 2.6)
+    assert (nn == nn_ase).all()
+    t_tip, bonds = best_time(find_tip_coordination, a)
+    print('%8i %10i %12.4f %12.4f %12.4f %10.1f' %
+          (n, len(a), t_ase, t_matscipy, t_tip, t_ase/t_matscipy))
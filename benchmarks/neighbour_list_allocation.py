@@ -0,0 +1,85 @@
+#! /usr/bin/env python
+
+# ======================================================================
+# matscipy - Python materials science tools
+# https://github.com/libAtoms/matscipy
+#
+# Copyright (2014) James Kermode, King's College London
+#                  Lars Pastewka, Karlsruhe Institute of Technology
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# ======================================================================
+
+"""
+Wall time and peak memory of neighbour list builds for amorphous carbon
+(tests/aC.traj) replicated to about 10^6 atoms. The time is the best of
+repeat builds, all builds have the same peak memory.
+
+Peak memory is a per-process quantity, run one measurement per process:
+
+    python neighbour_list_allocation.py [nat] [cutoff] [quantities] [repeat]
+"""
+
+import os
+import resource
+import sys
+import time
+
+import numpy as np
+
+import ase.io as io
+
+from matscipy.neighbours import neighbour_list
+
+###
+
+def peak_rss():
+    """ Peak resident set size of this process in MB. """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.
+
+
+def amorphous_carbon(nat):
+    """ Replicate tests/aC.traj until it has at least nat atoms. """
+    a = io.read(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '..', 'tests', 'aC.traj'))
+    n = int(np.ceil((float(nat)/len(a))**(1./3)))
+    return a*(n, n, n)
+
+###
+
+nat = int(float(sys.argv[1])) if len(sys.argv) > 1 else 10**6
+cutoff = float(sys.argv[2]) if len(sys.argv) > 2 else 1.85
+quantities = sys.argv[3] if len(sys.argv) > 3 else 'ijDdS'
+repeat = max(int(sys.argv[4]), 1) if len(sys.argv) > 4 else 1
+
+a = amorphous_carbon(nat)
+rss0 = peak_rss()
+
+times = []
+for k in range(repeat):
+    # Release the previous result first, it would count towards peak memory
+    r = None
+    t0 = time.time()
+    r = neighbour_list(quantities, a, cutoff)
+    times += [time.time()-t0]
+t = min(times)
+
+rss1 = peak_rss()
+npairs = len(r[0]) if len(quantities) > 1 else len(r)
+
+print('%i atoms, cutoff %.2f, %i pairs' % (len(a), cutoff, npairs))
+print('time %.3f s, %.2e pairs/s' % (t, npairs/t))
+print('peak RSS %.1f MB (%.1f MB before neighbour list, %.1f MB of '
+      'results)' % (rss1, rss0, sum(x.nbytes for x in r)/1024.**2
+                    if len(quantities) > 1 else r.nbytes/1024.**2))
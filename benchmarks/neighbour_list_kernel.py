@@ -0,0 +1,75 @@
+#! /usr/bin/env python
+
+# ======================================================================
+# matscipy - Python materials science tools
+# https://github.com/libAtoms/matscipy
+#
+# Copyright (2014) James Kermode, King's College London
+#                  Lars Pastewka, Karlsruhe Institute of Technology
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# ======================================================================
+
+"""
+Microbenchmark of the pair search kernel on large periodic cells. Amorphous
+carbon (tests/aC.traj) is replicated to the given numbers of atoms and the
+best of several neighbour list builds is reported as time per candidate
+pair and per stored pair.
+
+    python neighbour_list_kernel.py [cutoff] [repeat] [nat ...]
+"""
+
+import os
+import sys
+import time
+
+import numpy as np
+
+import ase.io as io
+
+from matscipy.neighbours import neighbour_list
+
+###
+
+def amorphous_carbon(nat):
+    """ Replicate tests/aC.traj until it has at least nat atoms. """
+    a = io.read(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '..', 'tests', 'aC.traj'))
+    n = int(np.ceil((float(nat)/len(a))**(1./3)))
+    return a*(n, n, n)
+
+###
+
+cutoff = float(sys.argv[1]) if len(sys.argv) > 1 else 3.0
+repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+sizes = [int(float(x)) for x in sys.argv[3:]] or [10**4, 10**5, 5*10**5]
+
+print('%10s %10s %12s %10s %14s %14s' % ('atoms', 'cutoff', 'pairs',
+                                         'time/s', 'ns/candidate',
+                                         'ns/pair'))
+for nat in sizes:
+    a = amorphous_carbon(nat)
+    times = []
+    for k in range(repeat):
+        t0 = time.time()
+        i = neighbour_list('i', a, cutoff)
+        times += [time.time()-t0]
+    t = min(times)
+
+    # Candidates are all atoms in the 27 neighbouring bins of each atom,
+    # bins are about cutoff wide
+    density = len(a)/a.get_volume()
+    ncandidates = len(a)*27*density*cutoff**3
+    print('%10i %10.2f %12i %10.3f %14.2f %14.2f' %
+          (len(a), cutoff, len(i), t, 1e9*t/ncandidates, 1e9*t/len(i)))
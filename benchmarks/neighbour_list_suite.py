@@ -0,0 +1,228 @@
+#! /usr/bin/env python
+
+# ======================================================================
+# matscipy - Python materials science tools
+# https://github.com/libAtoms/matscipy
+#
+# Copyright (2014) James Kermode, King's College London
+#                  Lars Pastewka, Karlsruhe Institute of Technology
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# ======================================================================
+
+"""
+Benchmark suite for neighbour_list. Amorphous carbon (tests/aC.traj) is
+replicated to the requested numbers of atoms. Each case is run in a fresh
+process and reports the best wall time of several builds, the throughput in
+pairs per second and the increase of the peak resident set size.
+
+By default, a scaling curve over the number of atoms is measured for a
+reference case, followed by sweeps that vary one of cutoff, cell shape,
+periodicity and quantities at a time. --full runs all combinations instead.
+
+    python neighbour_list_suite.py [--sizes 1e3 1e4 ...] [--full]
+        [--output results.json] [--compare baseline.json]
+
+With --compare, cases that are slower than in the baseline by more than
+--tolerance are listed and the script exits with a nonzero status, which
+allows to catch regressions of the C kernel.
+"""
+
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import time
+
+import numpy as np
+
+import ase.io as io
+
+from matscipy.neighbours import neighbour_list
+
+###
+
+REFERENCE = dict(cutoff=3.0, cell='orthorhombic', pbc='TTT',
+                 quantities='ijDd')
+
+CELLS = ['orthorhombic', 'triclinic']
+
+PBCS = ['TTT', 'TTF', 'TFF', 'FFF']
+
+# Every quantity on its own and the full list
+QUANTITIES = ['i', 'j', 'D', 'd', 'S', 'p', 'N', 'h', 'ijDdSp']
+
+###
+
+def peak_rss():
+    """ Peak resident set size of this process in MB. """
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, OS X bytes
+    return rss/1024.**2 if sys.platform == 'darwin' else rss/1024.
+
+
+def amorphous_carbon(nat, cell, pbc):
+    """ Replicate tests/aC.traj until it has at least nat atoms. Triclinic
+        cells are sheared in all three planes. """
+    a = io.read(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '..', 'tests', 'aC.traj'))
+    n = int(np.ceil((float(nat)/len(a))**(1./3)))
+    a *= (n, n, n)
+    if cell == 'triclinic':
+        shear = np.array([[1.0, 0.0, 0.0],
+                          [0.3, 1.0, 0.0],
+                          [0.2, -0.25, 1.0]])
+        a.set_cell(np.dot(a.cell, shear), scale_atoms=True)
+    elif cell != 'orthorhombic':
+        raise ValueError("Unknown cell '{0}'.".format(cell))
+    a.set_pbc([c == 'T' for c in pbc])
+    return a
+
+
+def number_of_pairs(quantities, r):
+    """ Number of pairs in the neighbour list, also for reductions. """
+    q, x = quantities[0], r[0]
+    if q == 'p':
+        return int(x[-1])
+    elif q in 'Nh':
+        return int(x.sum())
+    return len(x)
+
+
+def run_case(case):
+    """ Run a single benchmark case, this is called in a fresh process. """
+    a = amorphous_carbon(case['nat'], case['cell'], case['pbc'])
+    rss0 = peak_rss()
+
+    quantities = case['quantities']
+    times = []
+    for k in range(case['repeat']):
+        t0 = time.time()
+        r = neighbour_list(quantities, a, case['cutoff'],
+                           num_threads=case['num_threads'])
+        times += [time.time()-t0]
+        if len(quantities) == 1:
+            r = (r,)
+        npairs = number_of_pairs(quantities, r)
+        del r
+
+    result = dict(case)
+    result.update(nat=len(a), pairs=npairs, time=min(times),
+                  pairs_per_second=npairs/min(times),
+                  peak_memory=peak_rss()-rss0)
+    return result
+
+
+def run_in_process(case):
+    """ Run case in a fresh process, such that peak memory is not affected
+        by earlier cases. """
+    pool = multiprocessing.Pool(1)
+    try:
+        return pool.apply(run_case, (case,))
+    finally:
+        pool.close()
+        pool.join()
+
+
+def key(result):
+    return (result['nat'], result['cutoff'], result['cell'], result['pbc'],
+            result['quantities'], result['num_threads'])
+
+###
+
+parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+parser.add_argument('--sizes', type=float, nargs='+',
+                    default=[1e3, 1e4, 1e5, 1e6],
+                    help='numbers of atoms, up to 1e7')
+parser.add_argument('--cutoffs', type=float, nargs='+',
+                    default=[2.0, 3.0, 5.0])
+parser.add_argument('--cells', nargs='+', default=CELLS, choices=CELLS)
+parser.add_argument('--pbc', nargs='+', default=PBCS,
+                    help='periodicity along the three cell vectors, e.g. TTF')
+parser.add_argument('--quantities', nargs='+', default=QUANTITIES)
+parser.add_argument('--sweep-size', type=float, default=1e5,
+                    help='number of atoms for the sweeps')
+parser.add_argument('--full', action='store_true',
+                    help='run all combinations of sizes, cutoffs, cells, '
+                    'pbc and quantities')
+parser.add_argument('--repeat', type=int, default=3,
+                    help='number of timed runs per case, at least 1')
+parser.add_argument('--num-threads', type=int, default=1)
+parser.add_argument('--output', help='write results to this JSON file')
+parser.add_argument('--compare', help='compare times to this JSON file')
+parser.add_argument('--tolerance', type=float, default=0.2,
+                    help='relative slowdown that counts as regression')
+args = parser.parse_args()
+if args.repeat < 1:
+    parser.error('--repeat must be at least 1')
+
+cases = []
+if args.full:
+    for nat, cutoff, cell, pbc, quantities in itertools.product(
+        args.sizes, args.cutoffs, args.cells, args.pbc, args.quantities):
+        cases += [dict(nat=int(nat), cutoff=cutoff, cell=cell, pbc=pbc,
+                       quantities=quantities)]
+else:
+    # Scaling curve of the reference case
+    for nat in args.sizes:
+        cases += [dict(REFERENCE, nat=int(nat))]
+    # Vary one parameter at a time
+    for name, values in [('cutoff', args.cutoffs), ('cell', args.cells),
+                         ('pbc', args.pbc),
+                         ('quantities', args.quantities)]:
+        for value in values:
+            if value != REFERENCE[name]:
+                case = dict(REFERENCE, nat=int(args.sweep_size))
+                case[name] = value
+                cases += [case]
+for case in cases:
+    case.update(repeat=args.repeat, num_threads=args.num_threads)
+
+print('%10s %6s %13s %4s %10s %12s %10s %12s %10s' %
+      ('atoms', 'cutoff', 'cell', 'pbc', 'quantities', 'pairs', 'time/s',
+       'pairs/s', 'peak/MB'))
+results = []
+for case in cases:
+    result = run_in_process(case)
+    print('%10i %6.2f %13s %4s %10s %12i %10.4f %12.3e %10.1f' %
+          (result['nat'], result['cutoff'], result['cell'], result['pbc'],
+           result['quantities'], result['pairs'], result['time'],
+           result['pairs_per_second'], result['peak_memory']))
+    sys.stdout.flush()
+    results += [result]
+
+if args.output:
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=1)
+
+if args.compare:
+    with open(args.compare) as f:
+        baseline = dict((key(result), result) for result in json.load(f))
+    regressions = []
+    for result in results:
+        reference = baseline.get(key(result))
+        if reference is not None and \
+            result['time'] > (1+args.tolerance)*reference['time']:
+            regressions += [(result, reference)]
+    for result, reference in regressions:
+        print('Regression: %i atoms, cutoff %.2f, %s, pbc %s, %s: '
+              '%.4f s (baseline %.4f s)' %
+              (result['nat'], result['cutoff'], result['cell'],
+               result['pbc'], result['quantities'], result['time'],
+               reference['time']))
+    if regressions:
+        sys.exit(1)
@@ -25,8 +25,10 @@
 #define PY_ARRAY_UNIQUE_SYMBOL MATSCIPY_ARRAY_API
 #include <numpy/arrayobject.h>
 
+#include <pthread.h>
 #include <stdbool.h>
 #include <stddef.h>
+#include <string.h>
 
 #include "matscipymodule.h"
 
@@ -35,13 +37,20 @@
  */
 
 #define max(x, y)  ( x > y ? x : y )
+#define min(x, y)  ( x < y ? x : y )
+
+#ifdef __GNUC__
+#define ALWAYS_INLINE inline __attribute__((always_inline))
+#else
+#define ALWAYS_INLINE inline
+#endif
 
 /*
  * Some basic linear algebra
  */
 
 void
-cross_product(double *a, double *b, double *c)
+cross_product(const double *a, const double *b, double *c)
 {
     c[0] = a[1]*b[2]-a[2]*b[1];
     c[1] = a[2]*b[0]-a[0]*b[2];
@@ -49,7 +58,7 @@ cross_product(double *a, double *b, double *c)
 }
 
 void
-mat_mul_vec(double *mat, double *vin, double *vout)
+mat_mul_vec(const double *mat, const double *vin, double *vout)
 {
     int i, j;
     for (i = 0; i < 3; i++, vout++){
@@ -61,11 +70,17 @@ mat_mul_vec(double *mat, double *vin, double *vout)
 }
 
 double
-normsq(double *a)
+normsq(const double *a)
 {
     return sqrt(a[0]*a[0] + a[1]*a[1] + a[2]*a[2]);
 }
 
+double
+dot_product(const double *a, const double *b)
+{
+    return a[0]*b[0] + a[1]*b[1] + a[2]*b[2];
+}
+
 /*
  * Some cell index algebra
  */
@@ -78,6 +93,22 @@ bin_wrap(int i, int n)
     return i;
 }
 
+/* Number of periods that bin coordinate i is outside of 0 to n-1 */
+int
+bin_image(int i, int n)
+{
+    int m = 0;
+    while (i < 0) {
+        i += n;
+        m--;
+    }
+    while (i >= n) {
+        i -= n;
+        m++;
+    }
+    return m;
+}
+
 int
 bin_trunc(int i, int n)
 {
@@ -87,8 +118,8 @@ bin_trunc(int i, int n)
 }
 
 void
-position_to_cell_index(double *inv_cell, double *ri, int n1, int n2, int n3,
-                       int *c1, int *c2, int *c3)
+position_to_cell_index(const double *inv_cell, const double *ri, int n1,
+                       int n2, int n3, int *c1, int *c2, int *c3)
 {
     double si[3];
     mat_mul_vec(inv_cell, ri, si);
@@ -101,88 +132,451 @@ position_to_cell_index(double *inv_cell, double *ri, int n1, int n2, int n3,
  * Helper functions
  */
 
-void *
-resize_array(PyObject *py_arr, npy_intp newsize)
+bool
+check_bound(int c, int n)
 {
-    if (!py_arr) {
-        PyErr_SetString(PyExc_RuntimeError,
-                        "NULL pointer passed to resize_array.");
-        return NULL;
+    if (c < 0 || c >= n) {
+        PyErr_SetString(PyExc_RuntimeError, "Atom out of (non-periodic) "
+                        "simulation bounds.");
+        return false;
     }
+    return true;
+}
 
-    int i, ndim = PyArray_NDIM((PyArrayObject *) py_arr);
-    npy_intp dims[ndim];
-    for (i = 0; i < ndim; i++)  dims[i] = PyArray_DIM((PyArrayObject *) py_arr,
-                                                      i);
-    dims[0] = newsize;
-
-    PyArray_Dims newshape;
-    newshape.ptr = dims;
-    newshape.len = ndim;
-        
-    PyObject *retval;
-    retval = PyArray_Resize((PyArrayObject *) py_arr, &newshape, 1, NPY_CORDER);
-    if (!retval)  return NULL;
-    Py_DECREF(retval);
+/*
+ * Lattice reduction
+ */
 
-    return PyArray_DATA((PyArrayObject *) py_arr);
+/*
+ * Product of the distances of opposite faces of the cell. For a given volume
+ * this is largest for an orthogonal cell, it measures how well the cell can
+ * be subdivided into bins.
+ */
+double
+cell_face_distance_product(const double *cell)
+{
+    double norm1[3], norm2[3], norm3[3];
+    cross_product(&cell[3], &cell[6], norm1);
+    cross_product(&cell[6], &cell[0], norm2);
+    cross_product(&cell[0], &cell[3], norm3);
+    double volume = fabs(dot_product(&cell[6], norm3));
+    return volume*volume*volume/(normsq(norm1)*normsq(norm2)*normsq(norm3));
 }
 
+/*
+ * Gram-Schmidt orthogonalization of rows idx[0] to idx[n-1] of cell. Returns
+ * false if the vectors are linearly dependent.
+ */
 bool
-check_bound(int c, int n)
+gram_schmidt(const double *cell, const int *idx, int n, double *ortho,
+             double *ortho_sq)
 {
-    if (c < 0 || c >= n) {
-        PyErr_SetString(PyExc_RuntimeError, "Atom out of (non-periodic) "
-                        "simulation bounds.");
-        return false;
+    int k, l, d;
+    for (k = 0; k < n; k++) {
+        const double *b = &cell[3*idx[k]];
+        for (d = 0; d < 3; d++)  ortho[3*k+d] = b[d];
+        for (l = 0; l < k; l++) {
+            double mu = dot_product(b, &ortho[3*l])/ortho_sq[l];
+            for (d = 0; d < 3; d++)  ortho[3*k+d] -= mu*ortho[3*l+d];
+        }
+        ortho_sq[k] = dot_product(&ortho[3*k], &ortho[3*k]);
+        if (ortho_sq[k] <= 0.0)  return false;
     }
     return true;
 }
 
 /*
- * Neighbour list construction
+ * LLL reduction of the periodic cell vectors (rows of cell). Non-periodic
+ * vectors bound the domain of the bins and are left alone. On return, rows
+ * of cell_red are integer combinations of the rows of cell,
+ * cell_red = transform.cell, and transform is unimodular.
  */
+void
+lll_reduce(const double *cell, const npy_bool *pbc, double *cell_red,
+           int *transform)
+{
+    int idx[3], m = 0, k, l, d, iter;
+    double ortho[9], ortho_sq[3];
+
+    memcpy(cell_red, cell, 9*sizeof(double));
+    for (k = 0; k < 9; k++)  transform[k] = k % 4 == 0;
+    for (k = 0; k < 3; k++)  if (pbc[k])  idx[m++] = k;
+
+    k = 1;
+    for (iter = 0; k < m && iter < 1000; iter++) {
+        double *bk = &cell_red[3*idx[k]];
+        int *tk = &transform[3*idx[k]];
+
+        /* Size reduction of vector k */
+        for (l = k-1; l >= 0; l--) {
+            if (!gram_schmidt(cell_red, idx, k+1, ortho, ortho_sq))  return;
+            double q = floor(dot_product(bk, &ortho[3*l])/ortho_sq[l]+0.5);
+            if (q != 0.0) {
+                double *bl = &cell_red[3*idx[l]];
+                int *tl = &transform[3*idx[l]];
+                for (d = 0; d < 3; d++) {
+                    bk[d] -= q*bl[d];
+                    tk[d] -= (int) q*tl[d];
+                }
+            }
+        }
 
-PyObject *
-py_neighbour_list(PyObject *self, PyObject *args)
+        /* Lovasz condition, swap vectors if it is violated */
+        if (!gram_schmidt(cell_red, idx, k+1, ortho, ortho_sq))  return;
+        double mu = dot_product(bk, &ortho[3*(k-1)])/ortho_sq[k-1];
+        if (ortho_sq[k] >= (0.99-mu*mu)*ortho_sq[k-1]) {
+            k++;
+        }
+        else {
+            double *bl = &cell_red[3*idx[k-1]];
+            int *tl = &transform[3*idx[k-1]];
+            for (d = 0; d < 3; d++) {
+                double b = bk[d];
+                int t = tk[d];
+                bk[d] = bl[d];
+                tk[d] = tl[d];
+                bl[d] = b;
+                tl[d] = t;
+            }
+            k = max(k-1, 1);
+        }
+    }
+}
+
+/*
+ * Cell subdivision
+ */
+
+typedef struct {
+    npy_intp nat;              /* Number of atoms */
+    npy_double *r;             /* Positions, nat x 3 */
+    npy_bool *pbc;             /* Periodic boundary conditions */
+
+    /* Skewed cells are binned in their LLL-reduced form. Shift vectors are
+       transformed back to the original cell vectors. */
+    double cell[9];            /* (Reduced) simulation cell, row-wise */
+    double inv_cell[9];        /* Inverse of its transpose */
+    bool reduced;              /* Cell differs from the simulation cell */
+    int transform[9];          /* Reduced cell is transform.cell */
+
+    int n1, n2, n3;            /* Number of bins in each direction */
+    double len1, len2, len3;   /* Distance of opposite cell faces */
+    double bin1[3], bin2[3], bin3[3];  /* Shape of a single bin */
+
+    /* Per-atom bin information of linked lists, computed once when
+       binning. Bin coordinates are not wrapped into the cell for periodic
+       directions and truncated to the cell for non-periodic directions. */
+    int *coord;                /* Bin coordinates of each atom, nat x 3 */
+    double *offset;            /* Position relative to the lower left
+                                  corner of the bin, nat x 3 */
+
+    /* Atoms of each bin, either as linked lists (seed, next) or contiguous:
+       Atoms of bin c are in slots bin_start[c] to bin_start[c+1]-1 of
+       bin_atoms. */
+    int *seed, *next;
+    int *bin_start, *bin_atoms;
+
+    /* Positions folded into the cell in slot order, for contiguous bins.
+       A row of adjacent bins can be searched without their offsets. */
+    double *slot_position;
+} cell_list_t;
+
+void cell_list_free(cell_list_t *cl);
+
+/*
+ * Squared minimum distance between a point in the central bin and a point in
+ * the bin displaced by t. Within-bin differences are u.bin with -1 <= u <= 1.
+ * The minimum of |t + u.bin| lies in the interior of a face, an edge or at a
+ * corner of this difference body, we enumerate which components of u sit at
+ * their bounds and minimize over the remaining ones. Non-periodic atoms can
+ * lie outside of their (truncated) bin, u is unbounded in these directions.
+ */
+double
+cell_list_bin_distance_sq(const cell_list_t *cl, const double *t)
 {
-    PyObject *py_cell, *py_inv_cell, *py_pbc, *py_r, *py_quantities;
-    double cutoff;
+    const double *bin[3] = { cl->bin1, cl->bin2, cl->bin3 };
+    double dist_sq = -1.0;
+    int pattern;
+
+    for (pattern = 0; pattern < 27; pattern++) {
+        int state[3] = { pattern % 3, (pattern/3) % 3, pattern/9 };
+        int dims[3], nfree = 0, d, e, k;
+        double v[3] = { t[0], t[1], t[2] };
+        bool feasible = true;
+
+        /* Components at their bounds, 0 is free, 1 is -1 and 2 is +1 */
+        for (d = 0; d < 3; d++) {
+            if (state[d] == 0)  dims[nfree++] = d;
+            else if (!cl->pbc[d])  feasible = false;
+            else {
+                double u = state[d] == 1 ? -1.0 : 1.0;
+                for (k = 0; k < 3; k++)  v[k] += u*bin[d][k];
+            }
+        }
+        if (!feasible)  continue;
+
+        /* Minimize over free components, normal equations G.u = -B.v solved
+           by Gaussian elimination. G is positive definite. */
+        double G[3][3], u[3];
+        for (d = 0; d < nfree; d++) {
+            for (e = 0; e < nfree; e++)
+                G[d][e] = dot_product(bin[dims[d]], bin[dims[e]]);
+            u[d] = -dot_product(bin[dims[d]], v);
+        }
+        for (d = 0; d < nfree; d++) {
+            for (e = d+1; e < nfree; e++) {
+                double f = G[e][d]/G[d][d];
+                for (k = d; k < nfree; k++)  G[e][k] -= f*G[d][k];
+                u[e] -= f*u[d];
+            }
+        }
+        for (d = nfree-1; d >= 0; d--) {
+            for (k = d+1; k < nfree; k++)  u[d] -= G[d][k]*u[k];
+            u[d] /= G[d][d];
+            if (cl->pbc[dims[d]] && fabs(u[d]) > 1.0)  feasible = false;
+        }
+        if (!feasible)  continue;
 
-    if (!PyArg_ParseTuple(args, "O!OOOOd", &PyString_Type, &py_quantities,
-                          &py_cell, &py_inv_cell, &py_pbc, &py_r, &cutoff))
-        return NULL;
+        for (d = 0; d < nfree; d++)
+            for (k = 0; k < 3; k++)  v[k] += u[d]*bin[dims[d]][k];
+        double v_sq = dot_product(v, v);
+        if (dist_sq < 0.0 || v_sq < dist_sq)  dist_sq = v_sq;
+    }
 
-    /* Make sure our arrays are contiguous */
-    py_cell = PyArray_FROMANY(py_cell, NPY_DOUBLE, 2, 2,
-                              NPY_C_CONTIGUOUS);
-    if (!py_cell) return NULL;
-    py_inv_cell = PyArray_FROMANY(py_inv_cell, NPY_DOUBLE, 2, 2,
-                                  NPY_C_CONTIGUOUS);
-    if (!py_inv_cell) return NULL;
-    py_pbc = PyArray_FROMANY(py_pbc, NPY_BOOL, 1, 1, NPY_C_CONTIGUOUS);
-    if (!py_pbc) return NULL;
-    py_r = PyArray_FROMANY(py_r, NPY_DOUBLE, 2, 2, NPY_C_CONTIGUOUS);
-    if (!py_r) return NULL;
+    return dist_sq;
+}
 
-    /* FIXME! Check array shapes. */
-    npy_intp nat = PyArray_DIM((PyArrayObject *) py_r, 0);
+/*
+ * Offsets of the neighbouring bins that need to be searched for a given
+ * cutoff. This is more than the 3x3x3 adjacent bins if the cutoff is larger
+ * than the bins, e.g. for small cells. Bins that are further than the cutoff
+ * from the central bin and bins outside of non-periodic directions are
+ * pruned, for cells smaller than the cutoff this enumerates the periodic
+ * images within reach. The bins are returned as rows along the first cell
+ * vector, row n has offsets y, z along the second and third cell vector and
+ * spans offsets x0 to x1 along the first one. Returns an array of 4*nrows
+ * entries y, z, x0, x1 that the caller must free, or NULL if memory could
+ * not be allocated.
+ */
+int *
+cell_list_stencil(const cell_list_t *cl, double cutoff, int *nrows)
+{
+    int n1 = cl->n1, n2 = cl->n2, n3 = cl->n3;
+    int nx = (int) ceil(cutoff*n1/cl->len1);
+    int ny = (int) ceil(cutoff*n2/cl->len2);
+    int nz = (int) ceil(cutoff*n3/cl->len3);
+    const double *bin1 = cl->bin1, *bin2 = cl->bin2, *bin3 = cl->bin3;
+    npy_bool *pbc = cl->pbc;
+
+    /* Non-periodic directions have no bins beyond the cell */
+    if (!pbc[0] && nx > n1-1)  nx = n1-1;
+    if (!pbc[1] && ny > n2-1)  ny = n2-1;
+    if (!pbc[2] && nz > n3-1)  nz = n3-1;
+
+    /* Only bins beyond the adjacent ones can be out of reach */
+    bool prune = nx > 1 || ny > 1 || nz > 1;
+
+    /* Some slack for round-off in the bin distance */
+    double cutoff_sq = cutoff*cutoff*(1+1e-8);
+
+    /* Pruning can split a row, there are at most nx+1 pieces */
+    int *stencil = (int *) malloc(4*(nx+1)*(2*ny+1)*(2*nz+1)*sizeof(int));
+    if (!stencil)  return NULL;
+
+    int x, y, z, n = 0;
+    for (z = -nz; z <= nz; z++) {
+        for (y = -ny; y <= ny; y++) {
+            int x0 = 0;
+            bool in_row = false;
+            for (x = -nx; x <= nx+1; x++) {
+                bool inside = x <= nx;
+
+                /* Adjacent bins touch the central bin */
+                if (inside && prune &&
+                    (abs(x) > 1 || abs(y) > 1 || abs(z) > 1)) {
+                    double t[3];
+                    t[0] = z*bin3[0] + y*bin2[0] + x*bin1[0];
+                    t[1] = z*bin3[1] + y*bin2[1] + x*bin1[1];
+                    t[2] = z*bin3[2] + y*bin2[2] + x*bin1[2];
+                    inside = cell_list_bin_distance_sq(cl, t) < cutoff_sq;
+                }
 
-    /* Get pointers to array data */
-    npy_double *cell = PyArray_DATA((PyArrayObject *) py_cell);
-    npy_double *cell1 = &cell[0], *cell2 = &cell[3], *cell3 = &cell[6];
-    npy_double *inv_cell = PyArray_DATA((PyArrayObject *) py_inv_cell);
-    npy_bool *pbc = PyArray_DATA((PyArrayObject *) py_pbc);
-    npy_double *r = PyArray_DATA((PyArrayObject *) py_r);
+                if (inside && !in_row) {
+                    x0 = x;
+                    in_row = true;
+                }
+                else if (!inside && in_row) {
+                    stencil[4*n+0] = y;
+                    stencil[4*n+1] = z;
+                    stencil[4*n+2] = x0;
+                    stencil[4*n+3] = x-1;
+                    n++;
+                    in_row = false;
+                }
+            }
+        }
+    }
+
+    *nrows = n;
+    return stencil;
+}
+
+/*
+ * Compute bin coordinates and in-bin offset of position ri. Returns the
+ * continuous index of the bin the position belongs to.
+ */
+int
+cell_list_bin_position(const cell_list_t *cl, double *ri, int *coord,
+                       double *offset)
+{
+    int n1 = cl->n1, n2 = cl->n2, n3 = cl->n3;
+    const double *bin1 = cl->bin1, *bin2 = cl->bin2, *bin3 = cl->bin3;
+    npy_bool *pbc = cl->pbc;
+
+    /* Get cell index */
+    int c1, c2, c3;
+    position_to_cell_index(cl->inv_cell, ri, n1, n2, n3, &c1, &c2, &c3);
+
+    /* Truncate if non-periodic and outside of simulation domain */
+    if (!pbc[0])  c1 = bin_trunc(c1, n1);
+    if (!pbc[1])  c2 = bin_trunc(c2, n2);
+    if (!pbc[2])  c3 = bin_trunc(c3, n3);
+
+    coord[0] = c1;
+    coord[1] = c2;
+    coord[2] = c3;
+
+    /* Position relative to the lower left corner of the bin */
+    offset[0] = ri[0] - c1*bin1[0] - c2*bin2[0] - c3*bin3[0];
+    offset[1] = ri[1] - c1*bin1[1] - c2*bin2[1] - c3*bin3[1];
+    offset[2] = ri[2] - c1*bin1[2] - c2*bin2[2] - c3*bin3[2];
+
+    /* Periodic boundary conditions */
+    if (pbc[0])  c1 = bin_wrap(c1, n1);
+    if (pbc[1])  c2 = bin_wrap(c2, n2);
+    if (pbc[2])  c3 = bin_wrap(c3, n3);
+
+    assert(c1 >= 0 && c1 < n1);
+    assert(c2 >= 0 && c2 < n2);
+    assert(c3 >= 0 && c3 < n3);
+
+    /* Continuous cell index */
+    return c1+n1*(c2+n2*c3);
+}
+
+/*
+ * Compute bin coordinates and in-bin offset of atom i. Returns the
+ * continuous index of the bin the atom belongs to.
+ */
+int
+cell_list_bin_atom(cell_list_t *cl, npy_intp i)
+{
+    return cell_list_bin_position(cl, &cl->r[3*i], &cl->coord[3*i],
+                                  &cl->offset[3*i]);
+}
+
+/*
+ * Position folded into the cell, from the bin coordinates and in-bin offset
+ * computed by cell_list_bin_position.
+ */
+void
+cell_list_fold(const cell_list_t *cl, const int *coord, const double *offset,
+               double *position)
+{
+    const double *bin1 = cl->bin1, *bin2 = cl->bin2, *bin3 = cl->bin3;
+    int c1 = bin_wrap(coord[0], cl->n1);
+    int c2 = bin_wrap(coord[1], cl->n2);
+    int c3 = bin_wrap(coord[2], cl->n3);
+
+    position[0] = offset[0] + (c1*bin1[0] + c2*bin2[0] + c3*bin3[0]);
+    position[1] = offset[1] + (c1*bin1[1] + c2*bin2[1] + c3*bin3[1]);
+    position[2] = offset[2] + (c1*bin1[2] + c2*bin2[2] + c3*bin3[2]);
+}
+
+/*
+ * Bin position ri and fold it into the cell. Returns the continuous index of
+ * the bin, the result is identical to binning the same position again.
+ */
+int
+cell_list_fold_position(const cell_list_t *cl, double *ri, double *position)
+{
+    int coord[3];
+    double offset[3];
+    int c = cell_list_bin_position(cl, ri, coord, offset);
+    cell_list_fold(cl, coord, offset, position);
+    return c;
+}
+
+/*
+ * Sort atoms into bins. Bins are either linked lists (seed, next) or, if
+ * contiguous is true, stored contiguously by a counting sort. Returns false
+ * if memory could not be allocated. Does not touch the Python interpreter.
+ */
+bool
+cell_list_init(cell_list_t *cl, npy_double *cell, npy_double *inv_cell,
+               npy_bool *pbc, npy_double *r, npy_intp nat, double cutoff,
+               bool contiguous)
+{
+    cl->nat = nat;
+    cl->r = r;
+    cl->pbc = pbc;
+    cl->coord = NULL;
+    cl->offset = NULL;
+    cl->seed = NULL;
+    cl->next = NULL;
+    cl->bin_start = NULL;
+    cl->bin_atoms = NULL;
+    cl->slot_position = NULL;
+
+    /* Skewed cells leave little room for bins between opposite faces and
+       need large stencils. Bin the reduced cell instead, but only if it is
+       actually better such that the order of neighbours does not change for
+       cells that are reduced already. Orthogonal cells are reduced. */
+    double cell_red[9];
+    int *transform = cl->transform;
+    npy_intp i;
+    cl->reduced = false;
+    if (dot_product(&cell[0], &cell[3]) != 0.0 ||
+        dot_product(&cell[3], &cell[6]) != 0.0 ||
+        dot_product(&cell[6], &cell[0]) != 0.0) {
+        lll_reduce(cell, pbc, cell_red, transform);
+        cl->reduced = cell_face_distance_product(cell_red) >
+            (1+1e-6)*cell_face_distance_product(cell);
+    }
+    if (cl->reduced) {
+        /* inv(cell_red^T) = inv(transform^T).inv(cell^T), the inverse of the
+           unimodular transform is its adjugate divided by +-1 */
+        int cofactor[9], det = 0, k;
+        for (i = 0; i < 3; i++) {
+            for (k = 0; k < 3; k++) {
+                int i1 = (i+1)%3, i2 = (i+2)%3, k1 = (k+1)%3, k2 = (k+2)%3;
+                cofactor[3*i+k] = transform[3*i1+k1]*transform[3*i2+k2] -
+                    transform[3*i1+k2]*transform[3*i2+k1];
+            }
+            det += transform[i]*cofactor[i];
+        }
+        for (i = 0; i < 9; i++) {
+            int row = i/3, col = i%3;
+            cl->inv_cell[i] = (cofactor[3*row+0]*inv_cell[col] +
+                               cofactor[3*row+1]*inv_cell[3+col] +
+                               cofactor[3*row+2]*inv_cell[6+col])/det;
+        }
+        memcpy(cl->cell, cell_red, 9*sizeof(double));
+    }
+    else {
+        memcpy(cl->cell, cell, 9*sizeof(double));
+        memcpy(cl->inv_cell, inv_cell, 9*sizeof(double));
+    }
+    double *cell1 = &cl->cell[0], *cell2 = &cl->cell[3];
+    double *cell3 = &cl->cell[6];
 
     /* Compute vectors to opposite face */
     double norm1[3], norm2[3], norm3[3];
     cross_product(cell2, cell3, norm1);
     cross_product(cell3, cell1, norm2);
     cross_product(cell1, cell2, norm3);
-    double volume = cell1[0]*norm3[0] + cell2[1]*norm3[1] + cell3[2]*norm3[2];
+    double volume = fabs(dot_product(cell3, norm3));
     double len1 = normsq(norm1), len2 = normsq(norm2), len3 = normsq(norm3);
-    int i;
     for (i = 0; i < 3; i++) {
         norm1[i] *= volume/(len1*len1);
         norm2[i] *= volume/(len2*len2);
@@ -203,308 +597,1107 @@ py_neighbour_list(PyObject *self, PyObject *args)
     assert(n2 > 0);
     assert(n3 > 0);
 
-    /* Find out over how many neighbor cells we need to loop (if the box is
-       small */
-    int nx = (int) ceil(cutoff*n1/len1);
-    int ny = (int) ceil(cutoff*n2/len2);
-    int nz = (int) ceil(cutoff*n3/len3);
+    cl->n1 = n1;
+    cl->n2 = n2;
+    cl->n3 = n3;
+    cl->len1 = len1;
+    cl->len2 = len2;
+    cl->len3 = len3;
+
+    /* We need the shape of the bin */
+    for (i = 0; i < 3; i++) {
+        cl->bin1[i] = cell1[i]/n1;
+        cl->bin2[i] = cell2[i]/n2;
+        cl->bin3[i] = cell3[i]/n3;
+    }
 
-    /* Sort particles into bins */
-    int *seed = NULL, *last, *next = NULL;
+    /* Sort atoms into bins. Contiguous bins only store the folded positions
+       in slot order, linked lists the bin coordinates and offsets in atom
+       order. */
     int ncells = n1*n2*n3;
-    seed = (int *) malloc(ncells*sizeof(int));
-    last = (int *) malloc(ncells*sizeof(int));
-    for (i = 0; i < ncells; i++)  seed[i] = -1;
-    next = (int *) malloc(nat*sizeof(int));
-    for (i = 0; i < nat; i++) {
-        /* Get cell index */
-        int c1, c2, c3;
-        position_to_cell_index(inv_cell, &r[3*i], n1, n2, n3, &c1, &c2, &c3);
-
-        /* Periodic/non-periodic boundary conditions */
-        if (pbc[0])  c1 = bin_wrap(c1, n1);  else  c1 = bin_trunc(c1, n1);
-        if (pbc[1])  c2 = bin_wrap(c2, n2);  else  c2 = bin_trunc(c2, n2);
-        if (pbc[2])  c3 = bin_wrap(c3, n3);  else  c3 = bin_trunc(c3, n3);
-
-        /* Continuous cell index */
-        int ci = c1+n1*(c2+n2*c3);
-
-        assert(c1 >= 0 && c1 < n1);
-        assert(c2 >= 0 && c2 < n2);
-        assert(c3 >= 0 && c3 < n3);
-        assert(ci >= 0 && ci < ncells);
-
-        /* Put atom into appropriate bin */
-        if (seed[ci] < 0) {
-            next[i] = -1;
-            seed[ci] = i;
-            last[ci] = i;
+    if (contiguous) {
+        /* Counting sort. Atoms are binned once for counting and once for
+           sorting, which needs no per-atom bin index. The sort is stable,
+           atoms within a bin are in the same order as in the linked
+           lists. */
+        int *bin_start = (int *) calloc(ncells+1, sizeof(int));
+        int *bin_atoms = (int *) malloc(nat*sizeof(int));
+        double *slot_position = (double *) malloc(3*nat*sizeof(double));
+        cl->bin_start = bin_start;
+        cl->bin_atoms = bin_atoms;
+        cl->slot_position = slot_position;
+        if (!bin_start || !bin_atoms || !slot_position) {
+            cell_list_free(cl);
+            return false;
         }
-        else {
-            next[i] = -1;
-            next[last[ci]] = i;
-            last[ci] = i;
+        for (i = 0; i < nat; i++) {
+            double position[3];
+            int c = cell_list_fold_position(cl, &r[3*i], position);
+            assert(c >= 0 && c < ncells);
+            bin_start[c+1]++;
         }
+        for (i = 0; i < ncells; i++)  bin_start[i+1] += bin_start[i];
+        /* Use bin_start as insertion cursor, afterwards it points to the
+           end of each bin */
+        for (i = 0; i < nat; i++) {
+            double position[3];
+            int k = bin_start[cell_list_fold_position(cl, &r[3*i],
+                                                      position)]++;
+            bin_atoms[k] = i;
+            slot_position[3*k+0] = position[0];
+            slot_position[3*k+1] = position[1];
+            slot_position[3*k+2] = position[2];
+        }
+        for (i = ncells; i > 0; i--)  bin_start[i] = bin_start[i-1];
+        bin_start[0] = 0;
     }
-    free(last);
+    else {
+        int *cell_index = (int *) malloc(nat*sizeof(int));
+        cl->coord = (int *) malloc(3*nat*sizeof(int));
+        cl->offset = (double *) malloc(3*nat*sizeof(double));
+        if (!cell_index || !cl->coord || !cl->offset) {
+            if (cell_index)  free(cell_index);
+            cell_list_free(cl);
+            return false;
+        }
+        for (i = 0; i < nat; i++) {
+            cell_index[i] = cell_list_bin_atom(cl, i);
+            assert(cell_index[i] >= 0 && cell_index[i] < ncells);
+        }
 
-    /* Neighbour list counter and size */
-    npy_intp nneigh = 0; /* Number of neighbours found */
-    npy_intp neighsize = nat; /* Initial guess for neighbour list size */
+        int *seed, *last, *next;
+        seed = (int *) malloc(ncells*sizeof(int));
+        last = (int *) malloc(ncells*sizeof(int));
+        next = (int *) malloc(nat*sizeof(int));
+        cl->seed = seed;
+        cl->next = next;
+        if (!seed || !last || !next) {
+            if (last)  free(last);
+            free(cell_index);
+            cell_list_free(cl);
+            return false;
+        }
+        for (i = 0; i < ncells; i++)  seed[i] = -1;
+        for (i = 0; i < nat; i++) {
+            int ci = cell_index[i];
+
+            /* Put atom into appropriate bin */
+            if (seed[ci] < 0) {
+                next[i] = -1;
+                seed[ci] = i;
+                last[ci] = i;
+            }
+            else {
+                next[i] = -1;
+                next[last[ci]] = i;
+                last[ci] = i;
+            }
+        }
+        free(last);
+        free(cell_index);
+    }
 
-    /* Optional quantities to be computed */
-    PyObject *py_first = NULL, *py_secnd = NULL, *py_distvec = NULL;
-    PyObject *py_absdist = NULL, *py_shift = NULL;
+    return true;
+}
 
-    npy_int *first = NULL, *secnd = NULL, *shift = NULL;
-    npy_double *distvec = NULL, *absdist = NULL;
+void
+cell_list_free(cell_list_t *cl)
+{
+    /* For linked lists, slot arrays are the per-atom arrays */
+    if (cl->slot_position)  free(cl->slot_position);
+    if (cl->coord)  free(cl->coord);
+    if (cl->offset)  free(cl->offset);
+    if (cl->seed)  free(cl->seed);
+    if (cl->next)  free(cl->next);
+    if (cl->bin_start)  free(cl->bin_start);
+    if (cl->bin_atoms)  free(cl->bin_atoms);
+    cl->coord = NULL;
+    cl->offset = NULL;
+    cl->seed = NULL;
+    cl->next = NULL;
+    cl->bin_start = NULL;
+    cl->bin_atoms = NULL;
+    cl->slot_position = NULL;
+}
 
-    char *quantities = PyString_AS_STRING(py_quantities);
-    i = 0;
-    npy_intp dims[2] = { neighsize, 3 };
-    while (quantities[i] != '\0') {
-        switch (quantities[i]) {
-        case 'i':
-            py_first = PyArray_ZEROS(1, dims, NPY_INT, 0);
-            first = PyArray_DATA((PyArrayObject *) py_first);
-            break;
-        case 'j':
-            py_secnd = PyArray_ZEROS(1, dims, NPY_INT, 0);
-            secnd = PyArray_DATA((PyArrayObject *) py_secnd);
-            break;
-        case 'D':
-            py_distvec = PyArray_ZEROS(2, dims, NPY_DOUBLE, 0);
-            distvec = PyArray_DATA((PyArrayObject *) py_distvec);
-            break;
-        case 'd':
-            py_absdist = PyArray_ZEROS(1, dims, NPY_DOUBLE, 0);
-            absdist = PyArray_DATA((PyArrayObject *) py_absdist);
-            break;
-        case 'S':
-            py_shift = PyArray_ZEROS(2, dims, NPY_INT, 0);
-            shift = PyArray_DATA((PyArrayObject *) py_shift);
-            break;
-        default:
-            PyErr_SetString(PyExc_ValueError,
-                            "Unsupported quantity specified.");
-            goto fail;
+/*
+ * Re-bin atom i after its position has changed. Only linked lists can be
+ * updated, the atom is removed from its old bin and prepended to its new
+ * bin. Cost is proportional to the number of atoms in the old bin.
+ */
+void
+cell_list_move(cell_list_t *cl, npy_intp i)
+{
+    int n1 = cl->n1, n2 = cl->n2, n3 = cl->n3;
+    npy_bool *pbc = cl->pbc;
+    int *seed = cl->seed, *next = cl->next;
+
+    assert(seed && next);
+
+    /* Old bin */
+    int c1 = cl->coord[3*i+0], c2 = cl->coord[3*i+1], c3 = cl->coord[3*i+2];
+    if (pbc[0])  c1 = bin_wrap(c1, n1);
+    if (pbc[1])  c2 = bin_wrap(c2, n2);
+    if (pbc[2])  c3 = bin_wrap(c3, n3);
+    int ci = c1+n1*(c2+n2*c3);
+
+    /* Remove from old bin */
+    if (seed[ci] == i) {
+        seed[ci] = next[i];
+    }
+    else {
+        int k = seed[ci];
+        while (next[k] != i)  k = next[k];
+        next[k] = next[i];
+    }
+
+    /* Add to new bin */
+    ci = cell_list_bin_atom(cl, i);
+    next[i] = seed[ci];
+    seed[ci] = i;
+}
+
+/*
+ * Thread helpers
+ */
+
+typedef struct {
+    void *(*worker)(void *);
+    char *items;
+    size_t itemsize;
+    int nitems, nthreads, t;
+} thread_items_t;
+
+/*
+ * Process the work items assigned to a single thread.
+ */
+void *
+thread_items_worker(void *arg)
+{
+    thread_items_t *w = (thread_items_t *) arg;
+    int k;
+    for (k = w->t; k < w->nitems; k += w->nthreads)
+        w->worker(w->items + k*w->itemsize);
+    return NULL;
+}
+
+/*
+ * Call worker for each of the nitems work items on up to nthreads threads.
+ * Thread t processes items t, t+nthreads, ..., the calling thread acts as
+ * thread 0. Items of threads that cannot be started are processed serially.
+ * Does not touch the Python interpreter.
+ */
+void
+run_parallel(void *(*worker)(void *), void *items, size_t itemsize,
+             int nitems, int nthreads)
+{
+    nthreads = max(min(nthreads, nitems), 1);
+    thread_items_t *w = (thread_items_t *) malloc(nthreads*
+                                                  sizeof(thread_items_t));
+    pthread_t *threads = (pthread_t *) malloc(nthreads*sizeof(pthread_t));
+    bool *started = (bool *) calloc(nthreads, sizeof(bool));
+    int t;
+
+    if (!w || !threads || !started) {
+        for (t = 0; t < nitems; t++)
+            worker((char *) items + t*itemsize);
+    }
+    else {
+        for (t = 0; t < nthreads; t++) {
+            w[t].worker = worker;
+            w[t].items = (char *) items;
+            w[t].itemsize = itemsize;
+            w[t].nitems = nitems;
+            w[t].nthreads = nthreads;
+            w[t].t = t;
+        }
+        for (t = 1; t < nthreads; t++)
+            started[t] = !pthread_create(&threads[t], NULL,
+                                         thread_items_worker, &w[t]);
+        thread_items_worker(&w[0]);
+        for (t = 1; t < nthreads; t++) {
+            if (started[t])  pthread_join(threads[t], NULL);
+            else  thread_items_worker(&w[t]);
         }
-        i++;
     }
 
-    /* We need the square of the cutoff */
-    double cutoff_sq = cutoff*cutoff;
+    if (w)  free(w);
+    if (threads)  free(threads);
+    if (started)  free(started);
+}
 
-    /* We need the shape of the bin */
-    double bin1[3], bin2[3], bin3[3];
-    for (i = 0; i < 3; i++) {
-        bin1[i] = cell1[i]/n1;
-        bin2[i] = cell2[i]/n2;
-        bin3[i] = cell3[i]/n3;
-    }  
+/*
+ * Pair search
+ */
 
-    /* Loop over atoms */
-    for (i = 0; i < nat; i++) {
-        double *ri = &r[3*i];
+/*
+ * Parameters of the pair search, shared by all blocks of a frame. Atoms are
+ * binned with the maximum cutoff. If radii or types are given, each pair is
+ * additionally tested against its own cutoff.
+ */
+typedef struct {
+    const cell_list_t *cl;
+    npy_intp *central;         /* Central atoms, all atoms if NULL */
+    npy_double *points;        /* Query points instead of central atoms */
+    double cutoff_sq;          /* Square of the maximum cutoff */
+    int nstencil;              /* Number of rows of neighbouring bins */
+    int *stencil;              /* Rows y, z, x0, x1, nstencil x 4 */
+    bool half;                 /* Store each pair only once */
+    npy_double *radii;         /* Per-atom radii, pair cutoff is ri+rj */
+    npy_int *types;            /* Per-atom type */
+    int ntypes;                /* Number of types */
+    double *pair_cutoff_sq;    /* Squared cutoff for each pair of types */
+} search_params_t;
+
+/*
+ * A single frame of a trajectory, with its own cell list.
+ */
+typedef struct {
+    npy_double *cell, *inv_cell, *r;
+    npy_bool *pbc;
+    npy_intp nat;
+    double cutoff;
+    bool contiguous;
+    cell_list_t cl;
+    search_params_t params;
+    bool binned;
+} frame_t;
+
+/*
+ * Sort the atoms of a frame into bins. This is the thread worker for
+ * binning, it does not touch the Python interpreter.
+ */
+void *
+frame_bin(void *arg)
+{
+    frame_t *f = (frame_t *) arg;
+    f->binned = cell_list_init(&f->cl, f->cell, f->inv_cell, f->pbc, f->r,
+                               f->nat, f->cutoff, f->contiguous);
+    return NULL;
+}
+
+/* Bit flags for the quantities that are stored for each pair */
+#define STORE_FIRST    1
+#define STORE_SECND    2
+#define STORE_DISTVEC  4
+#define STORE_ABSDIST  8
+#define STORE_SHIFT   16
+#define STORE_FRAME   32
+
+/*
+ * A contiguous block of central atoms, processed by a single thread. The
+ * search runs twice: The first pass only counts the pairs of each block. The
+ * output arrays are then allocated once at their final size, and the second
+ * pass stores the pairs of each block directly in its slice of the outputs.
+ */
+typedef struct {
+    /* Input */
+    const search_params_t *p;
+    npy_int frame;             /* Frame of the trajectory */
+    npy_intp i0, i1;           /* Range of central atoms */
+    npy_intp seed_offset;      /* Position of the block in seed and count */
+    int nbins;                 /* Number of bins of the distance histogram */
+    int store;                 /* Which quantities to store, 0 to count */
+    bool index64;              /* Indices are npy_int64, else npy_int32 */
+    bool single;               /* Distances are npy_float, else npy_double */
+
+    /* Reductions */
+    npy_int *count;            /* Number of neighbours of each central atom,
+                                  indexed like seed */
+    npy_intp *hist;            /* Distance histogram of this block */
+    npy_intp *seed;            /* Index of the first neighbour of each
+                                  central atom, indexed by atom, not by
+                                  pair. Relative to the block until all
+                                  blocks are done. */
+
+    /* Output, the slices of the output arrays that belong to this block */
+    npy_intp nneigh;           /* Number of neighbours found */
+    void *first, *secnd, *shift, *frame_index;
+    void *distvec, *absdist;
+} neighbour_block_t;
+
+/*
+ * Store an index or a distance in an output array of either precision.
+ */
+static ALWAYS_INLINE void
+store_index(void *a, npy_intp k, npy_int64 value, bool index64)
+{
+    if (index64)  ((npy_int64 *) a)[k] = value;
+    else  ((npy_int32 *) a)[k] = (npy_int32) value;
+}
+
+static ALWAYS_INLINE void
+store_real(void *a, npy_intp k, double value, bool single)
+{
+    if (single)  ((npy_float *) a)[k] = (npy_float) value;
+    else  ((npy_double *) a)[k] = value;
+}
+
+/*
+ * Find all neighbours of central atoms b->i0 to b->i1-1, or of query points
+ * b->i0 to b->i1-1 if query is true. If count_only is true, the neighbours
+ * are only counted. Indices are stored as npy_int64 if index64 is true and
+ * as npy_int32 otherwise, distances as npy_float if single is true and as
+ * npy_double otherwise. This is inlined into one thread worker for each
+ * combination, such that neither is dispatched for every atom or pair.
+ */
+static ALWAYS_INLINE void
+neighbour_block_search(neighbour_block_t *b, bool count_only, bool query,
+                       bool index64, bool single)
+{
+    const search_params_t *p = b->p;
+    const cell_list_t *cl = p->cl;
+
+    npy_bool *pbc = cl->pbc;
+    int n1 = cl->n1, n2 = cl->n2, n3 = cl->n3;
+    int nstencil = p->nstencil, *stencil = p->stencil;
+    const int *transform = cl->reduced ? cl->transform : NULL;
+    const double *bin1 = cl->bin1, *bin2 = cl->bin2, *bin3 = cl->bin3;
+    const double *cell1 = &cl->cell[0], *cell2 = &cl->cell[3];
+    const double *cell3 = &cl->cell[6];
+    const double *inv_cell = cl->inv_cell;
+    npy_double *r = cl->r;
+    npy_intp *central = p->central;
+    npy_double *points = p->points;
+    int *seed = cl->seed, *next = cl->next;
+    int *bin_start = cl->bin_start, *bin_atoms = cl->bin_atoms;
+    int *coord = cl->coord;
+    double *slot_position = cl->slot_position, *offset = cl->offset;
+    double cutoff_sq = p->cutoff_sq;
+    bool half = p->half;
+    npy_double *radii = p->radii;
+    npy_int *types = p->types;
+    int ntypes = p->ntypes;
+    double *pair_cutoff_sq = p->pair_cutoff_sq;
+
+    int store = count_only ? 0 : b->store;
+    void *first = count_only ? NULL : b->first;
+    void *secnd = count_only ? NULL : b->secnd;
+    void *shift = count_only ? NULL : b->shift;
+    void *frame_index = count_only ? NULL : b->frame_index;
+    void *distvec = count_only ? NULL : b->distvec;
+    void *absdist = count_only ? NULL : b->absdist;
+    npy_intp *seed_out = count_only ? NULL : b->seed;
+    npy_intp nneigh = 0;
+
+    npy_int *count = count_only ? NULL : b->count;
+    npy_intp *hist = count_only ? NULL : b->hist;
+    int nbins = b->nbins;
+    double hist_scale = hist ? nbins/sqrt(cutoff_sq) : 0.0;
+
+    /* Plain counts of contiguous bins need no per-pair tests other than the
+       distance. The central atom counts itself, this is corrected below. */
+    bool count_all = count_only && bin_start && !half && !radii && !types;
 
+    /* Loop over atoms */
+    npy_intp n;
+    for (n = b->i0; n < b->i1; n++) {
+        npy_intp i = central ? central[n] : n;
+
+        if (seed_out)  seed_out[n] = nneigh;
+        npy_intp nneigh_i = nneigh;
+
+        /* Bin of the central atom and its position folded into the cell.
+           Contiguous bins and query points are binned again, this gives
+           exactly the folded position of the slot. Query points do not
+           match any atom. */
+        double *r_i = query ? &points[3*n] : &r[3*i];
+        double ri[3];
         int ci1, ci2, ci3;
-        position_to_cell_index(inv_cell, ri, n1, n2, n3, &ci1, &ci2, &ci3);
-
-        /* Truncate if non-periodic and outside of simulation domain */
-        if (!pbc[0])  ci1 = bin_trunc(ci1, n1);
-        if (!pbc[1])  ci2 = bin_trunc(ci2, n2);
-        if (!pbc[2])  ci3 = bin_trunc(ci3, n3);
-
-        /* dri is the position relative to the lower left corner of the bin */
-        double dri[3];
-        dri[0] = ri[0] - ci1*bin1[0] - ci2*bin2[0] - ci3*bin3[0];
-        dri[1] = ri[1] - ci1*bin1[1] - ci2*bin2[1] - ci3*bin3[1];
-        dri[2] = ri[2] - ci1*bin1[2] - ci2*bin2[2] - ci3*bin3[2];
-
-        /* Apply periodic boundary conditions */
-        if (pbc[0])  ci1 = bin_wrap(ci1, n1);  else  ci1 = bin_trunc(ci1, n1);
-        if (pbc[1])  ci2 = bin_wrap(ci2, n2);  else  ci2 = bin_trunc(ci2, n2);
-        if (pbc[2])  ci3 = bin_wrap(ci3, n3);  else  ci3 = bin_trunc(ci3, n3);
-
-        /* Loop over neighbouring bins */
-        int x, y, z;
-        for (z = -nz; z <= nz; z++) {
-            int cj3 = ci3 + z;
-            if (pbc[2])  cj3 = bin_wrap(cj3, n3);
-
-            /* Skip to next z value if cell is out of simulation bounds */
-            if (cj3 < 0 || cj3 >= n3)  continue;
-
-            cj3 = bin_trunc(cj3, n3);
-            int ncj3 = n2*cj3;
-
-            double off3[3];
-            off3[0] = z*bin3[0];
-            off3[1] = z*bin3[1];
-            off3[2] = z*bin3[2];
-            
-            for (y = -ny; y <= ny; y++) {
-                int cj2 = ci2 + y;
-                if (pbc[1])  cj2 = bin_wrap(cj2, n2);
-
-                /* Skip to next y value if cell is out of simulation bounds */
-                if (cj2 < 0 || cj2 >= n2)  continue;
-
-                cj2 = bin_trunc(cj2, n2);
-                int ncj2 = n1*(cj2 + ncj3);
-                
-                double off2[3];
-                off2[0] = off3[0] + y*bin2[0];
-                off2[1] = off3[1] + y*bin2[1];
-                off2[2] = off3[2] + y*bin2[2];
-
-                for (x = -nx; x <= nx; x++) {
-                    /* Bin index of neighbouring bin */
-                    int cj1 = ci1 + x;
-                    if (pbc[0])  cj1 = bin_wrap(cj1, n1);
-
-                    /* Skip to next x value if cell is out of simulation bounds
-                     */                    
-                    if (cj1 < 0 || cj1 >= n1)  continue;
-
-                    cj1 = bin_trunc(cj1, n1);
-                    int ncj = cj1 + ncj2;
-
-                    assert(ncj == cj1+n1*(cj2+n2*cj3));
-
-                    /* Offset of the neighboring bins */
-                    double off[3];
-                    off[0] = off2[0] + x*bin1[0];
-                    off[1] = off2[1] + x*bin1[1];
-                    off[2] = off2[2] + x*bin1[2];
-
-                    /* Loop over all atoms in neighbouring bin */
-                    int j = seed[ncj];
-                    while (j >= 0) {
-                        if (i != j || x != 0 || y != 0 || z != 0) {
-                            double *rj = &r[3*j];
-
-                            int cj1, cj2, cj3;
-                            position_to_cell_index(inv_cell, rj, n1, n2, n3,
-                                                   &cj1, &cj2, &cj3);
-
-                            /* Truncate if non-periodic and outside of
-                               simulation domain. */
-                            if (!pbc[0])  cj1 = bin_trunc(cj1, n1);
-                            if (!pbc[1])  cj2 = bin_trunc(cj2, n2);
-                            if (!pbc[2])  cj3 = bin_trunc(cj3, n3);
-
-                            /* drj is position relative to lower
-                               left corner of the bin */
-                            double drj[3];
-                            drj[0] = rj[0] - cj1*bin1[0] - cj2*bin2[0] -
-                                cj3*bin3[0];
-                            drj[1] = rj[1] - cj1*bin1[1] - cj2*bin2[1] -
-                                cj3*bin3[1];
-                            drj[2] = rj[2] - cj1*bin1[2] - cj2*bin2[2] -
-                                cj3*bin3[2];
+        if (!query && coord) {
+            int *si = &coord[3*i];
+            cell_list_fold(cl, si, &offset[3*i], ri);
+            ci1 = bin_wrap(si[0], n1);
+            ci2 = bin_wrap(si[1], n2);
+            ci3 = bin_wrap(si[2], n3);
+        }
+        else {
+            int c = cell_list_fold_position(cl, r_i, ri);
+            ci1 = c % n1;
+            ci2 = (c/n1) % n2;
+            ci3 = c/(n1*n2);
+        }
+        if (query)  i = -1;
+
+        /* Loop over rows of neighbouring bins */
+        int t;
+        for (t = 0; t < nstencil; t++) {
+            int y = stencil[4*t+0], z = stencil[4*t+1];
+
+            /* Bin coordinates of the row, skip rows that are out of
+               simulation bounds */
+            int cj2 = ci2 + y, cj3 = ci3 + z;
+            int m2 = bin_image(cj2, n2), m3 = bin_image(cj3, n3);
+            if ((m2 && !pbc[1]) || (m3 && !pbc[2]))  continue;
+            cj2 -= m2*n2;
+            cj3 -= m3*n3;
+            int row = n1*(cj2 + n2*cj3);
+
+            /* Split the row into pieces that are wrapped by the same
+               number of periods m1 */
+            int cj1 = ci1 + stencil[4*t+2], cend = ci1 + stencil[4*t+3];
+            if (!pbc[0]) {
+                cj1 = max(cj1, 0);
+                cend = min(cend, n1-1);
+            }
+            while (cj1 <= cend) {
+                int m1 = bin_image(cj1, n1);
+                int c0 = cj1 - m1*n1, c1 = min(cend - m1*n1, n1-1);
+                bool image = m1 != 0 || m2 != 0 || m3 != 0;
+                cj1 += c1 - c0 + 1;
+
+                /* The distance vector to atom j is its folded position
+                   plus delta */
+                double delta[3];
+                delta[0] = m1*cell1[0] + m2*cell2[0] + m3*cell3[0] - ri[0];
+                delta[1] = m1*cell1[1] + m2*cell2[1] + m3*cell3[1] - ri[1];
+                delta[2] = m1*cell1[2] + m2*cell2[2] + m3*cell3[2] - ri[2];
+
+                /* Contiguous bins c0 to c1 are a single range of slots.
+                   Linked lists are walked bin by bin, their atoms store
+                   offsets relative to the corner of the bin. Positions
+                   are folded as in cell_list_fold, such that both give
+                   identical distances. */
+                int c = c0, k = 0, kend = 0;
+                double corner[3] = { 0.0, 0.0, 0.0 };
+                if (bin_start) {
+                    k = bin_start[row+c0];
+                    kend = bin_start[row+c1+1];
+                    c = c1;
+                }
+                for (; c <= c1; c++) {
+                    if (!bin_start) {
+                        k = seed[row+c];
+                        corner[0] = c*bin1[0] + cj2*bin2[0] + cj3*bin3[0];
+                        corner[1] = c*bin1[1] + cj2*bin2[1] + cj3*bin3[1];
+                        corner[2] = c*bin1[2] + cj2*bin2[2] + cj3*bin3[2];
+                    }
+                    const double *rj = bin_start ? slot_position : offset;
+
+                    if (count_all) {
+                        for (; k < kend; k++) {
+                            double dx = rj[3*k+0] + delta[0];
+                            double dy = rj[3*k+1] + delta[1];
+                            double dz = rj[3*k+2] + delta[2];
+                            nneigh += dx*dx + dy*dy + dz*dz < cutoff_sq;
+                        }
+                        continue;
+                    }
 
+                    while (bin_start ? k < kend : k >= 0) {
+                        int j = bin_start ? bin_atoms[k] : k;
+
+                        /* For a half list, skip pairs with j < i. This
+                           leaves only periodic images of the same atom. */
+                        if ((!half || j >= i) && (i != j || image)) {
                             /* Compute distance between atoms */
                             double dr[3];
-                            dr[0] = drj[0] - dri[0] + off[0];
-                            dr[1] = drj[1] - dri[1] + off[1];
-                            dr[2] = drj[2] - dri[2] + off[2];
+                            dr[0] = (rj[3*k+0] + corner[0]) + delta[0];
+                            dr[1] = (rj[3*k+1] + corner[1]) + delta[1];
+                            dr[2] = (rj[3*k+2] + corner[2]) + delta[2];
                             double abs_dr_sq = dr[0]*dr[0] + dr[1]*dr[1] +
                                 dr[2]*dr[2];
 
-                            if (abs_dr_sq < cutoff_sq) {
-
-                                if (nneigh >= neighsize) {
-                                    neighsize *= 2;
-
-                                    if (py_first &&
-                                        !(first = resize_array(py_first,
-                                                               neighsize)))
-                                        goto fail;
-                                    if (py_secnd &&
-                                        !(secnd = resize_array(py_secnd,
-                                                               neighsize)))
-                                        goto fail;
-                                    if (py_distvec &&
-                                        !(distvec = resize_array(py_distvec,
-                                                                 neighsize)))
-                                        goto fail;
-                                    if (py_absdist &&
-                                        !(absdist = resize_array(py_absdist,
-                                                                 neighsize)))
-                                        goto fail;
-                                    if (py_shift &&
-                                        !(shift = resize_array(py_shift,
-                                                               neighsize)))
-                                        goto fail;
+                            /* Per-pair cutoffs */
+                            bool keep = abs_dr_sq < cutoff_sq;
+                            if (keep && radii) {
+                                double rc = radii[i] + radii[j];
+                                keep = abs_dr_sq < rc*rc;
+                            }
+                            if (keep && types) {
+                                keep = abs_dr_sq <
+                                    pair_cutoff_sq[types[i]*ntypes+types[j]];
+                            }
+
+                            /* Shift vector in units of the (reduced) cell
+                               vectors, from the distance vector and the
+                               positions, transformed back to the
+                               simulation cell */
+                            int s[3] = { 0, 0, 0 };
+                            if (keep &&
+                                ((store & STORE_SHIFT) || (half && i == j))) {
+                                double u[3];
+                                u[0] = dr[0] - r[3*j+0] + r_i[0];
+                                u[1] = dr[1] - r[3*j+1] + r_i[1];
+                                u[2] = dr[2] - r[3*j+2] + r_i[2];
+                                int d;
+                                for (d = 0; d < 3; d++) {
+                                    if (pbc[d])
+                                        s[d] = (int) nearbyint(
+                                            inv_cell[3*d+0]*u[0] +
+                                            inv_cell[3*d+1]*u[1] +
+                                            inv_cell[3*d+2]*u[2]);
+                                }
+                                if (transform) {
+                                    int s1 = s[0], s2 = s[1], s3 = s[2];
+                                    s[0] = s1*transform[0] + s2*transform[3] +
+                                        s3*transform[6];
+                                    s[1] = s1*transform[1] + s2*transform[4] +
+                                        s3*transform[7];
+                                    s[2] = s1*transform[2] + s2*transform[5] +
+                                        s3*transform[8];
+                                }
+                            }
+
+                            /* For a half list, keep only the periodic image
+                               of atom i with a positive shift, i.e. whose
+                               first nonzero component is > 0. */
+                            if (keep && half && i == j) {
+                                keep = s[0] > 0 ||
+                                    (s[0] == 0 && (s[1] > 0 ||
+                                                   (s[1] == 0 && s[2] > 0)));
+                            }
+
+                            if (keep) {
+                                if (hist) {
+                                    int bin = (int) (sqrt(abs_dr_sq)*
+                                                     hist_scale);
+                                    hist[min(bin, nbins-1)]++;
                                 }
-                                            
-                                if (py_first)
-                                    first[nneigh] = i;
-                                if (py_secnd)
-                                    secnd[nneigh] = j;
-                                if (py_distvec) {
-                                    distvec[3*nneigh+0] = dr[0];
-                                    distvec[3*nneigh+1] = dr[1];
-                                    distvec[3*nneigh+2] = dr[2];
+
+                                if (first)
+                                    store_index(first, nneigh,
+                                                query ? n : i, index64);
+                                if (secnd)
+                                    store_index(secnd, nneigh, j, index64);
+                                if (distvec) {
+                                    store_real(distvec, 3*nneigh+0, dr[0],
+                                               single);
+                                    store_real(distvec, 3*nneigh+1, dr[1],
+                                               single);
+                                    store_real(distvec, 3*nneigh+2, dr[2],
+                                               single);
                                 }
-                                if (py_absdist) 
-                                    absdist[nneigh] = sqrt(abs_dr_sq);
-                                if (py_shift) {
-                                    shift[3*nneigh+0] = (ci1 - cj1 + x)/n1;
-                                    shift[3*nneigh+1] = (ci2 - cj2 + y)/n2;
-                                    shift[3*nneigh+2] = (ci3 - cj3 + z)/n3;
+                                if (absdist)
+                                    store_real(absdist, nneigh,
+                                               sqrt(abs_dr_sq), single);
+                                if (shift) {
+                                    store_index(shift, 3*nneigh+0, s[0],
+                                                index64);
+                                    store_index(shift, 3*nneigh+1, s[1],
+                                                index64);
+                                    store_index(shift, 3*nneigh+2, s[2],
+                                                index64);
                                 }
-                                
+                                if (frame_index)
+                                    store_index(frame_index, nneigh,
+                                                b->frame, index64);
+
                                 nneigh++;
                             }
                         }
-                        
-                        j = next[j];
+
+                        k = bin_start ? k+1 : next[k];
                     }
                 }
             }
         }
+
+        if (count_all && !query)  nneigh--;
+        if (count)  count[n] = nneigh - nneigh_i;
     }
-    
-    /* Release cell subdivision information */
-    free(seed);
-    free(next);
-    seed = NULL;
-    next = NULL;
 
-    /* Resize arrays to actual size of neighbour list */
-    if (py_first && !resize_array(py_first, nneigh))  goto fail;
-    if (py_secnd && !resize_array(py_secnd, nneigh))  goto fail;
-    if (py_distvec && !resize_array(py_distvec, nneigh))  goto fail;
-    if (py_absdist && !resize_array(py_absdist, nneigh))  goto fail;
-    if (py_shift && !resize_array(py_shift, nneigh))  goto fail;
+    b->nneigh = nneigh;
+}
 
-    /* Build return tuple */
-    PyObject *py_ret = PyTuple_New(strlen(quantities));
-    i = 0;
-    while (quantities[i] != '\0') {
-        switch (quantities[i]) {
-        case 'i':
-            PyTuple_SetItem(py_ret, i, py_first);
-            break;
-        case 'j':
-            PyTuple_SetItem(py_ret, i, py_secnd);
-            break;
-        case 'D':
-            PyTuple_SetItem(py_ret, i, py_distvec);
-            break;
-        case 'd':
-            PyTuple_SetItem(py_ret, i, py_absdist);
+/*
+ * Thread workers for atoms and query points and each combination of index
+ * and distance types, and for counting only. They do not touch the Python
+ * interpreter.
+ */
+#define NEIGHBOUR_BLOCK_SEARCH_WORKER(name, count_only, query, index64,  \
+                                      single)                            \
+    void *                                                               \
+    name(void *arg)                                                      \
+    {                                                                    \
+        neighbour_block_search((neighbour_block_t *) arg, count_only,    \
+                               query, index64, single);                  \
+        return NULL;                                                     \
+    }
+
+NEIGHBOUR_BLOCK_SEARCH_WORKER(atom_count, true, false, false, false)
+NEIGHBOUR_BLOCK_SEARCH_WORKER(point_count, true, true, false, false)
+NEIGHBOUR_BLOCK_SEARCH_WORKER(atom_search_int32_double, false, false, false,
+                              false)
+NEIGHBOUR_BLOCK_SEARCH_WORKER(atom_search_int32_float, false, false, false,
+                              true)
+NEIGHBOUR_BLOCK_SEARCH_WORKER(atom_search_int64_double, false, false, true,
+                              false)
+NEIGHBOUR_BLOCK_SEARCH_WORKER(atom_search_int64_float, false, false, true,
+                              true)
+NEIGHBOUR_BLOCK_SEARCH_WORKER(point_search_int32_double, false, true, false,
+                              false)
+NEIGHBOUR_BLOCK_SEARCH_WORKER(point_search_int32_float, false, true, false,
+                              true)
+NEIGHBOUR_BLOCK_SEARCH_WORKER(point_search_int64_double, false, true, true,
+                              false)
+NEIGHBOUR_BLOCK_SEARCH_WORKER(point_search_int64_float, false, true, true,
+                              true)
+
+/* Indexed by query */
+void *(*neighbour_block_count_workers[2])(void *) = {
+    atom_count, point_count
+};
+
+/* Indexed by 4*query + 2*index64 + single */
+void *(*neighbour_block_search_workers[8])(void *) = {
+    atom_search_int32_double, atom_search_int32_float,
+    atom_search_int64_double, atom_search_int64_float,
+    point_search_int32_double, point_search_int32_float,
+    point_search_int64_double, point_search_int64_float
+};
+
+/*
+ * Output buffers
+ */
+
+/*
+ * Return an output array with dims[0] rows. If py_out is a dict that holds a
+ * suitable buffer for quantity q with at least dims[0] rows, the array is a
+ * view of the first rows of this buffer. Otherwise a new buffer with some
+ * headroom is allocated, stored in py_out and a view of it returned. Repeated
+ * calls with similar sizes hence do not allocate.
+ */
+PyObject *
+output_array(PyObject *py_out, char q, int nd, npy_intp *dims, int typenum)
+{
+    if (!py_out)  return PyArray_EMPTY(nd, dims, typenum, 0);
+
+    PyObject *py_key = PyString_FromStringAndSize(&q, 1);
+    if (!py_key)  return NULL;
+
+    /* Borrowed reference */
+    PyObject *py_buffer = PyDict_GetItem(py_out, py_key);
+    bool suitable = py_buffer && PyArray_Check(py_buffer);
+    if (suitable) {
+        PyArrayObject *buffer = (PyArrayObject *) py_buffer;
+        suitable = PyArray_EquivTypenums(PyArray_TYPE(buffer), typenum) &&
+            PyArray_NDIM(buffer) == nd &&
+            PyArray_ISCARRAY(buffer) &&
+            PyArray_DIM(buffer, 0) >= dims[0];
+        int k;
+        for (k = 1; k < nd && suitable; k++)
+            suitable = PyArray_DIM(buffer, k) == dims[k];
+    }
+
+    if (!suitable) {
+        /* Grow by 25% so that slightly larger lists fit next time */
+        npy_intp buffer_dims[NPY_MAXDIMS];
+        int k;
+        buffer_dims[0] = dims[0] + dims[0]/4;
+        for (k = 1; k < nd; k++)  buffer_dims[k] = dims[k];
+        py_buffer = PyArray_EMPTY(nd, buffer_dims, typenum, 0);
+        if (!py_buffer || PyDict_SetItem(py_out, py_key, py_buffer) < 0) {
+            Py_XDECREF(py_buffer);
+            Py_DECREF(py_key);
+            return NULL;
+        }
+        /* The dictionary holds a reference */
+        Py_DECREF(py_buffer);
+    }
+    Py_DECREF(py_key);
+
+    return PySequence_GetSlice(py_buffer, 0, dims[0]);
+}
+
+/*
+ * Neighbour search
+ */
+
+/*
+ * Check the quantities string before doing any work.
+ */
+bool
+check_quantities(const char *quantities)
+{
+    int i = 0;
+    while (quantities[i] != '\0') {
+        if (!strchr("ijDdSpfNh", quantities[i])) {
+            PyErr_SetString(PyExc_ValueError,
+                            "Unsupported quantity specified.");
+            return false;
+        }
+        i++;
+    }
+    return true;
+}
+
+/*
+ * Convert the optional dtype arguments for distances and indices to
+ * NPY_FLOAT or NPY_DOUBLE and to NPY_INT32 or NPY_INT64. Defaults are
+ * NPY_DOUBLE and NPY_INT.
+ */
+bool
+output_types(PyObject *py_float_type, PyObject *py_int_type, int *float_type,
+             int *int_type)
+{
+    PyArray_Descr *descr = NULL;
+
+    *float_type = NPY_DOUBLE;
+    *int_type = NPY_INT;
+
+    if (!PyArray_DescrConverter2(py_float_type, &descr))  return false;
+    if (descr) {
+        bool ok = descr->kind == 'f' && (descr->elsize == 4 ||
+                                         descr->elsize == 8);
+        if (ok)  *float_type = descr->elsize == 4 ? NPY_FLOAT : NPY_DOUBLE;
+        Py_DECREF(descr);
+        if (!ok) {
+            PyErr_SetString(PyExc_TypeError, "Distances can only be "
+                            "float32 or float64.");
+            return false;
+        }
+    }
+
+    descr = NULL;
+    if (!PyArray_DescrConverter2(py_int_type, &descr))  return false;
+    if (descr) {
+        bool ok = descr->kind == 'i' && (descr->elsize == 4 ||
+                                         descr->elsize == 8);
+        if (ok)  *int_type = descr->elsize == 4 ? NPY_INT32 : NPY_INT64;
+        Py_DECREF(descr);
+        if (!ok) {
+            PyErr_SetString(PyExc_TypeError, "Indices can only be int32 or "
+                            "int64.");
+            return false;
+        }
+    }
+
+    return true;
+}
+
+/*
+ * Initialize the search parameters and convert the optional per-pair cutoff
+ * arguments. On entry, *py_radii, *py_types and *py_pair_cutoffs are
+ * borrowed references to the arguments (or NULL or None). On return, they
+ * are new references to the converted arrays (or NULL) that the caller must
+ * release, together with params->pair_cutoff_sq.
+ */
+bool
+search_params_init(search_params_t *params, double cutoff, bool half,
+                   npy_intp nat, PyObject **py_radii, PyObject **py_types,
+                   PyObject **py_pair_cutoffs)
+{
+    PyObject *py_radii_arg = *py_radii, *py_types_arg = *py_types;
+    PyObject *py_pair_cutoffs_arg = *py_pair_cutoffs;
+
+    *py_radii = NULL;
+    *py_types = NULL;
+    *py_pair_cutoffs = NULL;
+
+    params->cl = NULL;
+    params->central = NULL;
+    params->points = NULL;
+    params->cutoff_sq = cutoff*cutoff;
+    params->nstencil = 0;
+    params->stencil = NULL;
+    params->half = half;
+    params->radii = NULL;
+    params->types = NULL;
+    params->ntypes = 0;
+    params->pair_cutoff_sq = NULL;
+
+    if (py_radii_arg == Py_None)  py_radii_arg = NULL;
+    if (py_types_arg == Py_None)  py_types_arg = NULL;
+    if (py_pair_cutoffs_arg == Py_None)  py_pair_cutoffs_arg = NULL;
+    if (!py_types_arg != !py_pair_cutoffs_arg) {
+        PyErr_SetString(PyExc_ValueError, "Please specify both types and "
+                        "pair_cutoffs.");
+        return false;
+    }
+
+    if (py_radii_arg) {
+        *py_radii = PyArray_FROMANY(py_radii_arg, NPY_DOUBLE, 1, 1,
+                                    NPY_C_CONTIGUOUS);
+        if (!*py_radii)  return false;
+        if (PyArray_DIM((PyArrayObject *) *py_radii, 0) != nat) {
+            PyErr_SetString(PyExc_ValueError, "radii must have one entry per "
+                            "atom.");
+            return false;
+        }
+        params->radii = PyArray_DATA((PyArrayObject *) *py_radii);
+    }
+    if (py_types_arg) {
+        *py_types = PyArray_FROMANY(py_types_arg, NPY_INT, 1, 1,
+                                    NPY_C_CONTIGUOUS | NPY_FORCECAST);
+        if (!*py_types)  return false;
+        *py_pair_cutoffs = PyArray_FROMANY(py_pair_cutoffs_arg, NPY_DOUBLE,
+                                           2, 2, NPY_C_CONTIGUOUS);
+        if (!*py_pair_cutoffs)  return false;
+
+        int ntypes = PyArray_DIM((PyArrayObject *) *py_pair_cutoffs, 0);
+        if (PyArray_DIM((PyArrayObject *) *py_pair_cutoffs, 1) != ntypes) {
+            PyErr_SetString(PyExc_ValueError, "pair_cutoffs must be a square "
+                            "matrix.");
+            return false;
+        }
+        if (PyArray_DIM((PyArrayObject *) *py_types, 0) != nat) {
+            PyErr_SetString(PyExc_ValueError, "types must have one entry per "
+                            "atom.");
+            return false;
+        }
+        npy_int *types = PyArray_DATA((PyArrayObject *) *py_types);
+        npy_intp k;
+        for (k = 0; k < nat; k++) {
+            if (types[k] < 0 || types[k] >= ntypes) {
+                PyErr_SetString(PyExc_ValueError, "types out of range of "
+                                "pair_cutoffs.");
+                return false;
+            }
+        }
+        npy_double *pair_cutoffs =
+            PyArray_DATA((PyArrayObject *) *py_pair_cutoffs);
+        params->pair_cutoff_sq = (double *) malloc(ntypes*ntypes*
+                                                   sizeof(double));
+        if (!params->pair_cutoff_sq) {
+            PyErr_NoMemory();
+            return false;
+        }
+        for (k = 0; k < ntypes*ntypes; k++)
+            params->pair_cutoff_sq[k] = pair_cutoffs[k]*pair_cutoffs[k];
+        params->types = types;
+        params->ntypes = ntypes;
+    }
+
+    return true;
+}
+
+/*
+ * Number of blocks the n central atoms of a frame are split into, at least
+ * one per thread. Blocks hold at most MAX_BLOCK_ATOMS atoms, such that the
+ * work is spread evenly over threads also if the density varies.
+ */
+#define MAX_BLOCK_ATOMS 16384
+
+int
+number_of_blocks(npy_intp n, int nthreads)
+{
+    npy_intp nblocks = (n+MAX_BLOCK_ATOMS-1)/MAX_BLOCK_ATOMS;
+    nblocks = max(nblocks, nthreads);
+    return (int) max(min(nblocks, n), 1);
+}
+
+/*
+ * Search the neighbours of all blocks. Atoms must have been binned. nseed is
+ * the total number of central atoms, the 'p' and 'N' quantities have
+ * nseed+1 and nseed entries. The distance histogram 'h' has nbins bins
+ * between zero and the cutoff. Indices ('i', 'j', 'S', 'f') are stored as
+ * int_type (NPY_INT32 or NPY_INT64), distances ('D', 'd') as float_type
+ * (NPY_FLOAT or NPY_DOUBLE). The GIL is released during the pair search.
+ * Returns the requested quantities or NULL on error.
+ */
+PyObject *
+neighbour_search(const char *quantities, neighbour_block_t *blocks,
+                 int nblocks, int num_threads, npy_intp nseed, int nbins,
+                 int float_type, int int_type, PyObject *py_out)
+{
+    PyObject *py_first = NULL, *py_secnd = NULL, *py_distvec = NULL;
+    PyObject *py_absdist = NULL, *py_shift = NULL, *py_seed = NULL;
+    PyObject *py_frame_index = NULL, *py_count = NULL, *py_hist = NULL;
+    PyObject *py_ret = NULL;
+    npy_intp *block_hist = NULL;
+    int i, t, store = 0;
+
+    /* Which quantities are stored for each pair */
+    i = 0;
+    while (quantities[i] != '\0') {
+        switch (quantities[i]) {
+        case 'i':
+            store |= STORE_FIRST;
+            break;
+        case 'j':
+            store |= STORE_SECND;
+            break;
+        case 'D':
+            store |= STORE_DISTVEC;
+            break;
+        case 'd':
+            store |= STORE_ABSDIST;
             break;
         case 'S':
-            PyTuple_SetItem(py_ret, i, py_shift);
+            store |= STORE_SHIFT;
             break;
-        default:
-            PyErr_SetString(PyExc_ValueError,
-                            "Unsupported quantity specified.");
+        case 'f':
+            store |= STORE_FRAME;
+            break;
+        }
+        i++;
+    }
+    if (strchr(quantities, 'h') && nbins < 1) {
+        PyErr_SetString(PyExc_ValueError, "Number of histogram bins must "
+                        "be positive.");
+        return NULL;
+    }
+
+    /* Search pairs, with the worker for atoms or query points and the
+       output types. All blocks have the same search parameters. */
+    bool index64 = int_type == NPY_INT64;
+    bool single = float_type == NPY_FLOAT;
+    bool query = nblocks > 0 && blocks[0].p->points;
+    void *(*worker)(void *) =
+        neighbour_block_search_workers[4*query + 2*index64 + single];
+    for (t = 0; t < nblocks; t++) {
+        blocks[t].index64 = index64;
+        blocks[t].single = single;
+    }
+
+    /* If pairs are stored, the first pass counts the pairs of each block
+       such that the output arrays can be allocated at their final size.
+       The reductions are accumulated in the second pass. */
+    npy_intp nneigh = 0;
+    if (store) {
+        Py_BEGIN_ALLOW_THREADS
+        run_parallel(neighbour_block_count_workers[query], blocks,
+                     sizeof(neighbour_block_t), nblocks, num_threads);
+        Py_END_ALLOW_THREADS
+        for (t = 0; t < nblocks; t++)  nneigh += blocks[t].nneigh;
+    }
+
+    /* Allocate the output arrays or take them from the buffers in out, this
+       needs the GIL */
+    npy_intp dims[2] = { nneigh, 3 };
+    if ((store & STORE_FIRST) &&
+        !(py_first = output_array(py_out, 'i', 1, dims, int_type)))
+        goto fail;
+    if ((store & STORE_SECND) &&
+        !(py_secnd = output_array(py_out, 'j', 1, dims, int_type)))
+        goto fail;
+    if ((store & STORE_DISTVEC) &&
+        !(py_distvec = output_array(py_out, 'D', 2, dims, float_type)))
+        goto fail;
+    if ((store & STORE_ABSDIST) &&
+        !(py_absdist = output_array(py_out, 'd', 1, dims, float_type)))
+        goto fail;
+    if ((store & STORE_SHIFT) &&
+        !(py_shift = output_array(py_out, 'S', 2, dims, int_type)))
+        goto fail;
+    if ((store & STORE_FRAME) &&
+        !(py_frame_index = output_array(py_out, 'f', 1, dims, int_type)))
+        goto fail;
+    if (strchr(quantities, 'p')) {
+        npy_intp seed_dims[1] = { nseed+1 };
+        py_seed = output_array(py_out, 'p', 1, seed_dims, NPY_INTP);
+        if (!py_seed)  goto fail;
+    }
+    if (strchr(quantities, 'N')) {
+        npy_intp count_dims[1] = { nseed };
+        py_count = output_array(py_out, 'N', 1, count_dims, NPY_INT);
+        if (!py_count)  goto fail;
+    }
+    if (strchr(quantities, 'h')) {
+        npy_intp hist_dims[1] = { nbins };
+        py_hist = output_array(py_out, 'h', 1, hist_dims, NPY_INTP);
+        block_hist = (npy_intp *) calloc(nblocks*nbins, sizeof(npy_intp));
+        if (!py_hist || !block_hist) {
+            if (py_hist)  PyErr_NoMemory();
             goto fail;
         }
+    }
+
+    /* Each block stores its pairs in its slice of the output arrays. Blocks
+       are in order of frame and central atom, hence the result is identical
+       to a serial search. */
+    char *first = py_first ? PyArray_BYTES((PyArrayObject *) py_first) : NULL;
+    char *secnd = py_secnd ? PyArray_BYTES((PyArrayObject *) py_secnd) : NULL;
+    char *distvec = py_distvec ?
+        PyArray_BYTES((PyArrayObject *) py_distvec) : NULL;
+    char *absdist = py_absdist ?
+        PyArray_BYTES((PyArrayObject *) py_absdist) : NULL;
+    char *shift = py_shift ? PyArray_BYTES((PyArrayObject *) py_shift) : NULL;
+    char *frame_index = py_frame_index ?
+        PyArray_BYTES((PyArrayObject *) py_frame_index) : NULL;
+    npy_intp *seed = py_seed ?
+        (npy_intp *) PyArray_DATA((PyArrayObject *) py_seed) : NULL;
+    npy_int *count = py_count ?
+        (npy_int *) PyArray_DATA((PyArrayObject *) py_count) : NULL;
+    npy_intp isize = index64 ? sizeof(npy_int64) : sizeof(npy_int32);
+    npy_intp fsize = single ? sizeof(npy_float) : sizeof(npy_double);
+    npy_intp offset = 0;
+    for (t = 0; t < nblocks; t++) {
+        neighbour_block_t *b = &blocks[t];
+        b->store = store;
+        b->first = first ? first + isize*offset : NULL;
+        b->secnd = secnd ? secnd + isize*offset : NULL;
+        b->distvec = distvec ? distvec + 3*fsize*offset : NULL;
+        b->absdist = absdist ? absdist + fsize*offset : NULL;
+        b->shift = shift ? shift + 3*isize*offset : NULL;
+        b->frame_index = frame_index ? frame_index + isize*offset : NULL;
+        b->seed = seed ? seed + b->seed_offset : NULL;
+        b->count = count ? count + b->seed_offset : NULL;
+        b->nbins = nbins;
+        b->hist = block_hist ? block_hist + t*nbins : NULL;
+        offset += b->nneigh;
+    }
+
+    if (store || py_seed || py_count || py_hist) {
+        Py_BEGIN_ALLOW_THREADS
+        run_parallel(worker, blocks, sizeof(neighbour_block_t), nblocks,
+                     num_threads);
+        Py_END_ALLOW_THREADS
+    }
+
+    /* Seeds are relative to their block */
+    offset = 0;
+    for (t = 0; t < nblocks; t++) {
+        neighbour_block_t *b = &blocks[t];
+        assert(!store || offset + b->nneigh <= nneigh);
+        if (seed) {
+            npy_intp k;
+            for (k = b->i0; k < b->i1; k++)  b->seed[k] += offset;
+        }
+        offset += b->nneigh;
+    }
+    assert(!store || offset == nneigh);
+    nneigh = offset;
+    if (seed)  seed[nseed] = nneigh;
+
+    /* Sum the histograms of all blocks */
+    if (py_hist) {
+        npy_intp *hist = PyArray_DATA((PyArrayObject *) py_hist);
+        int k;
+        for (k = 0; k < nbins; k++) {
+            hist[k] = 0;
+            for (t = 0; t < nblocks; t++)  hist[k] += block_hist[t*nbins+k];
+        }
+    }
+
+    /* Build return tuple */
+    py_ret = PyTuple_New(strlen(quantities));
+    if (!py_ret)  goto fail;
+    i = 0;
+    while (quantities[i] != '\0') {
+        PyObject *py_arr = NULL;
+        switch (quantities[i]) {
+        case 'i':
+            py_arr = py_first;
+            break;
+        case 'j':
+            py_arr = py_secnd;
+            break;
+        case 'D':
+            py_arr = py_distvec;
+            break;
+        case 'd':
+            py_arr = py_absdist;
+            break;
+        case 'S':
+            py_arr = py_shift;
+            break;
+        case 'p':
+            py_arr = py_seed;
+            break;
+        case 'f':
+            py_arr = py_frame_index;
+            break;
+        case 'N':
+            py_arr = py_count;
+            break;
+        case 'h':
+            py_arr = py_hist;
+            break;
+        }
+        Py_INCREF(py_arr);
+        PyTuple_SET_ITEM(py_ret, i, py_arr);
         i++;
     }
     if (strlen(quantities) == 1) {
@@ -513,18 +1706,1184 @@ py_neighbour_list(PyObject *self, PyObject *args)
         Py_INCREF(py_ret);
         Py_DECREF(py_tuple);
     }
+
+    fail:
+    Py_XDECREF(py_first);
+    Py_XDECREF(py_secnd);
+    Py_XDECREF(py_distvec);
+    Py_XDECREF(py_absdist);
+    Py_XDECREF(py_shift);
+    Py_XDECREF(py_seed);
+    Py_XDECREF(py_frame_index);
+    Py_XDECREF(py_count);
+    Py_XDECREF(py_hist);
+    if (block_hist)  free(block_hist);
     return py_ret;
+}
+
+/*
+ * Neighbour list construction
+ */
+
+PyObject *
+py_neighbour_list(PyObject *self, PyObject *args, PyObject *kwargs)
+{
+    static char *kwlist[] = { "quantities", "cell", "inv_cell", "pbc",
+                              "positions", "cutoff", "num_threads",
+                              "half_list", "radii", "types", "pair_cutoffs",
+                              "out", "contiguous_bins", "nbins",
+                              "float_type", "int_type", NULL };
+
+    PyObject *py_cell, *py_inv_cell, *py_pbc, *py_r, *py_quantities;
+    PyObject *py_radii = NULL, *py_types = NULL, *py_pair_cutoffs = NULL;
+    PyObject *py_out = NULL;
+    PyObject *py_float_type = Py_None, *py_int_type = Py_None;
+    double cutoff;
+    int num_threads = 1, half_list = 0, contiguous_bins = 1, nbins = 100;
+    int float_type, int_type;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "O!OOOOd|iiOOOOiiOO",
+                                     kwlist, &PyString_Type, &py_quantities,
+                                     &py_cell, &py_inv_cell, &py_pbc, &py_r,
+                                     &cutoff, &num_threads, &half_list,
+                                     &py_radii, &py_types, &py_pair_cutoffs,
+                                     &py_out, &contiguous_bins, &nbins,
+                                     &py_float_type, &py_int_type))
+        return NULL;
+    if (!output_types(py_float_type, py_int_type, &float_type, &int_type))
+        return NULL;
+
+    if (cutoff <= 0.0) {
+        PyErr_SetString(PyExc_ValueError, "Cutoff must be positive.");
+        return NULL;
+    }
+    if (num_threads < 1) {
+        PyErr_SetString(PyExc_ValueError,
+                        "Number of threads must be positive.");
+        return NULL;
+    }
+    if (py_out == Py_None)  py_out = NULL;
+    if (py_out && !PyDict_Check(py_out)) {
+        PyErr_SetString(PyExc_TypeError, "out must be a dictionary.");
+        return NULL;
+    }
+
+    char *quantities = PyString_AS_STRING(py_quantities);
+    if (!check_quantities(quantities))  return NULL;
+
+    search_params_t params;
+    frame_t *frames = NULL;
+    neighbour_block_t *blocks = NULL;
+    int nframes = 0, nblocks = 0, t;
+
+    PyObject *py_ret = NULL;
+
+    params.pair_cutoff_sq = NULL;
+
+    /* Make sure our arrays are contiguous. Positions and cells can carry an
+       additional leading dimension, the frames of a trajectory. */
+    py_cell = PyArray_FROMANY(py_cell, NPY_DOUBLE, 2, 3,
+                              NPY_C_CONTIGUOUS);
+    py_inv_cell = !py_cell ? NULL :
+        PyArray_FROMANY(py_inv_cell, NPY_DOUBLE, 2, 3, NPY_C_CONTIGUOUS);
+    py_pbc = !py_inv_cell ? NULL :
+        PyArray_FROMANY(py_pbc, NPY_BOOL, 1, 1, NPY_C_CONTIGUOUS);
+    py_r = !py_pbc ? NULL :
+        PyArray_FROMANY(py_r, NPY_DOUBLE, 2, 3, NPY_C_CONTIGUOUS);
+    if (!py_r) {
+        py_radii = py_types = py_pair_cutoffs = NULL;
+        goto fail;
+    }
+
+    /* Check array shapes */
+    int rdim = PyArray_NDIM((PyArrayObject *) py_r);
+    int celldim = PyArray_NDIM((PyArrayObject *) py_cell);
+    nframes = rdim == 3 ? PyArray_DIM((PyArrayObject *) py_r, 0) : 1;
+    npy_intp nat = PyArray_DIM((PyArrayObject *) py_r, rdim-2);
+
+    /* Per-pair cutoffs, this replaces the arguments by new references */
+    if (!search_params_init(&params, cutoff, half_list, nat, &py_radii,
+                            &py_types, &py_pair_cutoffs))
+        goto fail;
+
+    if (PyArray_NDIM((PyArrayObject *) py_inv_cell) != celldim ||
+        (celldim == 3 &&
+         (PyArray_DIM((PyArrayObject *) py_cell, 0) != nframes ||
+          PyArray_DIM((PyArrayObject *) py_inv_cell, 0) != nframes)) ||
+        PyArray_DIM((PyArrayObject *) py_cell, celldim-2) != 3 ||
+        PyArray_DIM((PyArrayObject *) py_cell, celldim-1) != 3 ||
+        PyArray_DIM((PyArrayObject *) py_inv_cell, celldim-2) != 3 ||
+        PyArray_DIM((PyArrayObject *) py_inv_cell, celldim-1) != 3) {
+        PyErr_SetString(PyExc_ValueError, "Cell must be a 3x3 matrix or one "
+                        "3x3 matrix per frame.");
+        goto fail;
+    }
+    if (PyArray_DIM((PyArrayObject *) py_pbc, 0) != 3) {
+        PyErr_SetString(PyExc_ValueError, "pbc must have length 3.");
+        goto fail;
+    }
+    if (PyArray_DIM((PyArrayObject *) py_r, rdim-1) != 3) {
+        PyErr_SetString(PyExc_ValueError, "Positions must be a nx3 array.");
+        goto fail;
+    }
+
+    npy_double *cell = PyArray_DATA((PyArrayObject *) py_cell);
+    npy_double *inv_cell = PyArray_DATA((PyArrayObject *) py_inv_cell);
+    npy_bool *pbc = PyArray_DATA((PyArrayObject *) py_pbc);
+    npy_double *r = PyArray_DATA((PyArrayObject *) py_r);
+
+    /* Each frame has its own cell list. A single cell is shared by all
+       frames. */
+    frames = (frame_t *) calloc(max(nframes, 1), sizeof(frame_t));
+    if (!frames) {
+        PyErr_NoMemory();
+        goto fail;
+    }
+    for (t = 0; t < nframes; t++) {
+        frame_t *f = &frames[t];
+        int c = celldim == 3 ? t : 0;
+        f->cell = cell + 9*c;
+        f->inv_cell = inv_cell + 9*c;
+        f->r = r + 3*nat*t;
+        f->pbc = pbc;
+        f->nat = nat;
+        f->cutoff = cutoff;
+        f->contiguous = contiguous_bins;
+        f->params = params;
+        f->params.cl = &f->cl;
+    }
+
+    /* Split central atoms of each frame into contiguous blocks. A single
+       frame is split into at least one block per thread, trajectories are
+       parallelized over frames. */
+    int blocks_per_frame = number_of_blocks(nat, num_threads/max(nframes, 1));
+    nblocks = nframes*blocks_per_frame;
+    blocks = (neighbour_block_t *) calloc(max(nblocks, 1),
+                                          sizeof(neighbour_block_t));
+    if (!blocks) {
+        PyErr_NoMemory();
+        goto fail;
+    }
+    for (t = 0; t < nblocks; t++) {
+        int f = t/blocks_per_frame, k = t%blocks_per_frame;
+        blocks[t].p = &frames[f].params;
+        blocks[t].frame = f;
+        blocks[t].i0 = (k*nat)/blocks_per_frame;
+        blocks[t].i1 = ((k+1)*nat)/blocks_per_frame;
+        blocks[t].seed_offset = f*nat;
+    }
+
+    /* Sort atoms into bins. This does not need the interpreter, release the
+       GIL so that other Python threads can run concurrently. */
+    bool binned = true;
+    Py_BEGIN_ALLOW_THREADS
+    run_parallel(frame_bin, frames, sizeof(frame_t), nframes, num_threads);
+    Py_END_ALLOW_THREADS
+
+    for (t = 0; t < nframes; t++) {
+        frame_t *f = &frames[t];
+        binned = binned && f->binned;
+        if (f->binned) {
+            f->params.stencil = cell_list_stencil(&f->cl, cutoff,
+                                                  &f->params.nstencil);
+            binned = binned && f->params.stencil;
+        }
+    }
+    if (!binned) {
+        PyErr_NoMemory();
+        goto fail;
+    }
+
+    py_ret = neighbour_search(quantities, blocks, nblocks, num_threads,
+                              nframes*nat, nbins, float_type, int_type,
+                              py_out);
 
     fail:
     /* Cleanup. Sorry for the goto. */
-    if (seed)  free(seed);
-    if (next)  free(next);
-    if (py_first)  Py_DECREF(py_first);
-    if (py_secnd)  Py_DECREF(py_secnd);
-    if (py_distvec)  Py_DECREF(py_distvec);
-    if (py_absdist)  Py_DECREF(py_absdist);
-    if (py_shift)  Py_DECREF(py_shift);
-    return NULL;
+    if (frames) {
+        for (t = 0; t < nframes; t++) {
+            cell_list_free(&frames[t].cl);
+            if (frames[t].params.stencil)  free(frames[t].params.stencil);
+        }
+        free(frames);
+    }
+    if (params.pair_cutoff_sq)  free(params.pair_cutoff_sq);
+    if (blocks)  free(blocks);
+    Py_XDECREF(py_radii);
+    Py_XDECREF(py_types);
+    Py_XDECREF(py_pair_cutoffs);
+    Py_XDECREF(py_cell);
+    Py_XDECREF(py_inv_cell);
+    Py_XDECREF(py_pbc);
+    Py_XDECREF(py_r);
+    return py_ret;
+}
+
+/*
+ * Persistent cell list. Atoms are binned once and can be re-binned
+ * individually after they moved, the neighbours of a subset of atoms can be
+ * searched at a cost proportional to the size of the subset.
+ */
+
+typedef struct {
+    PyObject_HEAD
+    PyObject *py_cell, *py_inv_cell, *py_pbc, *py_r;  /* Private copies */
+    double cutoff;
+    cell_list_t cl;
+    int nsearches;             /* Number of searches currently running */
+} cell_list_object_t;
+
+static void
+cell_list_object_dealloc(cell_list_object_t *self)
+{
+    cell_list_free(&self->cl);
+    Py_XDECREF(self->py_cell);
+    Py_XDECREF(self->py_inv_cell);
+    Py_XDECREF(self->py_pbc);
+    Py_XDECREF(self->py_r);
+    Py_TYPE(self)->tp_free((PyObject *) self);
+}
+
+static PyObject *
+cell_list_object_new(PyTypeObject *type, PyObject *args, PyObject *kwargs)
+{
+    cell_list_object_t *self;
+
+    self = (cell_list_object_t *) type->tp_alloc(type, 0);
+    if (self) {
+        self->py_cell = NULL;
+        self->py_inv_cell = NULL;
+        self->py_pbc = NULL;
+        self->py_r = NULL;
+        self->cutoff = 0.0;
+        memset(&self->cl, 0, sizeof(cell_list_t));
+        self->nsearches = 0;
+    }
+    return (PyObject *) self;
+}
+
+static int
+cell_list_object_init(cell_list_object_t *self, PyObject *args,
+                      PyObject *kwargs)
+{
+    static char *kwlist[] = { "cell", "inv_cell", "pbc", "positions",
+                              "cutoff", "contiguous_bins", NULL };
+
+    PyObject *py_cell, *py_inv_cell, *py_pbc, *py_r;
+    double cutoff;
+    int contiguous_bins = 0;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "OOOOd|i", kwlist,
+                                     &py_cell, &py_inv_cell, &py_pbc, &py_r,
+                                     &cutoff, &contiguous_bins))
+        return -1;
+
+    if (self->nsearches > 0) {
+        PyErr_SetString(PyExc_RuntimeError, "Cell list is in use.");
+        return -1;
+    }
+    if (cutoff <= 0.0) {
+        PyErr_SetString(PyExc_ValueError, "Cutoff must be positive.");
+        return -1;
+    }
+
+    /* Private copies, positions are modified by update */
+    py_cell = PyArray_FROMANY(py_cell, NPY_DOUBLE, 2, 2,
+                              NPY_C_CONTIGUOUS | NPY_ENSURECOPY);
+    py_inv_cell = !py_cell ? NULL :
+        PyArray_FROMANY(py_inv_cell, NPY_DOUBLE, 2, 2,
+                        NPY_C_CONTIGUOUS | NPY_ENSURECOPY);
+    py_pbc = !py_inv_cell ? NULL :
+        PyArray_FROMANY(py_pbc, NPY_BOOL, 1, 1,
+                        NPY_C_CONTIGUOUS | NPY_ENSURECOPY);
+    py_r = !py_pbc ? NULL :
+        PyArray_FROMANY(py_r, NPY_DOUBLE, 2, 2,
+                        NPY_C_CONTIGUOUS | NPY_ENSURECOPY);
+    if (!py_r)  goto fail;
+
+    if (PyArray_DIM((PyArrayObject *) py_cell, 0) != 3 ||
+        PyArray_DIM((PyArrayObject *) py_cell, 1) != 3 ||
+        PyArray_DIM((PyArrayObject *) py_inv_cell, 0) != 3 ||
+        PyArray_DIM((PyArrayObject *) py_inv_cell, 1) != 3) {
+        PyErr_SetString(PyExc_ValueError, "Cell must be a 3x3 matrix.");
+        goto fail;
+    }
+    if (PyArray_DIM((PyArrayObject *) py_pbc, 0) != 3) {
+        PyErr_SetString(PyExc_ValueError, "pbc must have length 3.");
+        goto fail;
+    }
+    if (PyArray_DIM((PyArrayObject *) py_r, 1) != 3) {
+        PyErr_SetString(PyExc_ValueError, "Positions must be a nx3 array.");
+        goto fail;
+    }
+
+    /* Release a previous cell list if __init__ is called twice */
+    cell_list_free(&self->cl);
+    Py_XDECREF(self->py_cell);
+    Py_XDECREF(self->py_inv_cell);
+    Py_XDECREF(self->py_pbc);
+    Py_XDECREF(self->py_r);
+    self->py_cell = py_cell;
+    self->py_inv_cell = py_inv_cell;
+    self->py_pbc = py_pbc;
+    self->py_r = py_r;
+    self->cutoff = cutoff;
+
+    /* Linked lists can be updated atom by atom, contiguous bins are faster
+       to search */
+    bool binned;
+    Py_BEGIN_ALLOW_THREADS
+    binned = cell_list_init(&self->cl,
+                            PyArray_DATA((PyArrayObject *) py_cell),
+                            PyArray_DATA((PyArrayObject *) py_inv_cell),
+                            PyArray_DATA((PyArrayObject *) py_pbc),
+                            PyArray_DATA((PyArrayObject *) py_r),
+                            PyArray_DIM((PyArrayObject *) py_r, 0), cutoff,
+                            contiguous_bins);
+    Py_END_ALLOW_THREADS
+    if (!binned) {
+        /* Mark as not initialized */
+        memset(&self->cl, 0, sizeof(cell_list_t));
+        Py_CLEAR(self->py_r);
+        PyErr_NoMemory();
+        return -1;
+    }
+
+    return 0;
+
+    fail:
+    Py_XDECREF(py_cell);
+    Py_XDECREF(py_inv_cell);
+    Py_XDECREF(py_pbc);
+    Py_XDECREF(py_r);
+    return -1;
+}
+
+/*
+ * Return the neighbours of a subset of atoms
+ */
+static PyObject *
+cell_list_object_neighbours(cell_list_object_t *self, PyObject *args,
+                            PyObject *kwargs)
+{
+    static char *kwlist[] = { "quantities", "central_atoms", "cutoff",
+                              "num_threads", "half_list", "radii", "types",
+                              "pair_cutoffs", "out", "nbins", "float_type",
+                              "int_type", NULL };
+
+    PyObject *py_quantities, *py_central = NULL;
+    PyObject *py_radii = NULL, *py_types = NULL, *py_pair_cutoffs = NULL;
+    PyObject *py_out = NULL;
+    PyObject *py_float_type = Py_None, *py_int_type = Py_None;
+    double cutoff = -1.0;
+    int num_threads = 1, half_list = 0, nbins = 100;
+    int float_type, int_type;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "O!|OdiiOOOOiOO", kwlist,
+                                     &PyString_Type, &py_quantities,
+                                     &py_central, &cutoff, &num_threads,
+                                     &half_list, &py_radii, &py_types,
+                                     &py_pair_cutoffs, &py_out, &nbins,
+                                     &py_float_type, &py_int_type))
+        return NULL;
+    if (!output_types(py_float_type, py_int_type, &float_type, &int_type))
+        return NULL;
+
+    if (!self->py_r) {
+        PyErr_SetString(PyExc_RuntimeError, "Cell list is not initialized.");
+        return NULL;
+    }
+    if (cutoff < 0.0)  cutoff = self->cutoff;
+    if (cutoff <= 0.0) {
+        PyErr_SetString(PyExc_ValueError, "Cutoff must be positive.");
+        return NULL;
+    }
+    if (num_threads < 1) {
+        PyErr_SetString(PyExc_ValueError,
+                        "Number of threads must be positive.");
+        return NULL;
+    }
+    if (py_out == Py_None)  py_out = NULL;
+    if (py_out && !PyDict_Check(py_out)) {
+        PyErr_SetString(PyExc_TypeError, "out must be a dictionary.");
+        return NULL;
+    }
+
+    char *quantities = PyString_AS_STRING(py_quantities);
+    if (!check_quantities(quantities))  return NULL;
+
+    search_params_t params;
+    neighbour_block_t *blocks = NULL;
+    PyObject *py_ret = NULL;
+    npy_intp nat = self->cl.nat, ncentral = nat, k;
+    int nblocks = 0, t;
+
+    if (py_central == Py_None)  py_central = NULL;
+    if (py_central) {
+        py_central = PyArray_FROMANY(py_central, NPY_INTP, 1, 1,
+                                     NPY_C_CONTIGUOUS | NPY_FORCECAST);
+        if (!py_central)  return NULL;
+    }
+
+    /* Per-pair cutoffs, this replaces the arguments by new references */
+    if (!search_params_init(&params, cutoff, half_list, nat, &py_radii,
+                            &py_types, &py_pair_cutoffs))
+        goto fail;
+    params.cl = &self->cl;
+    params.stencil = cell_list_stencil(&self->cl, cutoff, &params.nstencil);
+    if (!params.stencil) {
+        PyErr_NoMemory();
+        goto fail;
+    }
+
+    if (py_central) {
+        params.central = PyArray_DATA((PyArrayObject *) py_central);
+        ncentral = PyArray_DIM((PyArrayObject *) py_central, 0);
+        for (k = 0; k < ncentral; k++) {
+            if (params.central[k] < 0 || params.central[k] >= nat) {
+                PyErr_SetString(PyExc_IndexError, "Central atom out of "
+                                "range.");
+                goto fail;
+            }
+        }
+    }
+
+    nblocks = number_of_blocks(ncentral, num_threads);
+    blocks = (neighbour_block_t *) calloc(nblocks, sizeof(neighbour_block_t));
+    if (!blocks) {
+        PyErr_NoMemory();
+        goto fail;
+    }
+    for (t = 0; t < nblocks; t++) {
+        blocks[t].p = &params;
+        blocks[t].i0 = (t*ncentral)/nblocks;
+        blocks[t].i1 = ((t+1)*ncentral)/nblocks;
+    }
+
+    /* The cell list must not be updated while the GIL is released */
+    self->nsearches++;
+    py_ret = neighbour_search(quantities, blocks, nblocks, num_threads,
+                              ncentral, nbins, float_type, int_type,
+                              py_out);
+    self->nsearches--;
+
+    fail:
+    if (params.pair_cutoff_sq)  free(params.pair_cutoff_sq);
+    if (params.stencil)  free(params.stencil);
+    if (blocks)  free(blocks);
+    Py_XDECREF(py_central);
+    Py_XDECREF(py_radii);
+    Py_XDECREF(py_types);
+    Py_XDECREF(py_pair_cutoffs);
+    return py_ret;
+}
+
+/*
+ * Neighbours of arbitrary query points
+ */
+static PyObject *
+cell_list_object_query(cell_list_object_t *self, PyObject *args,
+                       PyObject *kwargs)
+{
+    static char *kwlist[] = { "quantities", "points", "cutoff",
+                              "num_threads", "out", "nbins", "float_type",
+                              "int_type", NULL };
+
+    PyObject *py_quantities, *py_points;
+    PyObject *py_radii = NULL, *py_types = NULL, *py_pair_cutoffs = NULL;
+    PyObject *py_out = NULL;
+    PyObject *py_float_type = Py_None, *py_int_type = Py_None;
+    double cutoff;
+    int num_threads = 1, nbins = 100;
+    int float_type, int_type;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "O!Od|iOiOO", kwlist,
+                                     &PyString_Type, &py_quantities,
+                                     &py_points, &cutoff, &num_threads,
+                                     &py_out, &nbins, &py_float_type,
+                                     &py_int_type))
+        return NULL;
+    if (!output_types(py_float_type, py_int_type, &float_type, &int_type))
+        return NULL;
+
+    if (!self->py_r) {
+        PyErr_SetString(PyExc_RuntimeError, "Cell list is not initialized.");
+        return NULL;
+    }
+    if (cutoff <= 0.0) {
+        PyErr_SetString(PyExc_ValueError, "Cutoff must be positive.");
+        return NULL;
+    }
+    if (num_threads < 1) {
+        PyErr_SetString(PyExc_ValueError,
+                        "Number of threads must be positive.");
+        return NULL;
+    }
+    if (py_out == Py_None)  py_out = NULL;
+    if (py_out && !PyDict_Check(py_out)) {
+        PyErr_SetString(PyExc_TypeError, "out must be a dictionary.");
+        return NULL;
+    }
+
+    char *quantities = PyString_AS_STRING(py_quantities);
+    if (!check_quantities(quantities))  return NULL;
+
+    py_points = PyArray_FROMANY(py_points, NPY_DOUBLE, 2, 2,
+                                NPY_C_CONTIGUOUS);
+    if (!py_points)  return NULL;
+
+    search_params_t params;
+    neighbour_block_t *blocks = NULL;
+    PyObject *py_ret = NULL;
+    npy_intp npoints = PyArray_DIM((PyArrayObject *) py_points, 0);
+    int nblocks = 0, t;
+
+    /* No per-pair cutoffs, these refer to pairs of atoms */
+    if (!search_params_init(&params, cutoff, false, self->cl.nat, &py_radii,
+                            &py_types, &py_pair_cutoffs))
+        goto fail;
+    params.cl = &self->cl;
+    params.points = PyArray_DATA((PyArrayObject *) py_points);
+    params.stencil = cell_list_stencil(&self->cl, cutoff, &params.nstencil);
+    if (!params.stencil) {
+        PyErr_NoMemory();
+        goto fail;
+    }
+
+    if (PyArray_DIM((PyArrayObject *) py_points, 1) != 3) {
+        PyErr_SetString(PyExc_ValueError, "Points must have shape "
+                        "(npoints, 3).");
+        goto fail;
+    }
+
+    nblocks = number_of_blocks(npoints, num_threads);
+    blocks = (neighbour_block_t *) calloc(nblocks, sizeof(neighbour_block_t));
+    if (!blocks) {
+        PyErr_NoMemory();
+        goto fail;
+    }
+    for (t = 0; t < nblocks; t++) {
+        blocks[t].p = &params;
+        blocks[t].i0 = (t*npoints)/nblocks;
+        blocks[t].i1 = ((t+1)*npoints)/nblocks;
+    }
+
+    /* The cell list must not be updated while the GIL is released */
+    self->nsearches++;
+    py_ret = neighbour_search(quantities, blocks, nblocks, num_threads,
+                              npoints, nbins, float_type, int_type, py_out);
+    self->nsearches--;
+
+    fail:
+    if (params.pair_cutoff_sq)  free(params.pair_cutoff_sq);
+    if (params.stencil)  free(params.stencil);
+    if (blocks)  free(blocks);
+    Py_DECREF(py_points);
+    return py_ret;
+}
+
+/*
+ * Move a subset of atoms and re-bin them
+ */
+static PyObject *
+cell_list_object_update(cell_list_object_t *self, PyObject *args)
+{
+    PyObject *py_indices, *py_positions;
+
+    if (!PyArg_ParseTuple(args, "OO", &py_indices, &py_positions))
+        return NULL;
+
+    if (!self->py_r) {
+        PyErr_SetString(PyExc_RuntimeError, "Cell list is not initialized.");
+        return NULL;
+    }
+    if (self->nsearches > 0) {
+        PyErr_SetString(PyExc_RuntimeError, "Cell list is in use.");
+        return NULL;
+    }
+    if (self->cl.bin_start) {
+        PyErr_SetString(PyExc_RuntimeError, "Contiguous bins cannot be "
+                        "updated.");
+        return NULL;
+    }
+
+    py_indices = PyArray_FROMANY(py_indices, NPY_INTP, 1, 1,
+                                 NPY_C_CONTIGUOUS | NPY_FORCECAST);
+    if (!py_indices)  return NULL;
+    py_positions = PyArray_FROMANY(py_positions, NPY_DOUBLE, 2, 2,
+                                   NPY_C_CONTIGUOUS);
+    if (!py_positions) {
+        Py_DECREF(py_indices);
+        return NULL;
+    }
+
+    npy_intp n = PyArray_DIM((PyArrayObject *) py_indices, 0), k;
+    npy_intp *indices = PyArray_DATA((PyArrayObject *) py_indices);
+    npy_double *positions = PyArray_DATA((PyArrayObject *) py_positions);
+    npy_double *r = PyArray_DATA((PyArrayObject *) self->py_r);
+    PyObject *py_ret = NULL;
+
+    if (PyArray_DIM((PyArrayObject *) py_positions, 0) != n ||
+        PyArray_DIM((PyArrayObject *) py_positions, 1) != 3) {
+        PyErr_SetString(PyExc_ValueError, "Please provide one position per "
+                        "index.");
+        goto fail;
+    }
+    for (k = 0; k < n; k++) {
+        if (indices[k] < 0 || indices[k] >= self->cl.nat) {
+            PyErr_SetString(PyExc_IndexError, "Atom index out of range.");
+            goto fail;
+        }
+    }
+
+    for (k = 0; k < n; k++) {
+        npy_intp i = indices[k];
+        r[3*i+0] = positions[3*k+0];
+        r[3*i+1] = positions[3*k+1];
+        r[3*i+2] = positions[3*k+2];
+        cell_list_move(&self->cl, i);
+    }
+
+    Py_INCREF(Py_None);
+    py_ret = Py_None;
+
+    fail:
+    Py_DECREF(py_indices);
+    Py_DECREF(py_positions);
+    return py_ret;
+}
+
+static PyMethodDef cell_list_object_methods[] = {
+    { "neighbours", (PyCFunction) cell_list_object_neighbours,
+      METH_VARARGS | METH_KEYWORDS,
+      "Neighbours of all or a subset of the atoms." },
+    { "query", (PyCFunction) cell_list_object_query,
+      METH_VARARGS | METH_KEYWORDS,
+      "Atoms within a cutoff of arbitrary query points." },
+    { "update", (PyCFunction) cell_list_object_update, METH_VARARGS,
+      "Move a subset of the atoms and re-bin them." },
+    { NULL, NULL, 0, NULL }  /* Sentinel */
+};
+
+static PyTypeObject cell_list_type = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    .tp_name = "_matscipy.CellList",
+    .tp_basicsize = sizeof(cell_list_object_t),
+    .tp_dealloc = (destructor) cell_list_object_dealloc,
+    .tp_flags = Py_TPFLAGS_DEFAULT,
+    .tp_doc = "Cell list that is kept between neighbour searches.",
+    .tp_methods = cell_list_object_methods,
+    .tp_init = (initproc) cell_list_object_init,
+    .tp_new = cell_list_object_new,
+};
+
+/*
+ * Triplet list
+ */
+
+/*
+ * Build all triplets (i, j, k) of a neighbour list that is given in
+ * compressed form, i.e. by the offsets of the neighbours of each atom. A
+ * triplet combines two different pairs ij and ik with the same first atom.
+ * If a cutoff is given, only pairs ik shorter than the cutoff are used as
+ * the second leg.
+ */
+PyObject *
+py_triplet_list(PyObject *self, PyObject *args, PyObject *kwargs)
+{
+    static char *kwlist[] = { "quantities", "first_neighbours", "j",
+                              "distvec", "cutoff", NULL };
+
+    PyObject *py_quantities, *py_seed, *py_secnd, *py_distvec;
+    double cutoff = -1.0;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "O!OOO|d", kwlist,
+                                     &PyString_Type, &py_quantities,
+                                     &py_seed, &py_secnd, &py_distvec,
+                                     &cutoff))
+        return NULL;
+
+    char *quantities = PyString_AS_STRING(py_quantities);
+    int i = 0;
+    while (quantities[i] != '\0') {
+        if (!strchr("ijkabct", quantities[i])) {
+            PyErr_SetString(PyExc_ValueError,
+                            "Unsupported quantity specified.");
+            return NULL;
+        }
+        i++;
+    }
+
+    /* Offsets and atom indices can have any integer type, e.g. int64 from
+       neighbour_list(..., int_type=np.int64). Offsets are cast to npy_intp,
+       the checks below ensure they lie between 0 and the number of pairs.
+       Atom indices are only gathered and keep their type. */
+    py_seed = PyArray_FROM_OF(py_seed, NPY_C_CONTIGUOUS);
+    if (!py_seed)  return NULL;
+    if (!PyArray_ISINTEGER((PyArrayObject *) py_seed)) {
+        PyErr_SetString(PyExc_TypeError, "Offsets of first neighbours must "
+                        "be integers.");
+        Py_DECREF(py_seed);
+        return NULL;
+    }
+    PyObject *py_seed_arg = py_seed;
+    py_seed = PyArray_FROMANY(py_seed_arg, NPY_INTP, 1, 1,
+                              NPY_C_CONTIGUOUS | NPY_FORCECAST);
+    Py_DECREF(py_seed_arg);
+    if (!py_seed)  return NULL;
+    py_secnd = PyArray_FROM_OF(py_secnd, NPY_C_CONTIGUOUS);
+    if (!py_secnd) {
+        Py_DECREF(py_seed);
+        return NULL;
+    }
+    if (PyArray_NDIM((PyArrayObject *) py_secnd) != 1 ||
+        !PyArray_ISINTEGER((PyArrayObject *) py_secnd)) {
+        PyErr_SetString(PyExc_TypeError, "Atom indices j must be a "
+                        "one-dimensional integer array.");
+        Py_DECREF(py_seed);
+        Py_DECREF(py_secnd);
+        return NULL;
+    }
+    py_distvec = PyArray_FROMANY(py_distvec, NPY_DOUBLE, 2, 2,
+                                 NPY_C_CONTIGUOUS);
+    if (!py_distvec) {
+        Py_DECREF(py_seed);
+        Py_DECREF(py_secnd);
+        return NULL;
+    }
+
+    PyObject *py_first = NULL, *py_ij = NULL, *py_ik = NULL, *py_cos = NULL;
+    PyObject *py_ret = NULL;
+    bool *leg = NULL;
+
+    npy_intp nat = PyArray_DIM((PyArrayObject *) py_seed, 0) - 1;
+    npy_intp npairs = PyArray_DIM((PyArrayObject *) py_secnd, 0);
+    npy_intp *seed = PyArray_DATA((PyArrayObject *) py_seed);
+    npy_double *distvec = PyArray_DATA((PyArrayObject *) py_distvec);
+    npy_intp n, ij, ik;
+
+    if (PyArray_DIM((PyArrayObject *) py_distvec, 0) != npairs ||
+        PyArray_DIM((PyArrayObject *) py_distvec, 1) != 3) {
+        PyErr_SetString(PyExc_ValueError, "Please provide one distance "
+                        "vector per pair.");
+        goto fail;
+    }
+    if (nat < 0 || seed[0] != 0 || seed[nat] != npairs) {
+        PyErr_SetString(PyExc_ValueError, "Offsets of first neighbours do "
+                        "not match the number of pairs.");
+        goto fail;
+    }
+    for (n = 0; n < nat; n++) {
+        if (seed[n+1] < seed[n]) {
+            PyErr_SetString(PyExc_ValueError, "Offsets of first neighbours "
+                            "must not decrease.");
+            goto fail;
+        }
+    }
+
+    /* Pairs that may serve as second leg */
+    if (cutoff >= 0.0) {
+        leg = (bool *) malloc(max(npairs, 1)*sizeof(bool));
+        if (!leg) {
+            PyErr_NoMemory();
+            goto fail;
+        }
+        double cutoff_sq = cutoff*cutoff;
+        for (ij = 0; ij < npairs; ij++) {
+            double *dr = &distvec[3*ij];
+            leg[ij] = dr[0]*dr[0] + dr[1]*dr[1] + dr[2]*dr[2] < cutoff_sq;
+        }
+    }
+
+    /* Count triplets. Each pair of an atom with m second legs forms a
+       triplet with each of them except itself. */
+    npy_intp ntriplets = 0;
+    for (n = 0; n < nat; n++) {
+        npy_intp m = seed[n+1]-seed[n];
+        if (leg) {
+            m = 0;
+            for (ik = seed[n]; ik < seed[n+1]; ik++)  m += leg[ik];
+        }
+        ntriplets += (seed[n+1]-seed[n]-1)*m;
+    }
+
+    npy_intp dims[1] = { ntriplets };
+    i = 0;
+    while (quantities[i] != '\0') {
+        switch (quantities[i]) {
+        case 'i':
+            if (!py_first &&
+                !(py_first = PyArray_EMPTY(1, dims, NPY_INTP, 0)))
+                goto fail;
+            break;
+        case 'j':
+        case 'a':
+            if (!py_ij && !(py_ij = PyArray_EMPTY(1, dims, NPY_INTP, 0)))
+                goto fail;
+            break;
+        case 'k':
+        case 'b':
+            if (!py_ik && !(py_ik = PyArray_EMPTY(1, dims, NPY_INTP, 0)))
+                goto fail;
+            break;
+        case 'c':
+        case 't':
+            if (!py_cos && !(py_cos = PyArray_EMPTY(1, dims, NPY_DOUBLE, 0)))
+                goto fail;
+            break;
+        }
+        i++;
+    }
+    npy_intp *first = py_first ? PyArray_DATA((PyArrayObject *) py_first) :
+        NULL;
+    npy_intp *pair_ij = py_ij ? PyArray_DATA((PyArrayObject *) py_ij) : NULL;
+    npy_intp *pair_ik = py_ik ? PyArray_DATA((PyArrayObject *) py_ik) : NULL;
+    npy_double *cos_ijk = py_cos ? PyArray_DATA((PyArrayObject *) py_cos) :
+        NULL;
+
+    Py_BEGIN_ALLOW_THREADS
+    npy_intp t = 0;
+    for (n = 0; n < nat; n++) {
+        for (ij = seed[n]; ij < seed[n+1]; ij++) {
+            double *dr_ij = &distvec[3*ij];
+            double abs_dr_ij = normsq(dr_ij);
+            for (ik = seed[n]; ik < seed[n+1]; ik++) {
+                if (ik == ij || (leg && !leg[ik]))  continue;
+                if (first)  first[t] = n;
+                if (pair_ij)  pair_ij[t] = ij;
+                if (pair_ik)  pair_ik[t] = ik;
+                if (cos_ijk) {
+                    double *dr_ik = &distvec[3*ik];
+                    cos_ijk[t] = (dr_ij[0]*dr_ik[0] + dr_ij[1]*dr_ik[1] +
+                                  dr_ij[2]*dr_ik[2])/(abs_dr_ij*normsq(dr_ik));
+                }
+                t++;
+            }
+        }
+    }
+    Py_END_ALLOW_THREADS
+
+    /* Build return tuple */
+    py_ret = PyTuple_New(strlen(quantities));
+    if (!py_ret)  goto fail;
+    i = 0;
+    while (quantities[i] != '\0') {
+        PyObject *py_arr = NULL;
+        switch (quantities[i]) {
+        case 'i':
+            Py_INCREF(py_first);
+            py_arr = py_first;
+            break;
+        case 'j':
+        case 'k':
+            /* Atom indices are gathered from the pair indices */
+            py_arr = PyArray_TakeFrom((PyArrayObject *) py_secnd,
+                                      quantities[i] == 'j' ? py_ij : py_ik,
+                                      0, NULL, NPY_RAISE);
+            break;
+        case 'a':
+            Py_INCREF(py_ij);
+            py_arr = py_ij;
+            break;
+        case 'b':
+            Py_INCREF(py_ik);
+            py_arr = py_ik;
+            break;
+        case 'c':
+            Py_INCREF(py_cos);
+            py_arr = py_cos;
+            break;
+        case 't':
+            if ((py_arr = PyArray_EMPTY(1, dims, NPY_DOUBLE, 0))) {
+                npy_double *angle = PyArray_DATA((PyArrayObject *) py_arr);
+                npy_intp k;
+                for (k = 0; k < ntriplets; k++)
+                    angle[k] = acos(max(-1.0, min(1.0, cos_ijk[k])));
+            }
+            break;
+        }
+        if (!py_arr) {
+            Py_DECREF(py_ret);
+            py_ret = NULL;
+            goto fail;
+        }
+        PyTuple_SET_ITEM(py_ret, i, py_arr);
+        i++;
+    }
+
+    /* Return single array if only one quantity was requested */
+    if (strlen(quantities) == 1) {
+        PyObject *py_arr = PyTuple_GET_ITEM(py_ret, 0);
+        Py_INCREF(py_arr);
+        Py_DECREF(py_ret);
+        py_ret = py_arr;
+    }
+
+    fail:
+    if (leg)  free(leg);
+    Py_DECREF(py_seed);
+    Py_DECREF(py_secnd);
+    Py_DECREF(py_distvec);
+    Py_XDECREF(py_first);
+    Py_XDECREF(py_ij);
+    Py_XDECREF(py_ik);
+    Py_XDECREF(py_cos);
+    return py_ret;
+}
+
+/*
+ * Atomic strain
+ */
+
+/*
+ * Sum the outer products dr_now x dr_old (X_ij) and dr_old x dr_old (Y_ij)
+ * over the neighbours of each atom, in a single sweep over all pairs.
+ */
+PyObject *
+py_atomic_strain_sums(PyObject *self, PyObject *args, PyObject *kwargs)
+{
+    static char *kwlist[] = { "nat", "i", "dr_now", "dr_old", "yij", NULL };
+
+    PyObject *py_first, *py_dr_now, *py_dr_old;
+    npy_intp nat;
+    int with_yij = 1;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "nOOO|i", kwlist, &nat,
+                                     &py_first, &py_dr_now, &py_dr_old,
+                                     &with_yij))
+        return NULL;
+
+    if (nat < 0) {
+        PyErr_SetString(PyExc_ValueError, "Number of atoms must not be "
+                        "negative.");
+        return NULL;
+    }
+
+    if (py_dr_now == Py_None)  py_dr_now = NULL;
+    py_first = PyArray_FROMANY(py_first, NPY_INTP, 1, 1,
+                               NPY_C_CONTIGUOUS | NPY_FORCECAST);
+    if (!py_first)  return NULL;
+    py_dr_old = PyArray_FROMANY(py_dr_old, NPY_DOUBLE, 2, 2,
+                                NPY_C_CONTIGUOUS);
+    if (!py_dr_old) {
+        Py_DECREF(py_first);
+        return NULL;
+    }
+    if (py_dr_now) {
+        py_dr_now = PyArray_FROMANY(py_dr_now, NPY_DOUBLE, 2, 2,
+                                    NPY_C_CONTIGUOUS);
+        if (!py_dr_now) {
+            Py_DECREF(py_first);
+            Py_DECREF(py_dr_old);
+            return NULL;
+        }
+    }
+
+    PyObject *py_xij = NULL, *py_yij = NULL, *py_ret = NULL;
+    npy_intp npairs = PyArray_DIM((PyArrayObject *) py_first, 0), n;
+    npy_intp *first = PyArray_DATA((PyArrayObject *) py_first);
+
+    if (PyArray_DIM((PyArrayObject *) py_dr_old, 0) != npairs ||
+        PyArray_DIM((PyArrayObject *) py_dr_old, 1) != 3 ||
+        (py_dr_now && (PyArray_DIM((PyArrayObject *) py_dr_now, 0) != npairs ||
+                       PyArray_DIM((PyArrayObject *) py_dr_now, 1) != 3))) {
+        PyErr_SetString(PyExc_ValueError, "Please provide one distance "
+                        "vector per pair.");
+        goto fail;
+    }
+    for (n = 0; n < npairs; n++) {
+        if (first[n] < 0 || first[n] >= nat) {
+            PyErr_SetString(PyExc_IndexError, "Atom index out of range.");
+            goto fail;
+        }
+    }
+
+    npy_intp dims[3] = { nat, 3, 3 };
+    if (py_dr_now && !(py_xij = PyArray_ZEROS(3, dims, NPY_DOUBLE, 0)))
+        goto fail;
+    if (with_yij && !(py_yij = PyArray_ZEROS(3, dims, NPY_DOUBLE, 0)))
+        goto fail;
+
+    npy_double *dr_now = py_dr_now ?
+        PyArray_DATA((PyArrayObject *) py_dr_now) : NULL;
+    npy_double *dr_old = PyArray_DATA((PyArrayObject *) py_dr_old);
+    npy_double *xij = py_xij ? PyArray_DATA((PyArrayObject *) py_xij) : NULL;
+    npy_double *yij = py_yij ? PyArray_DATA((PyArrayObject *) py_yij) : NULL;
+
+    Py_BEGIN_ALLOW_THREADS
+    for (n = 0; n < npairs; n++) {
+        double *old = &dr_old[3*n];
+        int k, l;
+        if (xij) {
+            double *now = &dr_now[3*n], *x = &xij[9*first[n]];
+            for (k = 0; k < 3; k++)
+                for (l = 0; l < 3; l++)
+                    x[3*k+l] += now[k]*old[l];
+        }
+        if (yij) {
+            double *y = &yij[9*first[n]];
+            for (k = 0; k < 3; k++)
+                for (l = 0; l < 3; l++)
+                    y[3*k+l] += old[k]*old[l];
+        }
+    }
+    Py_END_ALLOW_THREADS
+
+    if (!py_xij) {
+        Py_INCREF(Py_None);
+        py_xij = Py_None;
+    }
+    if (!py_yij) {
+        Py_INCREF(Py_None);
+        py_yij = Py_None;
+    }
+    py_ret = Py_BuildValue("OO", py_xij, py_yij);
+
+    fail:
+    Py_DECREF(py_first);
+    Py_DECREF(py_dr_old);
+    Py_XDECREF(py_dr_now);
+    Py_XDECREF(py_xij);
+    Py_XDECREF(py_yij);
+    return py_ret;
+}
+
+/*
+ * Minimum image convention
+ */
+
+/*
+ * Wrap distance vectors into the minimum image, in place. Cells are stored
+ * row-wise (rows are the lattice vectors), inv_cell is the inverse of cell
+ * such that dr.inv_cell are the fractional components of dr.
+ */
+void
+mic_frame(npy_double *dr, npy_intp n, const npy_double *cell,
+          const npy_double *inv_cell, const npy_bool *pbc)
+{
+    npy_intp k;
+    bool orthorhombic = cell[1] == 0.0 && cell[2] == 0.0 && cell[3] == 0.0 &&
+        cell[5] == 0.0 && cell[6] == 0.0 && cell[7] == 0.0;
+
+    if (orthorhombic) {
+        double l[3], inv_l[3];
+        int d;
+        for (d = 0; d < 3; d++) {
+            l[d] = pbc[d] ? cell[4*d] : 0.0;
+            inv_l[d] = pbc[d] ? 1.0/cell[4*d] : 0.0;
+        }
+        for (k = 0; k < n; k++, dr += 3) {
+            dr[0] -= nearbyint(dr[0]*inv_l[0])*l[0];
+            dr[1] -= nearbyint(dr[1]*inv_l[1])*l[1];
+            dr[2] -= nearbyint(dr[2]*inv_l[2])*l[2];
+        }
+        return;
+    }
+
+    for (k = 0; k < n; k++, dr += 3) {
+        double s[3];
+        int d;
+        for (d = 0; d < 3; d++) {
+            s[d] = pbc[d] ? nearbyint(dr[0]*inv_cell[d] + dr[1]*inv_cell[3+d] +
+                                      dr[2]*inv_cell[6+d]) : 0.0;
+        }
+        for (d = 0; d < 3; d++)
+            dr[d] -= s[0]*cell[d] + s[1]*cell[3+d] + s[2]*cell[6+d];
+    }
+}
+
+PyObject *
+py_mic(PyObject *self, PyObject *args, PyObject *kwargs)
+{
+    static char *kwlist[] = { "dr", "cell", "inv_cell", "pbc", NULL };
+
+    PyObject *py_dr, *py_cell, *py_inv_cell, *py_pbc = NULL;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "O!OO|O", kwlist,
+                                     &PyArray_Type, &py_dr, &py_cell,
+                                     &py_inv_cell, &py_pbc))
+        return NULL;
+
+    PyArrayObject *dr_arr = (PyArrayObject *) py_dr;
+    int nd = PyArray_NDIM(dr_arr);
+    if (PyArray_TYPE(dr_arr) != NPY_DOUBLE || !PyArray_ISCARRAY(dr_arr)) {
+        PyErr_SetString(PyExc_TypeError, "Distance vectors must be a "
+                        "C-contiguous, writeable array of doubles.");
+        return NULL;
+    }
+    if ((nd != 2 && nd != 3) || PyArray_DIM(dr_arr, nd-1) != 3) {
+        PyErr_SetString(PyExc_ValueError, "Distance vectors must have shape "
+                        "(npairs, 3) or (nframes, npairs, 3).");
+        return NULL;
+    }
+
+    py_cell = PyArray_FROMANY(py_cell, NPY_DOUBLE, 2, 3, NPY_C_CONTIGUOUS);
+    if (!py_cell)  return NULL;
+    py_inv_cell = PyArray_FROMANY(py_inv_cell, NPY_DOUBLE, 2, 3,
+                                  NPY_C_CONTIGUOUS);
+    if (!py_inv_cell) {
+        Py_DECREF(py_cell);
+        return NULL;
+    }
+    if (py_pbc == Py_None)  py_pbc = NULL;
+    if (py_pbc) {
+        py_pbc = PyArray_FROMANY(py_pbc, NPY_BOOL, 1, 1, NPY_C_CONTIGUOUS);
+        if (!py_pbc) {
+            Py_DECREF(py_cell);
+            Py_DECREF(py_inv_cell);
+            return NULL;
+        }
+    }
+
+    PyObject *py_ret = NULL;
+    npy_intp nframes = nd == 3 ? PyArray_DIM(dr_arr, 0) : 1;
+    npy_intp npairs = PyArray_DIM(dr_arr, nd-2);
+    int cell_nd = PyArray_NDIM((PyArrayObject *) py_cell);
+    npy_bool all_periodic[3] = { 1, 1, 1 };
+
+    if (PyArray_DIM((PyArrayObject *) py_cell, cell_nd-2) != 3 ||
+        PyArray_DIM((PyArrayObject *) py_cell, cell_nd-1) != 3 ||
+        (cell_nd == 3 && (nd != 3 ||
+                          PyArray_DIM((PyArrayObject *) py_cell, 0) !=
+                          nframes))) {
+        PyErr_SetString(PyExc_ValueError, "Please provide a single 3x3 cell "
+                        "or one cell per frame.");
+        goto fail;
+    }
+    if (!PyArray_SAMESHAPE((PyArrayObject *) py_cell,
+                           (PyArrayObject *) py_inv_cell)) {
+        PyErr_SetString(PyExc_ValueError, "Cells and inverse cells must "
+                        "have the same shape.");
+        goto fail;
+    }
+    if (py_pbc && PyArray_DIM((PyArrayObject *) py_pbc, 0) != 3) {
+        PyErr_SetString(PyExc_ValueError, "Periodic boundary conditions "
+                        "need to be given for all three directions.");
+        goto fail;
+    }
+
+    npy_double *dr = PyArray_DATA(dr_arr);
+    npy_double *cell = PyArray_DATA((PyArrayObject *) py_cell);
+    npy_double *inv_cell = PyArray_DATA((PyArrayObject *) py_inv_cell);
+    npy_bool *pbc = py_pbc ? PyArray_DATA((PyArrayObject *) py_pbc) :
+        all_periodic;
+    npy_intp f;
+
+    Py_BEGIN_ALLOW_THREADS
+    for (f = 0; f < nframes; f++) {
+        npy_intp c = cell_nd == 3 ? 9*f : 0;
+        mic_frame(dr + 3*npairs*f, npairs, cell + c, inv_cell + c, pbc);
+    }
+    Py_END_ALLOW_THREADS
+
+    Py_INCREF(Py_None);
+    py_ret = Py_None;
+
+    fail:
+    Py_DECREF(py_cell);
+    Py_DECREF(py_inv_cell);
+    Py_XDECREF(py_pbc);
+    return py_ret;
 }
 
 /*
@@ -532,8 +2891,17 @@ py_neighbour_list(PyObject *self, PyObject *args)
  */
 
 static PyMethodDef module_methods[] = {
-    { "neighbour_list", (PyCFunction) py_neighbour_list, METH_VARARGS,
+    { "neighbour_list", (PyCFunction) py_neighbour_list,
+      METH_VARARGS | METH_KEYWORDS,
       "Compute a neighbour list for an atomic configuration." },
+    { "triplet_list", (PyCFunction) py_triplet_list,
+      METH_VARARGS | METH_KEYWORDS,
+      "Compute triplets from a neighbour list." },
+    { "atomic_strain_sums", (PyCFunction) py_atomic_strain_sums,
+      METH_VARARGS | METH_KEYWORDS,
+      "Sum outer products of distance vectors for each atom." },
+    { "mic", (PyCFunction) py_mic, METH_VARARGS | METH_KEYWORDS,
+      "Apply the minimum image convention to distance vectors in place." },
     { NULL, NULL, 0, NULL }  /* Sentinel */
 };
 
@@ -553,8 +2921,14 @@ init_matscipy(void)
 
     import_array();
 
+    if (PyType_Ready(&cell_list_type) < 0)
+        return;
+
     m = Py_InitModule3("_matscipy", module_methods,
                        "C support functions for matscipy.");
     if (m == NULL)
         return;
+
+    Py_INCREF(&cell_list_type);
+    PyModule_AddObject(m, "CellList", (PyObject *) &cell_list_type);
 }
@@ -25,8 +25,11 @@ displacements.
 See: Falk, Langer, Phys. Rev. B 57, 7192 (1998)
 """
 
+import multiprocessing
+
 import numpy as np
 
+import _matscipy
 from matscipy.neighbours import mic, neighbour_list
 
 ###
@@ -35,15 +38,9 @@ def get_XIJ(nat, i_now, dr_now, dr_old):
     """
     Calculates the X_{ij} matrix
     """
-    # Do an element-wise outer product
-    dr_dr = dr_now.reshape(-1,3,1)*dr_old.reshape(-1,1,3)
-
-    xij = np.zeros([nat,3,3])
-    for i in range(3):
-        for j in range(3):
-            # For each atom, sum over all neighbors
-            xij[:,i,j] = np.bincount(i_now, weights=dr_dr[:,i,j])
-
+    # For each atom, sum the outer products over all neighbors
+    xij, yij = _matscipy.atomic_strain_sums(nat, i_now, dr_now, dr_old,
+                                            yij=False)
     return xij
 
 
@@ -51,60 +48,105 @@ def get_YIJ(nat, i_now, dr_old):
     """
     Calculates the Y_{ij} matrix
     """
-    # Just do an element-wise outer product
-    dr_dr = dr_old.reshape(-1,3,1)*dr_old.reshape(-1,1,3)
+    # For each atom, sum the outer products over all neighbors
+    xij, yij = _matscipy.atomic_strain_sums(nat, i_now, None, dr_old)
+    return yij
 
-    yij = np.zeros([nat,3,3])
-    for i in range(3):
-        for j in range(3):
-            # For each atom, sum over all neighbors
-            yij[:,i,j] = np.bincount(i_now, weights=dr_dr[:,i,j])
 
-    return yij
+def get_XIJ_YIJ(nat, i_now, dr_now, dr_old):
+    """
+    Calculates the X_{ij} and Y_{ij} matrices in a single sweep over all
+    pairs
+    """
+    return _matscipy.atomic_strain_sums(nat, i_now, dr_now, dr_old)
 
 
 def array_inverse(A):
     """
     Compute inverse for each matrix in a list of matrices.
-    This is faster than calling numpy.linalg.inv for each matrix.
+    3x3 matrices are inverted in closed form, i.e. as adjugate over
+    determinant, for all matrices at once. Other sizes use numpy's batched
+    inverse. Raises numpy.linalg.LinAlgError if any of the matrices is
+    singular, the error message lists their indices.
     """
-    A = np.ascontiguousarray(A, dtype=float)
-    b = np.identity(A.shape[2], dtype=A.dtype)
-
-    n_eq = A.shape[1]
-    n_rhs = A.shape[2]
-    pivots = np.zeros(n_eq, np.intc)
-    identity = np.eye(n_eq)
-    def lapack_inverse(a):
-        b = np.copy(identity)
-        pivots = np.zeros(n_eq, np.intc)
-        results = np.linalg.lapack_lite.dgesv(n_eq, n_rhs, a, n_eq, pivots, b,
-                                              n_eq, 0)
-        if results['info'] > 0:
-            raise np.linalg.LinAlgError('Singular matrix')
-        return b
-
-    return np.array([lapack_inverse(a) for a in A])
+    A = np.asarray(A, dtype=float)
+
+    if A.shape[1:] != (3, 3):
+        singular = np.linalg.matrix_rank(A) < A.shape[1]
+        if singular.any():
+            raise np.linalg.LinAlgError('Singular matrix for indices {0}'
+                                        .format(np.nonzero(singular)[0]))
+        return np.linalg.inv(A)
+
+    # Columns of the adjugate are the cross products of the rows
+    a0, a1, a2 = A[:, 0, :], A[:, 1, :], A[:, 2, :]
+    adj = np.empty_like(A)
+    adj[:, :, 0] = np.cross(a1, a2)
+    adj[:, :, 1] = np.cross(a2, a0)
+    adj[:, :, 2] = np.cross(a0, a1)
+    det = np.sum(a0*adj[:, :, 0], axis=1)
+
+    # The determinant vanishes relative to the product of the row norms
+    # (Hadamard's bound) for singular matrices
+    norm = np.sqrt(np.sum(A*A, axis=2))
+    singular = np.abs(det) <= 1e3*np.finfo(float).eps*np.prod(norm, axis=1)
+    if singular.any():
+        raise np.linalg.LinAlgError('Singular matrix for indices {0}'
+                                    .format(np.nonzero(singular)[0]))
+
+    return adj/det.reshape(-1, 1, 1)
 
 
 def get_delta_plus_epsilon_dgesv(nat, i_now, dr_now, dr_old):
     """
     Calculate delta_ij+epsilon_ij, i.e. the deformation gradient matrix
     """
-    XIJ = get_XIJ(nat, i_now, dr_now, dr_old)
-    YIJ = get_YIJ(nat, i_now, dr_old)
+    XIJ, YIJ = get_XIJ_YIJ(nat, i_now, dr_now, dr_old)
 
     YIJ_invert = array_inverse(YIJ)
 
     # Perform sum_k X_ik Y_jk^-1
-    epsilon = np.sum(XIJ.reshape(-1,3,1,3)*YIJ_invert.reshape(-1,1,3,3), axis=3)
+    epsilon = np.einsum('nik,njk->nij', XIJ, YIJ_invert)
 
     return epsilon
 
 
-def get_delta_plus_epsilon(nat, i_now, dr_now, dr_old):
+def array_pinv_symmetric(A, rcond=1e-12):
+    """
+    Compute the pseudo-inverse of each symmetric matrix in a list of
+    matrices from their eigendecompositions. Eigenvalues smaller than rcond
+    times the largest eigenvalue of the same matrix are treated as zero.
+    """
+    w, v = np.linalg.eigh(A)
+    wmax = np.abs(w).max(axis=1).reshape(-1, 1)
+    nonzero = np.abs(w) > rcond*wmax
+    inv_w = np.where(nonzero, 1.0/np.where(nonzero, w, 1.0), 0.0)
+    return np.einsum('nik,nk,njk->nij', v, inv_w, v)
+
+
+def get_delta_plus_epsilon(nat, i_now, dr_now, dr_old, rcond=1e-12):
     """
     Calculate delta_ij+epsilon_ij, i.e. the deformation gradient matrix
+
+    This is the least-squares solution for each atom, computed for all atoms
+    at once from the normal equations: X_{ij} Y_{jk}^+, where Y^+ is the
+    pseudo-inverse of Y. As for numpy.linalg.lstsq, the minimum norm solution
+    is returned for atoms whose neighbours do not span all three directions,
+    e.g. at surfaces. Singular values of the neighbour distances below
+    sqrt(rcond) times the largest one are treated as zero. Cost is linear in
+    the number of pairs.
+    """
+    XIJ, YIJ = get_XIJ_YIJ(nat, i_now, dr_now, dr_old)
+
+    return np.einsum('nik,njk->nij', XIJ, array_pinv_symmetric(YIJ, rcond))
+
+
+def get_delta_plus_epsilon_lstsq(nat, i_now, dr_now, dr_old):
+    """
+    Calculate delta_ij+epsilon_ij, i.e. the deformation gradient matrix
+
+    Reference implementation that calls numpy.linalg.lstsq for each atom.
+    Cost is quadratic in the number of atoms.
     """
     epsilon = []
     for i in range(nat):
@@ -130,8 +172,10 @@ def get_D_square_min(atoms_now, atoms_old, i_now, j_now, delta_plus_epsilon=None
     # are calculated from the sheared cell while these distance need to come
     # from the unsheared cell. Taking the distance from the unsheared cell
     # make periodic boundary conditions (and flipping of cell) a lot easier.
-    dr_now = mic(pos_now[i_now] - pos_now[j_now], atoms_now.cell)
-    dr_old = mic(pos_old[i_now] - pos_old[j_now], atoms_old.cell)
+    dr_now = mic(pos_now[i_now] - pos_now[j_now], atoms_now.cell,
+                 in_place=True)
+    dr_old = mic(pos_old[i_now] - pos_old[j_now], atoms_old.cell,
+                 in_place=True)
 
     # Sanity check: Shape needs to be identical!
     assert dr_now.shape == dr_old.shape
@@ -140,6 +184,16 @@ def get_D_square_min(atoms_now, atoms_old, i_now, j_now, delta_plus_epsilon=None
         # Get minimum strain tensor
         delta_plus_epsilon = get_delta_plus_epsilon(nat, i_now, dr_now, dr_old)
 
+    residual = get_residual(nat, i_now, dr_now, dr_old, delta_plus_epsilon)
+
+    return delta_plus_epsilon, residual
+
+
+def get_residual(nat, i_now, dr_now, dr_old, delta_plus_epsilon):
+    """
+    Calculate the residual of the least squares fit, i.e. D^2_min, from the
+    distance vectors and the deformation gradient matrix
+    """
     # Spread epsilon out for each neighbor index
     delta_plus_epsilon_n = delta_plus_epsilon[i_now]
 
@@ -153,9 +207,7 @@ def get_D_square_min(atoms_now, atoms_old, i_now, j_now, delta_plus_epsilon=None
         axis=1)
 
     # For each atom, sum over all neighbors
-    residual = np.bincount(i_now, weights=residual_n)
-
-    return delta_plus_epsilon, residual
+    return np.bincount(i_now, weights=residual_n, minlength=nat)
 
 
 def atomic_strain(atoms_now, atoms_old, cutoff=None, neighbours=None):
@@ -201,3 +253,122 @@ def atomic_strain(atoms_now, atoms_old, cutoff=None, neighbours=None):
                                                     j_now)
 
     return delta_plus_epsilon, residual
+
+
+class AtomicStrainAnalyzer(object):
+    """
+    Calculate deformation gradient tensor and D^2_min measure for many
+    configurations against a single reference configuration.
+
+    Neighbours are taken from the reference configuration. The neighbour
+    list, the reference distance vectors and the pseudo-inverse of Y_{ij}
+    only depend on the reference and are computed once. Note that
+    :func:`atomic_strain` computes neighbours from the current
+    configuration instead.
+
+    Parameters:
+    -----------
+    reference : ase.Atoms
+        Reference atomic configuration
+    cutoff : float
+        Neighbor list cutoff.
+    neighbours : ( array_like, array_like )
+        Neighbor list. Automatically computed if not provided.
+    rcond : float
+        Cutoff for small eigenvalues of Y_{ij}, see
+        :func:`get_delta_plus_epsilon`.
+    """
+
+    def __init__(self, reference, cutoff=None, neighbours=None, rcond=1e-12):
+        if neighbours is None:
+            if cutoff is None:
+                raise ValueError('Please provide either neighbor list or '
+                                 'neighbor list cutoff.')
+            i, j = neighbour_list("ij", reference, cutoff)
+        elif cutoff is not None:
+            raise ValueError('Please provide either neighbor list or neighbor '
+                             'list cutoff, not both.')
+        else:
+            i, j = neighbours
+
+        self.nat = len(reference)
+        self.i = np.asarray(i)
+        self.j = np.asarray(j)
+
+        pos_old = reference.positions
+        self.dr_old = mic(pos_old[self.i] - pos_old[self.j], reference.cell,
+                          in_place=True)
+        self.YIJ_pinv = array_pinv_symmetric(
+            get_YIJ(self.nat, self.i, self.dr_old), rcond)
+
+    def __call__(self, atoms_now):
+        """
+        Calculate deformation gradient tensor and D^2_min measure of a single
+        configuration.
+
+        Returns:
+        --------
+        delta_plus_epsilon : array
+            3x3 deformation gradient tensor for each atom.
+        residual : array
+            D^2_min norm for each atom
+        """
+        if len(atoms_now) != self.nat:
+            raise ValueError('Configuration has {0} atoms, reference has {1}.'
+                             .format(len(atoms_now), self.nat))
+
+        pos_now = atoms_now.positions
+        dr_now = mic(pos_now[self.i] - pos_now[self.j], atoms_now.cell,
+                     in_place=True)
+
+        XIJ = get_XIJ(self.nat, self.i, dr_now, self.dr_old)
+        delta_plus_epsilon = np.einsum('nik,njk->nij', XIJ, self.YIJ_pinv)
+        residual = get_residual(self.nat, self.i, dr_now, self.dr_old,
+                                delta_plus_epsilon)
+
+        return delta_plus_epsilon, residual
+
+    def iterate(self, frames, processes=None, chunksize=1):
+        """
+        Analyze a sequence of configurations, e.g. a trajectory.
+
+        Parameters:
+        -----------
+        frames : iterable of ase.Atoms
+            Configurations. This can be a generator, frames are read as they
+            are analyzed.
+        processes : int
+            Number of worker processes. Frames are analyzed in the calling
+            process if this is None.
+        chunksize : int
+            Number of frames sent to a worker process at once.
+
+        Returns:
+        --------
+        Iterator over (delta_plus_epsilon, residual) of each frame, in
+        order of the frames.
+        """
+        if processes is None:
+            for atoms_now in frames:
+                yield self(atoms_now)
+            return
+
+        # Each worker receives the cached reference data only once
+        pool = multiprocessing.Pool(processes, _init_worker, (self,))
+        try:
+            for retval in pool.imap(_analyze_frame, frames, chunksize):
+                yield retval
+        finally:
+            pool.terminate()
+            pool.join()
+
+
+_worker_analyzer = None
+
+def _init_worker(analyzer):
+    global _worker_analyzer
+    _worker_analyzer = analyzer
+
+
+def _analyze_frame(atoms_now):
+    return _worker_analyzer(atoms_now)
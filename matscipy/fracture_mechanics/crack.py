@@ -30,10 +30,10 @@ except ImportError:
     warnings.warn('Warning: no scipy')
 
 import ase.units as units
-from ase.calculators.neighborlist import NeighborList    
 
 from matscipy.elasticity import (rotate_elastic_constants,
                                  rotate_cubic_elastic_constants)
+from matscipy.neighbours import neighbour_list
 from matscipy.surface import MillerDirection, MillerPlane
 
 ###
@@ -954,12 +954,7 @@ def find_tip_coordination(a, bondlength=2.6, bulk_nn=4):
     """
     Find position of tip in crack cluster from coordination
     """
-    nl = NeighborList([bondlength/2.0]*len(a),
-                      skin=0.0,
-                      self_interaction=False,
-                      bothways=True)
-    nl.update(a)
-    nn = np.array([len(nl.get_neighbors(i)[0]) for i in range(len(a))])
+    nn = neighbour_list('N', a, bondlength)
     a.set_array('n_neighb', nn)
     g = a.get_array('groups')
 
@@ -5,7 +5,8 @@ from ase.calculators.calculator import Calculator
 from ase.constraints import FixAtoms
 from ase.lattice.spacegroup.cell import cellpar_to_cell
 
-from matscipy.neighbours import neighbour_list
+from matscipy.neighbours import (neighbour_list, NeighbourList,
+                                  scatter_pair_energies, scatter_pair_forces)
 from matscipy.fracture_mechanics.crack import (ConstantStrainRate,
                                                get_strain)
 
@@ -41,44 +42,52 @@ class IdealBrittleSolid(Calculator):
                           'rc': 1.01, # cutoff
                           'k': 1.0, # spring constant
                           'beta': 0.01, # Kelvin dissipation
-                          'b': 0.01 # Stokes dissipation
+                          'b': 0.01, # Stokes dissipation
+                          'skin': 0.1 # Verlet skin of the neighbour list
                           }
 
+    def __init__(self, *args, **kwargs):
+        Calculator.__init__(self, *args, **kwargs)
+        self.nl = None
+
     def set_reference_crystal(self, crystal):
         rc = self.parameters['rc']
         self.crystal = crystal.copy()
-        i = neighbour_list('i', self.crystal, rc)
-        self.crystal_bonds = len(i)
+        self.crystal_bonds = neighbour_list('N', self.crystal, rc,
+                                            half_list=True).sum()
 
     def calculate(self, atoms, properties, system_changes):
         a = self.parameters['a']
         rc = self.parameters['rc']
         k = self.parameters['k']
         beta = self.parameters['beta']
+        skin = self.parameters['skin']
+
+        if self.nl is None or self.nl.cutoff != rc or self.nl.skin != skin:
+            self.nl = NeighbourList(rc, skin, half_list=True)
 
         energies = np.zeros(len(atoms))
         forces = np.zeros((len(atoms), 3))
         velocities = (atoms.get_momenta().T/atoms.get_masses()).T
                 
-        i, j, dr, r = neighbour_list('ijDd', atoms, rc)
+        i, j, dr, r = self.nl.neighbour_list('ijDd', atoms)
         if len(i) > 0:
             dr_hat = (dr.T/r).T
             dv = velocities[j] - velocities[i]
 
             de = 0.5*k*(r - a)**2 # spring energies
-            e = 0.5*de # half goes to each end of spring
             f = (k*(r - a)*dr_hat.T).T + beta*dv
 
-            energies[:] = np.bincount(i, e)            
-            for kk in range(3):
-                forces[:, kk] = np.bincount(i, weights=f[:, kk])
+            # half goes to each end of spring
+            energies[:] = scatter_pair_energies(len(atoms), i, j, de)
+            forces[:] = scatter_pair_forces(len(atoms), i, j, f)
 
         energy = energies.sum()
             
         # add energy 0.5*k*(rc - a)**2 for each broken bond
         if len(i) < self.crystal_bonds:
             de = 0.5*k*(rc - a)**2
-            energy += 0.5*de*(self.crystal_bonds - len(i))
+            energy += de*(self.crystal_bonds - len(i))
 
         # Stokes dissipation
         if 'stokes' in atoms.arrays:
@@ -141,8 +150,7 @@ def find_crack_tip(atoms, dt=None, store=True, results=None):
     a = calc.parameters['a']
     rc = calc.parameters['rc']
     
-    i = neighbour_list('i', atoms, rc)
-    nn = np.bincount(i) # number of nearest neighbours, equal to 6 in bulk
+    nn = neighbour_list('N', atoms, rc) # number of nearest neighbours, equal to 6 in bulk
     
     x = atoms.positions[:, 0]
     y = atoms.positions[:, 1]
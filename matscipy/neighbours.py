@@ -23,42 +23,124 @@ import itertools
 
 import numpy as np
 
+from ase.data import atomic_numbers
+
 import _matscipy 
 
 ###
 
-def mic(dr, cell, pbc=None):
+def mic(dr, cell, pbc=None, inv_cell=None, in_place=False):
     """
     Apply minimum image convention to an array of distance vectors.
 
     Parameters
     ----------
     dr : array_like
-        Array of distance vectors.
+        Array of distance vectors, shape (npairs, 3). Distance vectors of
+        several frames can be stacked, shape (nframes, npairs, 3).
     cell : array_like
-        Simulation cell.
+        Simulation cell, rows are the lattice vectors. For stacked frames
+        this can also be one cell per frame, shape (nframes, 3, 3).
     pbc : array_like, optional
-        Periodic boundary conditions in x-, y- and z-direction. Default is to
-        assume periodic boundaries in all directions.
+        Periodic boundary conditions along the three lattice vectors.
+        Default is to assume periodic boundaries in all directions.
+    inv_cell : array_like, optional
+        Precomputed inverse of cell (or of each cell), avoids inverting the
+        cell on each call.
+    in_place : bool, optional
+        Wrap dr in place, without allocating. dr must then be a C-contiguous
+        array of doubles. Default is False.
 
     Returns
     -------
     dr : array
         Array of distance vectors, wrapped according to the minimum image
-        convention.
+        convention. This is dr itself if in_place is set.
+
+    Notes
+    -----
+    The distance vectors are wrapped in C. Orthorhombic cells take a fast
+    path that does not need the inverse cell.
     """
-    # Check where distance larger than 1/2 cell. Particles have crossed
-    # periodic boundaries then and need to be unwrapped.
-    rec = np.linalg.inv(cell)
+    if in_place:
+        if not isinstance(dr, np.ndarray):
+            raise TypeError('Distance vectors must be an array to be wrapped '
+                            'in place.')
+    else:
+        dr = np.array(dr, dtype=float, order='C')
+    cell = np.asarray(cell, dtype=float)
+    if inv_cell is None:
+        inv_cell = np.linalg.inv(cell)
     if pbc is not None:
-        rec *= np.array(pbc, dtype=int).reshape(3,1)
-    dri = np.round(np.dot(dr, rec))
+        pbc = np.asarray(pbc, dtype=bool)
+    _matscipy.mic(dr, cell, inv_cell, pbc)
+    return dr
+
+
+def _cutoff_arguments(a, cutoff):
+    """
+    Translate a cutoff specification into the maximum cutoff, which is used
+    for binning, and the keyword arguments that pass per-pair cutoffs to the
+    C kernel.
+    """
+    if isinstance(cutoff, dict):
+        elements, types = np.unique(a.numbers, return_inverse=True)
+        pair_cutoffs = np.zeros((len(elements), len(elements)))
+        for (el1, el2), c in cutoff.items():
+            z1 = atomic_numbers.get(el1, el1)
+            z2 = atomic_numbers.get(el2, el2)
+            if z1 in elements and z2 in elements:
+                k1 = np.searchsorted(elements, z1)
+                k2 = np.searchsorted(elements, z2)
+                pair_cutoffs[k1, k2] = pair_cutoffs[k2, k1] = c
+        max_cutoff = pair_cutoffs.max() if len(elements) > 0 else 0.0
+        kwargs = dict(types=types, pair_cutoffs=pair_cutoffs)
+    elif np.ndim(cutoff) > 0:
+        radii = np.asarray(cutoff, dtype=float)
+        if radii.shape != (len(a),):
+            raise ValueError('Please provide one radius per atom.')
+        max_cutoff = 2*radii.max() if len(a) > 0 else 0.0
+        kwargs = dict(radii=radii)
+    else:
+        return cutoff, {}
 
-    # Unwrap
-    return dr - np.dot(dri, cell)
+    # All pair cutoffs are zero. There are no neighbours, but the kernel
+    # still needs a positive cutoff for binning.
+    if max_cutoff <= 0.0:
+        max_cutoff = 1.0
+    return max_cutoff, kwargs
 
 
-def neighbour_list(quantities, a, cutoff):
+def _pair_cutoffs(a, cutoff, i, j):
+    """
+    Cutoff of each pair i, j. Scalar if all pairs have the same cutoff.
+    """
+    if isinstance(cutoff, dict):
+        max_cutoff, kwargs = _cutoff_arguments(a, cutoff)
+        types = kwargs['types']
+        return kwargs['pair_cutoffs'][types[i], types[j]]
+    elif np.ndim(cutoff) > 0:
+        radii = np.asarray(cutoff, dtype=float)
+        return radii[i] + radii[j]
+    else:
+        return cutoff
+
+
+def _add_skin(cutoff, skin):
+    """
+    Increase each pair cutoff by skin.
+    """
+    if isinstance(cutoff, dict):
+        return dict((key, c+skin) for key, c in cutoff.items())
+    elif np.ndim(cutoff) > 0:
+        return np.asarray(cutoff, dtype=float) + 0.5*skin
+    else:
+        return cutoff + skin
+
+
+def neighbour_list(quantities, a, cutoff, num_threads=1, half_list=False,
+                   out=None, contiguous_bins=True, nbins=100, float_type=None,
+                   int_type=None):
     """
     Compute a neighbour list for an atomic configuration.
 
@@ -74,18 +156,829 @@ def neighbour_list(quantities, a, cutoff):
             'D' : distance vector
             'S' : shift vector (number of cell boundaries crossed by the bond
                   between atom i and j)
+            'p' : offsets of the neighbours of each atom (array of length
+                  len(a)+1). Pairs are sorted by the first atom index, the
+                  neighbours of atom n are pairs p[n] to p[n+1]-1.
+            'N' : number of neighbours of each atom (array of length
+                  len(a))
+            'h' : histogram of pair distances with nbins bins of equal
+                  width between zero and the (maximum) cutoff
+        The reductions 'N' and 'h' are accumulated during the pair search.
+        If only they are requested, no pairs are stored.
     a : ase.Atoms
         Atomic configuration.
-    cutoff : float
-        Cutoff for neighbour search.
+    cutoff : float or array_like or dict
+        Cutoff for neighbour search. This can be
+            float : a single cutoff for all pairs
+            array_like : a radius for each atom, the cutoff of a pair is
+                         the sum of the radii of both atoms
+            dict : a cutoff for each pair of elements, e.g.
+                   {(8, 14): 1.8, ('Si', 'Si'): 2.6}. Pairs of elements
+                   that are not listed have no neighbours.
+        Atoms are binned with the largest cutoff, each pair is then tested
+        against its own cutoff.
+    num_threads : int, optional
+        Number of threads used for the pair search. Atoms are split into
+        contiguous blocks, one per thread. The result is identical to the
+        serial search. Default is 1.
+    half_list : bool, optional
+        Store each pair only once, with i < j. Of the periodic images of an
+        atom with itself (i == j), only those whose shift vector has a
+        positive first nonzero component are stored. Default is False.
+    out : dict, optional
+        Reusable output buffers. Returned arrays are views of buffers stored
+        in this dictionary under the name of the quantity. Buffers that are
+        missing or too small are replaced by new ones with some headroom.
+        Passing the same dictionary to repeated calls avoids reallocating
+        the output, but each call overwrites the results of the previous
+        one.
+    contiguous_bins : bool, optional
+        Store the atoms of each bin contiguously, together with a copy of
+        their positions, instead of in linked lists. This improves memory
+        locality of the pair search, results are identical. Default is True.
+    nbins : int, optional
+        Number of bins of the distance histogram 'h'. Default is 100.
+    float_type : dtype, optional
+        Type of the distances 'D' and 'd', numpy.float32 or numpy.float64.
+        Distances are always computed and tested against the cutoff in
+        double precision, float32 only rounds the stored values. Default is
+        numpy.float64.
+    int_type : dtype, optional
+        Type of the indices 'i', 'j', 'S' and 'f', numpy.int32 or
+        numpy.int64. Default is numpy.intc. The offsets 'p' are always of
+        type numpy.intp and can hence address more than 2**31 pairs.
 
     Returns
     -------
     i, j, ... : array
         Tuple with arrays for each quantity specified above.
+
+    Notes
+    -----
+    The global interpreter lock is released while atoms are binned and pairs
+    are searched. Neighbour lists for different configurations can hence be
+    built concurrently from several Python threads.
     """
 
+    max_cutoff, kwargs = _cutoff_arguments(a, cutoff)
     return _matscipy.neighbour_list(quantities, a.cell,
-                                    np.linalg.inv(a.cell.T).T, a.pbc,
-                                    a.positions, cutoff)
+                                    np.linalg.inv(a.cell.T), a.pbc,
+                                    a.positions, max_cutoff,
+                                    num_threads=num_threads,
+                                    half_list=half_list, out=out,
+                                    contiguous_bins=contiguous_bins,
+                                    nbins=nbins, float_type=float_type,
+                                    int_type=int_type, **kwargs)
+
+
+def neighbour_list_trajectory(quantities, frames, cutoff, positions=None,
+                              cells=None, num_threads=1, half_list=False,
+                              out=None, nbins=100, float_type=None,
+                              int_type=None):
+    """
+    Compute the neighbour lists of all frames of a trajectory in a single
+    call. Frames are processed in parallel by the C kernel.
+
+    Parameters
+    ----------
+    quantities : str
+        Quantities to compute, see :func:`neighbour_list`. Additionally
+            'f' : frame index
+        is available. The offsets 'p' have length nframes*nat+1, atom n of
+        frame f has the neighbours p[f*nat+n] to p[f*nat+n+1]-1. Likewise,
+        'N' has length nframes*nat. The histogram 'h' sums over all frames.
+    frames : list of ase.Atoms or ase.Atoms
+        Atomic configurations. All frames must have the same number of
+        atoms, atomic numbers and periodicity. If positions are given, this
+        is a single configuration that supplies atomic numbers, periodicity
+        and, unless cells are given, the cell.
+    cutoff : float or array_like or dict
+        Cutoff for neighbour search, see :func:`neighbour_list`.
+    positions : array_like, optional
+        Stacked positions of all frames, shape (nframes, nat, 3).
+    cells : array_like, optional
+        Stacked cells of all frames, shape (nframes, 3, 3). Only used
+        together with positions.
+    num_threads : int, optional
+        Number of threads. Default is 1.
+    half_list : bool, optional
+        Store each pair only once, see :func:`neighbour_list`.
+    out : dict, optional
+        Reusable output buffers, see :func:`neighbour_list`.
+    nbins : int, optional
+        Number of bins of the distance histogram 'h'. Default is 100.
+    float_type, int_type : dtype, optional
+        Types of distances and indices, see :func:`neighbour_list`.
+
+    Returns
+    -------
+    f, i, j, ... : array
+        Tuple with arrays for each quantity specified above. Pairs of all
+        frames are concatenated in order of the frames, atom indices refer
+        to the atoms within a frame.
+    """
+
+    if positions is None:
+        a = frames[0]
+        positions = np.array([b.positions for b in frames])
+        cells = np.array([np.asarray(b.cell) for b in frames])
+    else:
+        a = frames
+        if cells is None:
+            cells = a.cell
+    cells = np.asarray(cells, dtype=float)
+
+    max_cutoff, kwargs = _cutoff_arguments(a, cutoff)
+    return _matscipy.neighbour_list(quantities, cells,
+                                    np.linalg.inv(np.swapaxes(cells, -1, -2)),
+                                    a.pbc, positions, max_cutoff,
+                                    num_threads=num_threads,
+                                    half_list=half_list, out=out, nbins=nbins,
+                                    float_type=float_type, int_type=int_type,
+                                    **kwargs)
+
+
+def iter_neighbour_chunks(quantities, a, cutoff, chunk_atoms=100000,
+                          num_threads=1, half_list=False, out=None,
+                          float_type=None, int_type=None):
+    """
+    Iterate over the neighbour list of an atomic configuration in chunks of
+    central atoms. Atoms are binned once, each chunk is then searched
+    separately. Only the pairs of a single chunk are held in memory, which
+    allows reductions such as coordination numbers or per-atom stresses to
+    be computed block by block for systems whose full neighbour list does
+    not fit into memory.
+
+    Parameters
+    ----------
+    quantities : str
+        Quantities to compute, see :func:`neighbour_list`. The offsets 'p'
+        refer to the atoms of the chunk, i.e. they have length
+        stop-start+1 and the neighbours of atom start+n are pairs p[n] to
+        p[n+1]-1 of the chunk.
+    a : ase.Atoms
+        Atomic configuration.
+    cutoff : float or array_like or dict
+        Cutoff for neighbour search, see :func:`neighbour_list`.
+    chunk_atoms : int, optional
+        Number of central atoms per chunk. Chunk k contains the pairs of
+        atoms k*chunk_atoms to (k+1)*chunk_atoms-1. Default is 100000.
+    num_threads : int, optional
+        Number of threads used for the search of each chunk. Default is 1.
+    half_list : bool, optional
+        Store each pair only once, see :func:`neighbour_list`. A pair is
+        returned with the chunk of its smaller atom index.
+    out : dict, optional
+        Reusable output buffers, see :func:`neighbour_list`. Each chunk then
+        overwrites the arrays of the previous one.
+    float_type, int_type : dtype, optional
+        Types of distances and indices, see :func:`neighbour_list`.
+
+    Returns
+    -------
+    Iterator over tuples with arrays for each quantity specified above.
+    Atom indices refer to the full configuration. Concatenating all chunks
+    yields all pairs sorted by the first atom index.
+    """
+
+    if chunk_atoms < 1:
+        raise ValueError('Chunks must contain at least one atom.')
+
+    max_cutoff, kwargs = _cutoff_arguments(a, cutoff)
+    cell_list = _matscipy.CellList(a.cell, np.linalg.inv(a.cell.T), a.pbc,
+                                   a.positions, max_cutoff)
+    for start in range(0, len(a), chunk_atoms):
+        central_atoms = np.arange(start, min(start+chunk_atoms, len(a)))
+        yield cell_list.neighbours(quantities, central_atoms,
+                                   num_threads=num_threads,
+                                   half_list=half_list, out=out,
+                                   float_type=float_type, int_type=int_type,
+                                   **kwargs)
+
+
+def first_neighbours(nat, i):
+    """
+    Compute the offsets of the neighbours of each atom from the first atom
+    index of a neighbour list sorted by i. This is the 'p' quantity of
+    :func:`neighbour_list`.
+
+    Parameters
+    ----------
+    nat : int
+        Number of atoms.
+    i : array_like
+        First atom index of each pair, sorted.
+
+    Returns
+    -------
+    seed : array
+        Array of length nat+1. The neighbours of atom n are pairs seed[n]
+        to seed[n+1]-1.
+    """
+    seed = np.zeros(nat+1, dtype=np.intp)
+    seed[1:] = np.cumsum(np.bincount(i, minlength=nat))
+    return seed
+
+
+def triplet_list(quantities, i, j, D, cutoff=None, p=None):
+    """
+    Compute triplets of atoms i, j, k from a neighbour list. A triplet
+    combines two different pairs ij and ik that share the first atom i.
+    Both orders of the second and third atom are returned.
+
+    Parameters
+    ----------
+    quantities : str
+        Quantities to compute. Each character in this string defines a
+        quantity. They are returned in a tuple of the same order. Possible
+        quantities are
+            'i' : central atom index
+            'j' : second atom index
+            'k' : third atom index
+            'a' : index of pair ij in the neighbour list
+            'b' : index of pair ik in the neighbour list
+            'c' : cosine of the angle between pairs ij and ik
+            't' : angle between pairs ij and ik (in radians)
+    i : array_like
+        First atom index of each pair, sorted.
+    j : array_like
+        Second atom index of each pair. The atom indices 'j' and 'k' of the
+        triplets have the same integer type, 'i', 'a' and 'b' are intp.
+    D : array_like
+        Distance vector of each pair.
+    cutoff : float, optional
+        Only pairs ik shorter than cutoff are used as the second leg of a
+        triplet. Default is to use all pairs.
+    p : array_like, optional
+        Offsets of the neighbours of each atom, i.e. the 'p' quantity of
+        :func:`neighbour_list`. Computed from i if omitted.
+
+    Returns
+    -------
+    i, j, k, ... : array
+        Tuple with arrays for each quantity specified above. Triplets are
+        sorted by pair ij.
+    """
+
+    if p is None:
+        i = np.asarray(i)
+        p = first_neighbours(np.max(i)+1 if len(i) > 0 else 0, i)
+    if cutoff is None:
+        cutoff = -1.0
+    return _matscipy.triplet_list(quantities, p, j, D, cutoff=cutoff)
+
+
+def _spread_bits(x):
+    """
+    Insert two zero bits between each of the lower 21 bits of x.
+    """
+    x = x.astype(np.uint64) & np.uint64(0x1fffff)
+    for shift, mask in [(32, 0x1f00000000ffff), (16, 0x1f0000ff0000ff),
+                        (8, 0x100f00f00f00f00f), (4, 0x10c30c30c30c30c3),
+                        (2, 0x1249249249249249)]:
+        x = (x | (x << np.uint64(shift))) & np.uint64(mask)
+    return x
+
+
+def spatial_sort(a, bin_size=2.0):
+    """
+    Order atoms along a space-filling (Morton or Z-order) curve. Atoms are
+    sorted into bins of roughly bin_size and bins are ordered along the
+    curve, such that atoms that are close in space are also close in
+    memory. Reordering a configuration with this permutation improves the
+    cache behaviour of the neighbour search and of scatter operations on
+    per-atom arrays.
+
+    Parameters
+    ----------
+    a : ase.Atoms
+        Atomic configuration.
+    bin_size : float, optional
+        Approximate edge length of a bin. Default is 2.0.
+
+    Returns
+    -------
+    permutation : array
+        Atom indices in curve order, i.e. a[permutation] is the sorted
+        configuration.
+    inverse : array
+        Inverse permutation, atom n of the original configuration is atom
+        inverse[n] of the sorted configuration.
+
+    Examples
+    --------
+    >>> permutation, inverse = spatial_sort(a)
+    >>> b = a[permutation]
+    >>> i, j = neighbour_list('ij', b, 3.0)
+    >>> i, j = permutation[i], permutation[j]  # Indices into a
+    """
+    cell = np.asarray(a.cell)
+    s = np.linalg.solve(cell.T, a.positions.T).T
+    # Wrap periodic directions, shift non-periodic ones into the first cell
+    for c in range(3):
+        if a.pbc[c]:
+            s[:, c] %= 1.0
+        elif len(a) > 0:
+            s[:, c] -= s[:, c].min()
+
+    # Number of bins from the distance of opposite cell faces
+    lengths = 1/np.sqrt(np.sum(np.linalg.inv(cell)**2, axis=0))
+    nbins = np.maximum(np.floor(lengths/bin_size), 1)
+    bins = np.clip(np.floor(s*nbins), 0, 2**21-1).astype(np.int64)
+
+    code = _spread_bits(bins[:, 0]) | \
+        (_spread_bits(bins[:, 1]) << np.uint64(1)) | \
+        (_spread_bits(bins[:, 2]) << np.uint64(2))
+    permutation = np.argsort(code, kind='mergesort')
+    inverse = np.empty_like(permutation)
+    inverse[permutation] = np.arange(len(permutation))
+    return permutation, inverse
+
+
+def scatter_pair_energies(nat, i, j, e):
+    """
+    Distribute pair energies of a half neighbour list onto atoms. Each atom
+    of a pair receives half of the pair energy.
+
+    Parameters
+    ----------
+    nat : int
+        Number of atoms.
+    i, j : array_like
+        First and second atom index of each pair.
+    e : array_like
+        Energy of each pair.
+
+    Returns
+    -------
+    energies : array
+        Energy of each atom.
+    """
+    return 0.5*(np.bincount(i, weights=e, minlength=nat) +
+                np.bincount(j, weights=e, minlength=nat))
+
+
+def scatter_pair_forces(nat, i, j, f):
+    """
+    Distribute pair forces of a half neighbour list onto atoms. Atom i of
+    a pair receives the force f, atom j the reaction force -f.
+
+    Parameters
+    ----------
+    nat : int
+        Number of atoms.
+    i, j : array_like
+        First and second atom index of each pair.
+    f : array_like
+        Force on atom i of each pair, shape (npairs, 3).
+
+    Returns
+    -------
+    forces : array
+        Force on each atom, shape (nat, 3).
+    """
+    forces = np.empty((nat, 3))
+    for k in range(3):
+        forces[:, k] = np.bincount(i, weights=f[:, k], minlength=nat) - \
+            np.bincount(j, weights=f[:, k], minlength=nat)
+    return forces
+
+
+class CellList(object):
+    """
+    Atoms sorted into bins, for repeated queries of the atoms near arbitrary
+    points. Bins are built once, when the object is created. Later changes
+    of the atomic configuration are not reflected.
+
+    Parameters
+    ----------
+    a : ase.Atoms
+        Atomic configuration.
+    cutoff : float
+        Bin size. Queries are most efficient for radii of about this size,
+        but any radius can be used.
+    num_threads : int, optional
+        Number of threads used for queries. Default is 1.
+    """
+
+    def __init__(self, a, cutoff, num_threads=1):
+        self.cutoff = cutoff
+        self.num_threads = num_threads
+        self.nat = len(a)
+        self.pbc = a.pbc.copy()
+        self.volume = abs(np.linalg.det(a.cell))
+        # Sphere that contains all atoms
+        if self.nat > 0:
+            self.center = (a.positions.min(axis=0) +
+                           a.positions.max(axis=0))/2
+            self.radius = np.sqrt(np.max(np.sum((a.positions -
+                                                 self.center)**2, axis=1)))
+        self._cell_list = _matscipy.CellList(a.cell, np.linalg.inv(a.cell.T),
+                                             a.pbc, a.positions, cutoff,
+                                             contiguous_bins=True)
+
+    def query_radius(self, points, r, quantities='ijd'):
+        """
+        Find all atoms within a radius of the query points.
+
+        Parameters
+        ----------
+        points : array_like
+            Query points, shape (npoints, 3).
+        r : float
+            Radius.
+        quantities : str, optional
+            Quantities to compute, see :func:`neighbour_list`. Here, 'i' is
+            the index of the query point and 'j' the index of the atom, 'D'
+            the vector from the point to the atom. 'p' and 'N' refer to the
+            query points. Default is 'ijd'.
+
+        Returns
+        -------
+        i, j, ... : array
+            Tuple with arrays for each quantity specified above, sorted by
+            query point.
+        """
+        points = np.asarray(points, dtype=float).reshape(-1, 3)
+        return self._cell_list.query(quantities, points, r,
+                                     num_threads=self.num_threads)
+
+    def query_knn(self, points, k, quantities='jd'):
+        """
+        Find the k nearest atoms of each query point. Periodic images of an
+        atom count as separate atoms.
+
+        Parameters
+        ----------
+        points : array_like
+            Query points, shape (npoints, 3).
+        k : int
+            Number of atoms to find.
+        quantities : str, optional
+            Quantities to compute, any of 'j' (atom index), 'D' (vector
+            from the point to the atom), 'd' (distance) and 'S' (shift
+            vector). Default is 'jd'.
+
+        Returns
+        -------
+        j, ... : array
+            Tuple with arrays for each quantity specified above, of shape
+            (npoints, k) or (npoints, k, 3). Atoms are sorted by distance
+            from the query point.
+        """
+        for q in quantities:
+            if q not in 'jDdS':
+                raise ValueError('Unsupported quantity specified.')
+        if k < 1:
+            raise ValueError('Please ask for at least one neighbour.')
+        if self.nat == 0:
+            raise ValueError('There are no atoms.')
+        if not self.pbc.any() and k > self.nat:
+            raise ValueError('There are only {0} atoms.'.format(self.nat))
+
+        points = np.asarray(points, dtype=float).reshape(-1, 3)
+        npoints = len(points)
+
+        # Without periodic images, all atoms are within this radius of every
+        # point and a larger radius finds no more atoms. Periodic systems
+        # have an unlimited number of images.
+        r_max = np.inf
+        if not self.pbc.any() and npoints > 0:
+            r_max = self.radius + np.sqrt(np.max(np.sum((points -
+                                                         self.center)**2,
+                                                        axis=1)))
+
+        # Start with the bin size, which keeps the search within adjacent
+        # bins, or a sphere that contains k atoms on average if this is
+        # larger. Double the radius for points that have fewer than k atoms
+        # within.
+        r = max(self.cutoff, (3*k*self.volume/(4*np.pi*self.nat))**(1./3))
+        retvals = [np.zeros((npoints, k, 3) if q in 'DS' else (npoints, k),
+                            dtype=float if q in 'Dd' else int)
+                   for q in quantities]
+        remaining = np.arange(npoints)
+        while len(remaining) > 0:
+            pairs = self._cell_list.query('idp' + quantities,
+                                          points[remaining], r,
+                                          num_threads=self.num_threads)
+            i, d, p = pairs[:3]
+            done = np.diff(p) >= k
+            if done.any():
+                # k nearest atoms of each point that has enough of them
+                mask = done[i]
+                order = np.nonzero(mask)[0][np.lexsort((d[mask], i[mask]))]
+                first = first_neighbours(len(remaining), i[order])[:-1]
+                nearest = order[(first[done].reshape(-1, 1) +
+                                 np.arange(k)).ravel()]
+                for retval, x in zip(retvals, pairs[3:]):
+                    retval[remaining[done]] = \
+                        x[nearest].reshape((-1,) + retval.shape[1:])
+            remaining = remaining[np.logical_not(done)]
+            if len(remaining) > 0 and r > r_max:
+                raise RuntimeError('Found fewer than {0} atoms within the '
+                                   'radius that contains all atoms.'
+                                   .format(k))
+            r *= 2
+
+        if len(retvals) == 1:
+            return retvals[0]
+        return tuple(retvals)
+
+
+def _concatenated_ranges(starts, stops):
+    """
+    Concatenation of the ranges starts[k] to stops[k]-1.
+    """
+    lengths = stops - starts
+    if len(lengths) == 0:
+        return np.zeros(0, dtype=int)
+    return np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + \
+        np.arange(np.sum(lengths))
+
+
+class NeighbourList(object):
+    """
+    Neighbour list that is only rebuilt when atoms have moved appreciably.
+
+    The list is built with a cutoff of `cutoff+skin`. It stays valid until an
+    atom has moved by more than half of the skin since the last build, or
+    until the number of atoms, the elements, the cell or the periodicity
+    change. In between, the stored pairs are filtered to `cutoff` and
+    distances are recomputed from the current positions.
+
+    If only a few atoms have moved too far, e.g. near a crack tip, the list is
+    updated incrementally: Only these atoms are re-binned and searched, their
+    pairs and the matching reverse entries of their neighbours are replaced.
+    The cost of the update is then proportional to the number of moved atoms.
+    Replaced pairs are masked and new pairs are kept separately until they
+    make up a sizeable fraction of the list, only then are the stored arrays
+    compacted.
+
+    Parameters
+    ----------
+    cutoff : float or array_like or dict
+        Cutoff for neighbour search. See :func:`neighbour_list`.
+    skin : float, optional
+        Verlet skin. Default is 0.3.
+    num_threads : int, optional
+        Number of threads used when the list is rebuilt. Default is 1.
+    half_list : bool, optional
+        Store each pair only once. See :func:`neighbour_list`. Default is
+        False.
+    max_moved : float, optional
+        Largest fraction of atoms that may have moved for an incremental
+        update. If more atoms have moved, the whole list is rebuilt. Set to
+        zero to disable incremental updates. Default is 0.1.
+    """
+
+    def __init__(self, cutoff, skin=0.3, num_threads=1, half_list=False,
+                 max_moved=0.1):
+        self.cutoff = cutoff
+        self.skin = skin
+        self.num_threads = num_threads
+        self.half_list = half_list
+        self.max_moved = max_moved
+        self.nbuilds = 0
+        self.nupdates = 0
+
+        self._positions = None
+        self._numbers = None
+        self._cell = None
+        self._pbc = None
+        self._buffers = {}
+
+    def _structure_changed(self, a):
+        """
+        Check whether the number of atoms, the elements, the cell or the
+        periodicity changed since the last build.
+        """
+        if self._positions is None or len(a) != len(self._positions):
+            return True
+        return (a.pbc != self._pbc).any() or (a.cell != self._cell).any() or \
+            (a.numbers != self._numbers).any()
+
+    def moved_atoms(self, a):
+        """
+        Indices of atoms that moved by more than half of the skin since they
+        were last searched.
+        """
+        dr = a.positions - self._positions
+        return np.nonzero(np.sum(dr*dr, axis=1) > (0.5*self.skin)**2)[0]
+
+    def rebuild_needed(self, a):
+        """
+        Check whether the stored pairs are still valid for configuration a.
+        """
+        if self._structure_changed(a):
+            return True
+        return len(self.moved_atoms(a)) > 0
+
+    def build(self, a):
+        """
+        Build the list for configuration a, irrespective of whether this is
+        necessary.
+        """
+        self._i, self._j, self._S, self._seed = \
+            neighbour_list('ijSp', a, _add_skin(self.cutoff, self.skin),
+                           num_threads=self.num_threads,
+                           half_list=self.half_list, out=self._buffers)
+        self._shift_vectors = np.dot(self._S, a.cell)
+        self._pair_cutoffs = _pair_cutoffs(a, self.cutoff, self._i, self._j)
+        self._positions = a.positions.copy()
+        self._numbers = a.numbers.copy()
+        self._cell = a.cell.copy()
+        self._pbc = a.pbc.copy()
+
+        # State of incremental updates
+        self._alive = None
+        self._reverse = None
+        self._extra = None
+        self._cell_list = None
+
+        self.nbuilds += 1
+
+    def _compact(self):
+        """
+        Merge pairs from incremental updates into the stored arrays.
+        """
+        i, j, S, shift_vectors, pair_cutoffs = self._pairs(
+            self._i, self._j, self._S, self._shift_vectors,
+            self._pair_cutoffs)
+        self._i, self._j, self._S, self._shift_vectors, self._pair_cutoffs = \
+            i, j, S, shift_vectors, pair_cutoffs
+        self._seed = first_neighbours(len(self._positions), i)
+        self._alive = None
+        self._reverse = None
+        self._extra = None
+
+    def _pairs(self, *args):
+        """
+        Combine per-pair arrays of the stored pairs that are still valid with
+        those of pairs from incremental updates, sorted by first index. Each
+        argument is either an array over the stored pairs or a scalar.
+        """
+        retvals = []
+        if self._alive is not None:
+            for x in args:
+                retvals += [x[self._alive] if np.ndim(x) > 0 else x]
+        else:
+            retvals = list(args)
+        if self._extra is None:
+            return retvals
+        extra_i = self._extra[0]
+        pos = np.searchsorted(retvals[0], extra_i, side='right')
+        for k, (x, e) in enumerate(zip(retvals, self._extra)):
+            if np.ndim(x) > 0:
+                retvals[k] = np.insert(x, pos, e, axis=0)
+        return retvals
+
+    def update_atoms(self, a, indices):
+        """
+        Update the list after the atoms given by indices have moved. Only
+        these atoms are re-binned and searched. Their pairs and the matching
+        reverse entries of their neighbours are replaced. The cell, the
+        periodicity and the elements must not have changed since the last
+        build.
+
+        Parameters
+        ----------
+        a : ase.Atoms
+            Current atomic configuration.
+        indices : array_like
+            Indices of the atoms that have moved.
+        """
+        if self._structure_changed(a):
+            raise ValueError('Structure changed since the last build, please '
+                             'rebuild the neighbour list.')
+        nat = len(a)
+        indices = np.unique(np.asarray(indices, dtype=int))
+        moved = np.zeros(nat, dtype=bool)
+        moved[indices] = True
+
+        # The persistent cell list holds the positions at which each atom
+        # was last searched, the reverse index lists the stored pairs by
+        # second atom. Both are created once they are needed.
+        max_cutoff, kwargs = _cutoff_arguments(a, _add_skin(self.cutoff,
+                                                            self.skin))
+        if self._cell_list is None:
+            self._cell_list = _matscipy.CellList(self._cell,
+                                                 np.linalg.inv(self._cell.T),
+                                                 self._pbc, self._positions,
+                                                 max_cutoff)
+        if self._reverse is None:
+            order = np.argsort(self._j, kind='mergesort')
+            self._reverse = order, first_neighbours(nat, self._j[order])
+
+        # Mask all stored pairs of the moved atoms
+        if self._alive is None:
+            self._alive = np.ones(len(self._i), dtype=bool)
+        self._alive[_concatenated_ranges(self._seed[indices],
+                                         self._seed[indices+1])] = False
+        order, reverse_seed = self._reverse
+        self._alive[order[_concatenated_ranges(reverse_seed[indices],
+                                               reverse_seed[indices+1])]] = \
+            False
+
+        # Search moved atoms at their new positions
+        self._positions[indices] = a.positions[indices]
+        self._cell_list.update(indices, self._positions[indices])
+        i, j, S = self._cell_list.neighbours('ijS', indices,
+                                             num_threads=self.num_threads,
+                                             **kwargs)
+        if self.half_list:
+            # Pairs between two moved atoms are found twice, keep them once
+            positive = np.logical_or(S[:, 0] > 0, np.logical_and(
+                S[:, 0] == 0, np.logical_or(S[:, 1] > 0, np.logical_and(
+                    S[:, 1] == 0, S[:, 2] > 0))))
+            mask = np.logical_or(np.logical_not(moved[j]), np.logical_or(
+                i < j, np.logical_and(i == j, positive)))
+            i, j, S = i[mask], j[mask], S[mask]
+            swap = i > j
+            i, j = np.where(swap, j, i), np.where(swap, i, j)
+            S[swap] *= -1
+        else:
+            # Reverse entries of the neighbours that have not moved
+            reverse = np.logical_not(moved[j])
+            i, j = np.append(i, j[reverse]), np.append(j, i[reverse])
+            S = np.append(S, -S[reverse], axis=0)
+        shift_vectors = np.dot(S, self._cell)
+        pair_cutoffs = _pair_cutoffs(a, self.cutoff, i, j)
+
+        # Keep pairs of earlier updates that are still valid
+        if self._extra is not None:
+            extra_i, extra_j = self._extra[:2]
+            mask = np.logical_not(np.logical_or(moved[extra_i],
+                                                moved[extra_j]))
+            i, j, S, shift_vectors, pair_cutoffs = [
+                np.append(e[mask], x, axis=0) if np.ndim(e) > 0 else x
+                for e, x in zip(self._extra, [i, j, S, shift_vectors,
+                                              pair_cutoffs])]
+        order = np.argsort(i, kind='mergesort')
+        self._extra = [x[order] if np.ndim(x) > 0 else x
+                       for x in [i, j, S, shift_vectors, pair_cutoffs]]
+
+        if len(self._extra[0]) > 0.1*len(self._i):
+            self._compact()
+        self.nupdates += 1
+
+    def update(self, a):
+        """
+        Rebuild or incrementally update the list if necessary.
+
+        Returns
+        -------
+        updated : bool
+            True if the list was rebuilt or updated.
+        """
+        if self._structure_changed(a):
+            self.build(a)
+            return True
+        moved = self.moved_atoms(a)
+        if len(moved) == 0:
+            return False
+        if len(moved) <= self.max_moved*len(a):
+            self.update_atoms(a, moved)
+        else:
+            self.build(a)
+        return True
+
+    def neighbour_list(self, quantities, a):
+        """
+        Return the neighbour list for configuration a, rebuilding it if
+        necessary. Arguments and return values are identical to the
+        :func:`neighbour_list` function, but the order of pairs for each
+        atom may differ.
+        """
+        self.update(a)
+
+        i, j, S, shift_vectors, pair_cutoffs = self._pairs(
+            self._i, self._j, self._S, self._shift_vectors,
+            self._pair_cutoffs)
+
+        r = a.positions
+        dr = r[j] - r[i] + shift_vectors
+        abs_dr = np.sqrt(np.sum(dr*dr, axis=1))
+        mask = abs_dr < pair_cutoffs
+
+        retvals = []
+        for q in quantities:
+            if q == 'i':
+                retvals += [i[mask]]
+            elif q == 'j':
+                retvals += [j[mask]]
+            elif q == 'D':
+                retvals += [dr[mask]]
+            elif q == 'd':
+                retvals += [abs_dr[mask]]
+            elif q == 'S':
+                retvals += [S[mask]]
+            elif q == 'p':
+                retvals += [first_neighbours(len(a), i[mask])]
+            elif q == 'N':
+                retvals += [np.bincount(i[mask], minlength=len(a))]
+            else:
+                raise ValueError('Unsupported quantity specified.')
 
+        if len(retvals) == 1:
+            return retvals[0]
+        return tuple(retvals)
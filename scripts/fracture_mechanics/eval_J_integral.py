@@ -67,7 +67,7 @@ print 'cohesive energy = {} eV/atom'.format(e0)
 a *= (1,3,1)
 a.set_pbc([True, False, True])
 ase.optimize.FIRE(a, logfile=None).run(fmax=params.fmax)
-coord = np.bincount(neighbour_list("i", a, 2.85))
+coord = neighbour_list("N", a, 2.85)
 esurf0 = (a.get_potential_energy() - e0*len(a))
 sx, sy, sz = a.cell.diagonal()
 print 'surface energy = {} J/m^2'.format(esurf0/(2*sx*sz)/J_m2)
@@ -20,6 +20,7 @@ setup(name='matscipy',
         Extension(
             '_matscipy',
             [ 'c/matscipymodule.c' ],
+            libraries=[ 'pthread' ],
             )
         ]
       )
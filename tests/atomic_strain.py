@@ -30,9 +30,13 @@ from ase.lattice.cubic import Diamond
 
 import matscipytest
 from matscipy.neighbours import mic, neighbour_list
-from matscipy.atomic_strain import (get_delta_plus_epsilon_dgesv,
+from matscipy.atomic_strain import (array_inverse, get_XIJ, get_YIJ,
+                                    get_XIJ_YIJ,
+                                    get_delta_plus_epsilon_dgesv,
                                     get_delta_plus_epsilon,
-                                    get_D_square_min)
+                                    get_delta_plus_epsilon_lstsq,
+                                    get_D_square_min,
+                                    AtomicStrainAnalyzer)
 
 ###
 
@@ -52,6 +56,84 @@ class TestAtomicStrain(matscipytest.MatSciPyTestCase):
 
         self.assertArrayAlmostEqual(dgrad1, dgrad2)
 
+    def test_rank_deficient(self):
+        # Single layer with vacuum in z, neighbours of each atom lie in a
+        # plane. Atoms of the last row have no neighbours.
+        a = Diamond('C', size=[4,4,1])
+        a = a[a.positions[:, 2] < 0.1]
+        a.set_pbc([True, True, False])
+        a += Diamond('C', size=[1,1,1])[:1]
+        a.positions[-1] = [0.5, 0.5, 10.0]
+        b = a.copy()
+        b.positions += (np.random.random(b.positions.shape)-0.5)*0.1
+        i, j = neighbour_list("ij", b, 2.6)
+        self.assertTrue(np.bincount(i).shape[0] < len(b))
+
+        dr_now = mic(b.positions[i] - b.positions[j], b.cell)
+        dr_old = mic(a.positions[i] - a.positions[j], a.cell)
+
+        dgrad1 = get_delta_plus_epsilon_lstsq(len(b), i, dr_now, dr_old)
+        dgrad2 = get_delta_plus_epsilon(len(b), i, dr_now, dr_old)
+
+        self.assertArrayAlmostEqual(dgrad1, dgrad2, tol=1e-6)
+
+    def test_analyzer(self):
+        a = Diamond('C', size=[3,3,3])
+        i, j = neighbour_list("ij", a, 1.85)
+        frames = []
+        for k in range(4):
+            b = a.copy()
+            b.positions += (np.random.random(b.positions.shape)-0.5)*0.1
+            frames += [b]
+
+        analyzer = AtomicStrainAnalyzer(a, 1.85)
+        for processes in [None, 2]:
+            results = list(analyzer.iterate(iter(frames),
+                                            processes=processes))
+            self.assertEqual(len(results), len(frames))
+            for b, (dgrad, residual) in zip(frames, results):
+                dgrad2, residual2 = get_D_square_min(b, a, i, j)
+                self.assertArrayAlmostEqual(dgrad, dgrad2, tol=1e-8)
+                self.assertArrayAlmostEqual(residual, residual2, tol=1e-8)
+
+    def test_XIJ_YIJ(self):
+        nat = 20
+        i = np.sort(np.random.randint(0, nat-2, size=200))
+        dr_now = np.random.random((200, 3))
+        dr_old = np.random.random((200, 3))
+        xij = np.zeros((nat, 3, 3))
+        yij = np.zeros((nat, 3, 3))
+        for n in range(len(i)):
+            xij[i[n]] += np.outer(dr_now[n], dr_old[n])
+            yij[i[n]] += np.outer(dr_old[n], dr_old[n])
+
+        self.assertArrayAlmostEqual(get_XIJ(nat, i, dr_now, dr_old), xij,
+                                    tol=1e-12)
+        self.assertArrayAlmostEqual(get_YIJ(nat, i, dr_old), yij, tol=1e-12)
+        xij2, yij2 = get_XIJ_YIJ(nat, i, dr_now, dr_old)
+        self.assertArrayAlmostEqual(xij2, xij, tol=1e-12)
+        self.assertArrayAlmostEqual(yij2, yij, tol=1e-12)
+
+        self.assertRaises(IndexError, get_YIJ, 10, i, dr_old)
+
+    def test_array_inverse(self):
+        A = np.random.random((100, 3, 3))
+        self.assertArrayAlmostEqual(array_inverse(A), np.linalg.inv(A),
+                                    tol=1e-8)
+        A = np.random.random((100, 4, 4))
+        self.assertArrayAlmostEqual(array_inverse(A), np.linalg.inv(A),
+                                    tol=1e-8)
+
+        # Singular matrices: rank deficient and zero
+        A = np.random.random((10, 3, 3))
+        A[3, 2] = A[3, 0] + 2*A[3, 1]
+        A[7] = 0.0
+        try:
+            array_inverse(A)
+            self.fail('No error raised for singular matrices.')
+        except np.linalg.LinAlgError as e:
+            self.assertTrue('[3 7]' in str(e))
+
 ###
 
 if __name__ == '__main__':
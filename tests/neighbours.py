@@ -21,6 +21,7 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 # ======================================================================
 
+import threading
 import unittest
 
 import numpy as np
@@ -29,7 +30,25 @@ import ase
 import ase.io as io
 
 import matscipytest
-from matscipy.neighbours import mic, neighbour_list
+from matscipy.neighbours import (mic, neighbour_list,
+                                  neighbour_list_trajectory, first_neighbours,
+                                  iter_neighbour_chunks, triplet_list,
+                                  CellList,
+                                  NeighbourList, spatial_sort,
+                                  scatter_pair_energies, scatter_pair_forces)
+
+###
+
+def sorted_pairs(i, j, *args):
+    """
+    Sort neighbour list by first index, second index and shift vector.
+    """
+    keys = [i, j]
+    for x in args:
+        if x.ndim == 2 and x.dtype.kind == 'i':
+            keys += list(x.T)
+    order = np.lexsort(keys[::-1])
+    return [i[order], j[order]] + [x[order] for x in args]
 
 ###
 
@@ -52,6 +71,524 @@ class TestNeighbours(matscipytest.MatSciPyTestCase):
 
         self.assertTrue(np.all(np.abs(dr-dr_direct) < 1e-12))
 
+    def test_shift_vectors(self):
+        a = io.read('aC.traj')
+        # Move some atoms out of the cell
+        a.positions[:10] -= a.cell[0]
+        a.positions[10:20] += 2*a.cell[2]
+        i, j, dr, shift = neighbour_list("ijDS", a, 1.85)
+        r = a.get_positions()
+        self.assertArrayAlmostEqual(r[j]-r[i]+np.dot(shift, a.cell), dr,
+                                    tol=1e-12)
+
+    def test_num_threads(self):
+        a = io.read('aC.traj')
+        serial = neighbour_list("ijDdS", a, 1.85)
+        for num_threads in [2, 3, 7]:
+            threaded = neighbour_list("ijDdS", a, 1.85,
+                                      num_threads=num_threads)
+            for x, y in zip(serial, threaded):
+                self.assertTrue(np.all(x == y))
+
+    def test_python_threads(self):
+        a = io.read('aC.traj')
+        frames = []
+        for k in range(4):
+            b = a.copy()
+            b.rattle(0.01, seed=k)
+            frames += [b]
+        serial = [neighbour_list("ijD", b, 1.85) for b in frames]
+
+        results = [None]*len(frames)
+        def run(k):
+            results[k] = neighbour_list("ijD", frames[k], 1.85)
+        threads = [threading.Thread(target=run, args=(k,))
+                   for k in range(len(frames))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        for r1, r2 in zip(serial, results):
+            for x, y in zip(r1, r2):
+                self.assertTrue(np.all(x == y))
+
+    def test_half_list(self):
+        a = io.read('aC.traj')
+        i, j, D, S = sorted_pairs(*neighbour_list("ijDS", a, 1.85))
+        ih, jh, Dh, Sh = neighbour_list("ijDS", a, 1.85, half_list=True)
+        self.assertEqual(2*len(ih), len(i))
+        self.assertTrue((ih <= jh).all())
+
+        # Adding the reverse pairs recovers the full list
+        ih, jh, Dh, Sh = sorted_pairs(np.append(ih, jh), np.append(jh, ih),
+                                      np.append(Dh, -Dh, axis=0),
+                                      np.append(Sh, -Sh, axis=0))
+        self.assertArrayAlmostEqual(i, ih)
+        self.assertArrayAlmostEqual(j, jh)
+        self.assertArrayAlmostEqual(S, Sh)
+        self.assertArrayAlmostEqual(D, Dh, tol=1e-12)
+
+        # Pair quantities scattered onto atoms
+        ih, jh = neighbour_list("ij", a, 1.85, half_list=True)
+        e = np.random.random(len(ih))
+        f = np.random.random((len(ih), 3))
+        self.assertArrayAlmostEqual(
+            scatter_pair_energies(len(a), ih, jh, e),
+            np.bincount(np.append(ih, jh), weights=np.append(e, e)/2,
+                        minlength=len(a)))
+        self.assertArrayAlmostEqual(
+            scatter_pair_forces(len(a), ih, jh, f).sum(axis=0), np.zeros(3))
+
+    def test_half_list_small_cell(self):
+        a = ase.Atoms('C', positions=[[0.5, 0.5, 0.5]], cell=[1, 1, 1],
+                      pbc=True)
+        i, j, S = neighbour_list("ijS", a, 1.5, half_list=True)
+        self.assertEqual(len(i), 9)
+        self.assertArrayAlmostEqual(
+            sorted(map(tuple, S)),
+            sorted(s for s in ((x, y, z) for x in (-1, 0, 1)
+                               for y in (-1, 0, 1) for z in (-1, 0, 1))
+                   if 0 < np.dot(s, s) < 3 and s > (0, 0, 0)))
+
+    def test_verlet_skin(self):
+        a = io.read('aC.traj')
+        nl = NeighbourList(1.85, skin=0.3)
+
+        i1, j1, D1, d1, S1 = nl.neighbour_list('ijDdS', a)
+        self.assertEqual(nl.nbuilds, 1)
+
+        # Small displacements reuse the list
+        b = a.copy()
+        b.positions += (np.random.random(b.positions.shape)-0.5)*0.1
+        i1, j1, S1, D1, d1 = sorted_pairs(*nl.neighbour_list('ijSDd', b))
+        self.assertEqual(nl.nbuilds, 1)
+        i2, j2, S2, D2, d2 = sorted_pairs(*neighbour_list('ijSDd', b, 1.85))
+        self.assertArrayAlmostEqual(i1, i2)
+        self.assertArrayAlmostEqual(j1, j2)
+        self.assertArrayAlmostEqual(S1, S2)
+        self.assertArrayAlmostEqual(D1, D2)
+        self.assertArrayAlmostEqual(d1, d2)
+
+        # Large displacements of a single atom trigger an update
+        b.positions[0] += [0.2, 0.0, 0.0]
+        nl.update(b)
+        self.assertEqual(nl.nbuilds, 1)
+        self.assertEqual(nl.nupdates, 1)
+
+        # Large displacements of many atoms trigger a rebuild
+        c = b.copy()
+        c.positions[::2] += [0.2, 0.0, 0.0]
+        nl.update(c)
+        self.assertEqual(nl.nbuilds, 2)
+
+        # So does a change of cell
+        b.set_cell(b.cell*1.01, scale_atoms=True)
+        i1, j1 = sorted_pairs(*nl.neighbour_list('ij', b))
+        self.assertEqual(nl.nbuilds, 3)
+        i2, j2 = sorted_pairs(*neighbour_list('ij', b, 1.85))
+        self.assertArrayAlmostEqual(i1, i2)
+        self.assertArrayAlmostEqual(j1, j2)
+
+    def test_chunks(self):
+        a = io.read('aC.traj')
+        for half_list in [False, True]:
+            for cutoff in [1.85, {('C', 'C'): 1.85}]:
+                i, j, D, S = sorted_pairs(*neighbour_list(
+                    'ijDS', a, cutoff, half_list=half_list))
+                chunks = list(iter_neighbour_chunks(
+                    'ijDSp', a, cutoff, chunk_atoms=50, half_list=half_list))
+                self.assertEqual(len(chunks), (len(a)+49)//50)
+                for k, (i2, j2, D2, S2, p2) in enumerate(chunks):
+                    self.assertTrue((i2 >= 50*k).all())
+                    self.assertTrue((i2 < 50*(k+1)).all())
+                    self.assertArrayAlmostEqual(
+                        p2, first_neighbours(min(50*(k+1), len(a)),
+                                             i2)[50*k:])
+                i2, j2, D2, S2 = sorted_pairs(
+                    *[np.concatenate(x) for x in list(zip(*chunks))[:4]])
+                self.assertArrayAlmostEqual(i, i2)
+                self.assertArrayAlmostEqual(j, j2)
+                self.assertArrayAlmostEqual(D, D2)
+                self.assertArrayAlmostEqual(S, S2)
+
+    def test_trajectory(self):
+        a = io.read('aC.traj')
+        frames = []
+        for k in range(5):
+            b = a.copy()
+            b.rattle(0.05, seed=k)
+            b.set_cell(a.cell*(1+0.01*k), scale_atoms=True)
+            frames += [b]
+        nat = len(a)
+
+        serial = [neighbour_list("ijDdSp", b, 1.85) for b in frames]
+        for num_threads in [1, 3, 7]:
+            f, i, j, D, d, S, p = neighbour_list_trajectory(
+                "fijDdSp", frames, 1.85, num_threads=num_threads)
+            self.assertEqual(len(p), len(frames)*nat+1)
+            for k, (i2, j2, D2, d2, S2, p2) in enumerate(serial):
+                mask = f == k
+                self.assertTrue((i[mask] == i2).all())
+                self.assertTrue((j[mask] == j2).all())
+                self.assertTrue((D[mask] == D2).all())
+                self.assertTrue((d[mask] == d2).all())
+                self.assertTrue((S[mask] == S2).all())
+                self.assertTrue((p[k*nat:(k+1)*nat+1]-p[k*nat] == p2).all())
+
+        # Stacked positions and cells
+        positions = np.array([b.positions for b in frames])
+        cells = np.array([np.asarray(b.cell) for b in frames])
+        f2, d2 = neighbour_list_trajectory("fd", a, 1.85, positions=positions,
+                                           cells=cells)
+        self.assertTrue((f == f2).all())
+        self.assertTrue((d == d2).all())
+
+    def test_out_buffers(self):
+        a = io.read('aC.traj')
+        i, j, D, d, S, p = neighbour_list("ijDdSp", a, 1.85)
+
+        buffers = {}
+        i1, j1, D1, d1, S1, p1 = neighbour_list("ijDdSp", a, 1.85,
+                                                out=buffers)
+        self.assertEqual(sorted(buffers.keys()), sorted("ijDdSp"))
+        self.assertTrue(len(buffers['i']) > len(i))
+        for x, y in zip([i, j, D, d, S, p], [i1, j1, D1, d1, S1, p1]):
+            self.assertTrue((x == y).all())
+
+        # Second call reuses the buffers
+        ids = dict((q, id(x)) for q, x in buffers.items())
+        b = a.copy()
+        b.rattle(0.01, seed=1)
+        i2, j2, d2 = neighbour_list("ijd", b, 1.85, out=buffers)
+        self.assertEqual(dict((q, id(x)) for q, x in buffers.items()), ids)
+        self.assertTrue(i2.base is buffers['i'])
+        self.assertTrue(d2.base is buffers['d'])
+        i3, j3, d3 = neighbour_list("ijd", b, 1.85)
+        self.assertTrue((i2 == i3).all())
+        self.assertTrue((j2 == j3).all())
+        self.assertTrue((d2 == d3).all())
+
+        # Buffers that are too small or of the wrong type are replaced
+        buffers = {'i': np.zeros(10, dtype=np.int32),
+                   'd': np.zeros(len(i)+10, dtype=np.float32)}
+        i4, d4 = neighbour_list("id", a, 1.85, out=buffers)
+        self.assertTrue(len(buffers['i']) >= len(i))
+        self.assertEqual(buffers['d'].dtype, np.float64)
+        self.assertTrue((i4 == i).all())
+        self.assertTrue((d4 == d).all())
+
+    def test_contiguous_bins(self):
+        a = io.read('aC.traj')
+        for cutoff in [1.85, 3.0]:
+            r1 = neighbour_list("ijDdS", a, cutoff)
+            r2 = neighbour_list("ijDdS", a, cutoff, contiguous_bins=False)
+            for x, y in zip(r1, r2):
+                self.assertTrue((x == y).all())
+
+    def test_spatial_sort(self):
+        a = io.read('aC.traj')
+        a.rattle(0.5)
+        permutation, inverse = spatial_sort(a)
+        self.assertArrayAlmostEqual(np.sort(permutation), np.arange(len(a)))
+        self.assertArrayAlmostEqual(permutation[inverse], np.arange(len(a)))
+
+        # Same pairs in the sorted configuration
+        i, j, d = sorted_pairs(*neighbour_list("ijd", a, 1.85))
+        b = a[permutation]
+        i2, j2, d2 = neighbour_list("ijd", b, 1.85)
+        i2, j2, d2 = sorted_pairs(permutation[i2], permutation[j2], d2)
+        self.assertArrayAlmostEqual(i, i2)
+        self.assertArrayAlmostEqual(j, j2)
+        self.assertArrayAlmostEqual(d, d2, tol=1e-12)
+
+        # Neighbours are closer in memory after sorting
+        self.assertTrue(np.abs(i2-j2).mean() > np.abs(inverse[i2]-
+                                                     inverse[j2]).mean())
+
+    def test_incremental_update(self):
+        a = io.read('aC.traj')
+        for half_list in [False, True]:
+            for cutoff in [1.85, {('C', 'C'): 1.85, ('H', 'C'): 1.2}]:
+                b = a.copy()
+                b.numbers[::5] = 1
+                nl = NeighbourList(cutoff, skin=0.3, half_list=half_list)
+                nl.update(b)
+                for step in range(3):
+                    # Move a few atoms far, some of them across the cell
+                    # boundary
+                    moved = np.random.permutation(len(b))[:20]
+                    b.positions[moved] += 3*(np.random.random((20, 3))-0.5)
+                    b.positions[moved[:5]] += b.cell[1]
+                    i1, j1, S1, p1 = nl.neighbour_list('ijSp', b)
+                    self.assertEqual(nl.nbuilds, 1)
+                    self.assertEqual(nl.nupdates, step+1)
+                    self.assertArrayAlmostEqual(p1,
+                                                first_neighbours(len(b), i1))
+                    i1, j1, S1 = sorted_pairs(i1, j1, S1)
+                    i2, j2, S2 = sorted_pairs(*neighbour_list(
+                        'ijS', b, cutoff, half_list=half_list))
+                    self.assertArrayAlmostEqual(i1, i2)
+                    self.assertArrayAlmostEqual(j1, j2)
+                    self.assertArrayAlmostEqual(S1, S2)
+
+    def test_triplet_list(self):
+        a = io.read('aC.traj')
+        i, j, D, d, p = neighbour_list('ijDdp', a, 1.85)
+        for cutoff in [None, 1.5]:
+            ti, tj, tk, ij, ik, c, t = triplet_list('ijkabct', i, j, D,
+                                                    cutoff=cutoff, p=p)
+            # Loop over pairs of pairs
+            ref = []
+            for n in range(len(a)):
+                for m in range(p[n], p[n+1]):
+                    for l in range(p[n], p[n+1]):
+                        if m != l and (cutoff is None or d[l] < cutoff):
+                            ref += [(m, l)]
+            ref = np.array(ref)
+            self.assertArrayAlmostEqual(ij, ref[:, 0])
+            self.assertArrayAlmostEqual(ik, ref[:, 1])
+            self.assertArrayAlmostEqual(ti, i[ij])
+            self.assertArrayAlmostEqual(tj, j[ij])
+            self.assertArrayAlmostEqual(tk, j[ik])
+            self.assertArrayAlmostEqual(
+                c, np.sum(D[ij]*D[ik], axis=1)/(d[ij]*d[ik]), tol=1e-12)
+            self.assertArrayAlmostEqual(np.cos(t), c, tol=1e-12)
+
+        # Offsets are computed from i if omitted
+        ij2 = triplet_list('a', i, j, D, cutoff=1.5)
+        self.assertArrayAlmostEqual(ij2, ij)
+
+        # 64-bit indices, atom indices keep their type, central atom and pair
+        # indices are intp
+        i64, j64, D64, p64 = neighbour_list('ijDp', a, 1.85,
+                                            int_type=np.int64)
+        for p2 in [None, p64, p64.astype(np.int32)]:
+            ti2, tj2, ij2 = triplet_list('ija', i64, j64, D64, cutoff=1.5,
+                                         p=p2)
+            self.assertEqual(ti2.dtype, np.intp)
+            self.assertEqual(tj2.dtype, np.int64)
+            self.assertEqual(ij2.dtype, np.intp)
+            self.assertArrayAlmostEqual(ti2, ti)
+            self.assertArrayAlmostEqual(tj2, tj)
+            self.assertArrayAlmostEqual(ij2, ij)
+        self.assertRaises(TypeError, triplet_list, 'ja', i, D[:, 0], D)
+
+    def test_reductions(self):
+        a = io.read('aC.traj')
+        for half_list in [False, True]:
+            for num_threads in [1, 3]:
+                i, d = neighbour_list('id', a, 1.85, half_list=half_list)
+                N, h = neighbour_list('Nh', a, 1.85, num_threads=num_threads,
+                                      half_list=half_list, nbins=37)
+                self.assertArrayAlmostEqual(N, np.bincount(i,
+                                                           minlength=len(a)))
+                self.assertArrayAlmostEqual(
+                    h, np.histogram(d, bins=37, range=(0, 1.85))[0])
+
+        # Per-pair cutoffs, histogram extends to the largest cutoff
+        cutoff = {('C', 'C'): 1.85, ('H', 'C'): 1.2}
+        b = a.copy()
+        b.numbers[::5] = 1
+        i, d = neighbour_list('id', b, cutoff)
+        N, h = neighbour_list('Nh', b, cutoff)
+        self.assertArrayAlmostEqual(N, np.bincount(i, minlength=len(b)))
+        self.assertArrayAlmostEqual(
+            h, np.histogram(d, bins=100, range=(0, 1.85))[0])
+
+        # Trajectories count per frame and sum the histograms
+        frames = [a, a.copy()]
+        frames[1].positions += 0.1*np.random.random((len(a), 3))
+        f, i, d, N, h = neighbour_list_trajectory('fidNh', frames, 1.85)
+        self.assertArrayAlmostEqual(N, np.bincount(f*len(a)+i,
+                                                   minlength=2*len(a)))
+        self.assertArrayAlmostEqual(
+            h, np.histogram(d, bins=100, range=(0, 1.85))[0])
+
+        nl = NeighbourList(1.85)
+        self.assertArrayAlmostEqual(nl.neighbour_list('N', a),
+                                    neighbour_list('N', a, 1.85))
+
+        self.assertRaises(ValueError, neighbour_list, 'h', a, 1.85, nbins=0)
+
+    def test_mic(self):
+        def reference_mic(dr, cell, pbc):
+            s = np.round(np.dot(dr, np.linalg.inv(cell)))*pbc
+            return dr - np.dot(s, cell)
+
+        dr = 20*(np.random.random((100, 3))-0.5)
+        triclinic = np.array([[5.0, 0.0, 0.0], [1.5, 6.0, 0.0],
+                              [0.5, -1.0, 7.0]])
+        orthorhombic = np.diag([5.0, 6.0, 7.0])
+        for cell in [triclinic, orthorhombic]:
+            for pbc in [[True, True, True], [True, False, True]]:
+                self.assertArrayAlmostEqual(mic(dr, cell, pbc),
+                                            reference_mic(dr, cell, pbc),
+                                            tol=1e-12)
+            self.assertArrayAlmostEqual(
+                mic(dr, cell, inv_cell=np.linalg.inv(cell)),
+                reference_mic(dr, cell, [True, True, True]), tol=1e-12)
+
+        # Stacked frames with one cell per frame
+        cells = np.array([triclinic, orthorhombic, 1.1*triclinic])
+        drs = 20*(np.random.random((3, 50, 3))-0.5)
+        wrapped = mic(drs, cells)
+        for dr, cell, wrapped_dr in zip(drs, cells, wrapped):
+            self.assertArrayAlmostEqual(wrapped_dr,
+                                        reference_mic(dr, cell, 1),
+                                        tol=1e-12)
+
+        # In place
+        dr2 = dr.copy()
+        self.assertTrue(mic(dr2, triclinic, in_place=True) is dr2)
+        self.assertArrayAlmostEqual(dr2, mic(dr, triclinic), tol=1e-12)
+        self.assertRaises(TypeError, mic, dr2.astype(np.float32), triclinic,
+                          in_place=True)
+
+    def test_output_types(self):
+        a = io.read('aC.traj')
+        i, j, D, d, S = neighbour_list('ijDdS', a, 1.85)
+        for num_threads in [1, 3]:
+            i2, j2, D2, d2, S2, p2 = neighbour_list(
+                'ijDdSp', a, 1.85, num_threads=num_threads,
+                float_type=np.float32, int_type=np.int64)
+            for x in [i2, j2, S2]:
+                self.assertEqual(x.dtype, np.int64)
+            for x in [D2, d2]:
+                self.assertEqual(x.dtype, np.float32)
+            self.assertEqual(p2.dtype, np.intp)
+            self.assertArrayAlmostEqual(i, i2)
+            self.assertArrayAlmostEqual(j, j2)
+            self.assertArrayAlmostEqual(S, S2)
+            self.assertArrayAlmostEqual(D, D2, tol=1e-6)
+            self.assertArrayAlmostEqual(d, d2, tol=1e-6)
+
+        i2, d2 = neighbour_list('id', a, 1.85, float_type='f4',
+                                int_type='i4')
+        self.assertEqual(i2.dtype, np.int32)
+        self.assertEqual(d2.dtype, np.float32)
+
+        f, i2 = neighbour_list_trajectory('fi', [a, a], 1.85,
+                                          int_type=np.int64)
+        self.assertEqual(f.dtype, np.int64)
+        self.assertArrayAlmostEqual(i2, np.append(i, i))
+
+        self.assertRaises(TypeError, neighbour_list, 'd', a, 1.85,
+                          float_type=np.int32)
+        self.assertRaises(TypeError, neighbour_list, 'i', a, 1.85,
+                          int_type=np.int16)
+
+    def test_cell_list_queries(self):
+        a = io.read('aC.traj')
+        points = np.dot(np.random.random((20, 3)), a.cell)
+        # Brute force distances from each point to all atoms, the radii
+        # below are smaller than half the cell
+        D = mic(a.positions.reshape(1, -1, 3) - points.reshape(-1, 1, 3),
+                a.cell)
+        d = np.sqrt(np.sum(D*D, axis=2))
+
+        cl = CellList(a, 1.85)
+        for r in [1.0, 1.85, 3.0]:
+            i, j, D2, d2, p = cl.query_radius(points, r, 'ijDdp')
+            self.assertArrayAlmostEqual(p, first_neighbours(len(points), i))
+            mask = d < r
+            i3, j3 = np.nonzero(mask)
+            i, j, D2, d2 = sorted_pairs(i, j, D2, d2)
+            self.assertArrayAlmostEqual(i, i3)
+            self.assertArrayAlmostEqual(j, j3)
+            self.assertArrayAlmostEqual(D2, D[mask], tol=1e-12)
+            self.assertArrayAlmostEqual(d2, d[mask], tol=1e-12)
+
+        j, d2 = cl.query_knn(points, 7)
+        self.assertEqual(j.shape, (20, 7))
+        self.assertArrayAlmostEqual(j, np.argsort(d, axis=1)[:, :7])
+        self.assertArrayAlmostEqual(d2, np.sort(d, axis=1)[:, :7],
+                                    tol=1e-12)
+        D2 = cl.query_knn(points, 7, 'D')
+        self.assertArrayAlmostEqual(np.sqrt(np.sum(D2*D2, axis=2)), d2,
+                                    tol=1e-12)
+
+        # Non-periodic, ask for all atoms
+        b = a.copy()
+        b.set_pbc(False)
+        point = np.dot([[0.1, 0.2, 0.3]], b.cell)
+        d = np.sqrt(np.sum((b.positions-point)**2, axis=1))
+        j, d2 = CellList(b, 1.85).query_knn(point, len(b))
+        self.assertArrayAlmostEqual(j[0], np.argsort(d))
+        self.assertArrayAlmostEqual(d2[0], np.sort(d), tol=1e-12)
+        self.assertRaises(ValueError, CellList(b, 1.85).query_knn, point,
+                          len(b)+1)
+
+        # Query point far from a small non-periodic system
+        j, d2 = CellList(b[:5], 1.85).query_knn(point+1000, 5)
+        self.assertEqual(sorted(j[0]), list(range(5)))
+
+        # No atoms, periodic or not
+        for pbc in [True, False]:
+            c = a[:0]
+            c.set_pbc(pbc)
+            self.assertRaises(ValueError, CellList(c, 1.85).query_knn,
+                              point, 1)
+
+    def test_first_neighbours(self):
+        a = io.read('aC.traj')
+        i, d, p = neighbour_list("idp", a, 1.85)
+        self.assertEqual(len(p), len(a)+1)
+        self.assertArrayAlmostEqual(p, first_neighbours(len(a), i))
+        for n in [0, 17, len(a)-1]:
+            self.assertTrue((i[p[n]:p[n+1]] == n).all())
+        self.assertArrayAlmostEqual(np.add.reduceat(d, p[:-1]),
+                                    np.bincount(i, weights=d), tol=1e-12)
+
+        p = neighbour_list("p", a, 1.85, num_threads=3)
+        self.assertArrayAlmostEqual(p, first_neighbours(len(a), i))
+
+        # Atoms without neighbours
+        b = ase.Atoms('CC', positions=[[0, 0, 0], [5, 0, 0]],
+                      cell=[10, 10, 10])
+        p = neighbour_list("p", b, 1.85)
+        self.assertArrayAlmostEqual(p, [0, 0, 0])
+
+        nl = NeighbourList(1.85, skin=0.3)
+        i, p = nl.neighbour_list("ip", a)
+        self.assertArrayAlmostEqual(p, first_neighbours(len(a), i))
+
+    def test_per_atom_cutoffs(self):
+        a = io.read('aC.traj')
+        radii = 0.8 + 0.2*np.random.random(len(a))
+        i, j, d, S = sorted_pairs(*neighbour_list("ijdS", a, radii))
+        self.assertTrue((d < radii[i]+radii[j]).all())
+
+        i2, j2, d2, S2 = neighbour_list("ijdS", a, 2*radii.max())
+        mask = d2 < radii[i2]+radii[j2]
+        i2, j2, d2, S2 = sorted_pairs(i2[mask], j2[mask], d2[mask], S2[mask])
+        self.assertArrayAlmostEqual(i, i2)
+        self.assertArrayAlmostEqual(j, j2)
+        self.assertArrayAlmostEqual(S, S2)
+        self.assertArrayAlmostEqual(d, d2)
+
+    def test_pair_cutoffs(self):
+        a = io.read('aC.traj')
+        a.numbers[::3] = 1
+        cutoffs = {('C', 'C'): 1.85, (1, 6): 1.2}
+        i, j, d = sorted_pairs(*neighbour_list("ijd", a, cutoffs))
+
+        i2, j2, d2 = neighbour_list("ijd", a, 1.85)
+        Zi, Zj = a.numbers[i2], a.numbers[j2]
+        mask = np.logical_or(np.logical_and(Zi == 6, Zj == 6),
+                             np.logical_and(Zi != Zj, d2 < 1.2))
+        i2, j2, d2 = sorted_pairs(i2[mask], j2[mask], d2[mask])
+        self.assertArrayAlmostEqual(i, i2)
+        self.assertArrayAlmostEqual(j, j2)
+        self.assertArrayAlmostEqual(d, d2)
+
+        # Verlet list with per-pair cutoffs
+        nl = NeighbourList(cutoffs, skin=0.3)
+        i3, j3, d3 = sorted_pairs(*nl.neighbour_list("ijd", a))
+        self.assertArrayAlmostEqual(i, i3)
+        self.assertArrayAlmostEqual(j, j3)
+        self.assertArrayAlmostEqual(d, d3)
+
     def test_small_cell(self):
         a = ase.Atoms('C', positions=[[0.5, 0.5, 0.5]], cell=[1, 1, 1],
                       pbc=True)
@@ -74,6 +611,37 @@ class TestNeighbours(matscipytest.MatSciPyTestCase):
         i = neighbour_list("i", a, 1.1)
         assert np.bincount(i)[0] == 4
 
+    def test_skewed_cell(self):
+        a = ase.Atoms('CCC', positions=[[0.2, 0.3, 0.1],
+                                        [1.1, 0.4, 0.9],
+                                        [0.6, 1.4, 1.3]],
+                      cell=[2.0, 1.8, 2.2], pbc=True)
+
+        # Same lattice, spanned by strongly skewed cell vectors
+        b = a.copy()
+        b.set_cell(np.dot([[1, 0, 0], [3, 1, 0], [-2, 4, 1]], a.cell))
+        for pbc in [True, [True, True, False]]:
+            a.set_pbc(pbc)
+            b.set_pbc(pbc)
+            i, j, d = neighbour_list("ijd", a, 5.0)
+            order = np.lexsort((d, j, i))
+            ib, jb, Db, db, Sb = neighbour_list("ijDdS", b, 5.0)
+            order_b = np.lexsort((db, jb, ib))
+            self.assertArrayAlmostEqual(i[order], ib[order_b])
+            self.assertArrayAlmostEqual(j[order], jb[order_b])
+            self.assertArrayAlmostEqual(d[order], db[order_b], tol=1e-12)
+
+            # Shift vectors refer to the cell vectors of b
+            r = b.get_positions()
+            self.assertArrayAlmostEqual(r[jb]-r[ib]+np.dot(Sb, b.cell), Db,
+                                        tol=1e-12)
+
+            # Half list keeps images of the same atom with positive shift
+            ih, jh, Sh = neighbour_list("ijS", b, 5.0, half_list=True)
+            self.assertEqual(2*len(ih), len(ib))
+            self.assertTrue(all(tuple(s) > (0, 0, 0)
+                                for s in Sh[ih == jh]))
+
     def test_out_of_cell_small_cell(self):
         a = ase.Atoms('CC', positions=[[0.5, 0.5, 0.5],
                                        [1.1, 0.5, 0.5]],